@@ -0,0 +1,99 @@
+"""Compare the per-face and vectorized inertia matrix and scale calculations
+
+The per-face path is the one ImagesBuilder used before: one cross product matrix
+per face, squared and folded together with reduce. It uses mathutils.Matrix when
+run inside blender (blender -b -P bench_geometry.py) and equivalent 3x3 numpy
+arrays otherwise.
+
+    $ python benchmarks/bench_geometry.py --faces 10000 100000 1000000
+"""
+import argparse
+import sys
+import timeit
+from functools import reduce
+from operator import add
+from os.path import abspath, dirname, join
+
+import numpy as np
+
+sys.path.append(join(dirname(dirname(abspath(__file__))), 'match3d'))
+from geometry import inertia_matrix, max_vertex_norm
+
+try:
+    from mathutils import Matrix
+
+    def _matrix(rows):
+        return Matrix(rows)
+
+    def _square(M):
+        return M * M
+except ImportError:
+    def _matrix(rows):
+        return np.array(rows)
+
+    def _square(M):
+        return M.dot(M)
+
+
+def _bracketB(v):
+    return _matrix([[    0, -v[2], v[1]],
+                    [v[2],    0, -v[0]],
+                    [-v[1], v[0],   0]])
+
+
+def per_face_inertia_matrix(areas, centroids):
+    return reduce(add, map(lambda f: -1 * f[0] * _square(_bracketB(f[1])), zip(areas, centroids)))
+
+
+def per_vertex_max_norm(coordinates):
+    return max([np.linalg.norm(x) for x in coordinates])
+
+
+def synthetic_mesh(n_faces, seed=0):
+    """Random triangles scattered over an ellipsoid, so the inertia matrix isn't degenerate"""
+    rng = np.random.RandomState(seed)
+    centers = rng.normal(size=(n_faces, 3))
+    centers /= np.linalg.norm(centers, axis=1)[:, np.newaxis]
+    centers *= [3., 2., 1.]
+    triangles = centers[:, np.newaxis, :] + 0.01 * rng.normal(size=(n_faces, 3, 3))
+    areas = 0.5 * np.linalg.norm(np.cross(triangles[:, 1] - triangles[:, 0],
+                                          triangles[:, 2] - triangles[:, 0]), axis=1)
+    centroids = triangles.mean(axis=1)
+    vertices = triangles.reshape(-1, 3)
+    return areas.astype(np.float32), centroids.astype(np.float32), vertices.astype(np.float32)
+
+
+def best_of(function, repeat):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--faces', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--skip-per-face', action='store_true',
+                        help='only time the vectorized path (the per-face one is slow on big meshes)')
+    if argv is None and '--' in sys.argv:
+        # inside blender, our arguments come after the double dash
+        argv = sys.argv[sys.argv.index('--') + 1:]
+    args = parser.parse_args(argv)
+
+    print('{:>10} {:>14} {:>14} {:>14} {:>14}'.format('faces', 'inertia loop', 'inertia numpy',
+                                                      'norm loop', 'norm numpy'))
+    for n_faces in args.faces:
+        areas, centroids, vertices = synthetic_mesh(n_faces)
+        vectorized = best_of(lambda: inertia_matrix(areas, centroids), args.repeat)
+        vectorized_norm = best_of(lambda: max_vertex_norm(vertices), args.repeat)
+        if args.skip_per_face:
+            loop = loop_norm = float('nan')
+        else:
+            loop = best_of(lambda: per_face_inertia_matrix(areas, centroids), 1)
+            loop_norm = best_of(lambda: per_vertex_max_norm(vertices), 1)
+            assert np.allclose(np.array(per_face_inertia_matrix(areas[:1000], centroids[:1000])),
+                               inertia_matrix(areas[:1000], centroids[:1000]), rtol=1e-4)
+        print('{:>10} {:>13.4f}s {:>13.4f}s {:>13.4f}s {:>13.4f}s'.format(n_faces, loop, vectorized,
+                                                                          loop_norm, vectorized_norm))
+
+
+if __name__ == '__main__':
+    main()
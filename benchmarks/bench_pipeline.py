@@ -0,0 +1,299 @@
+"""Benchmark the stages of match3d and whole adds and searches, with no services running
+
+Builds a synthetic corpus (synthetic_corpus.py), indexes it into a
+local_index.LocalOperations instead of elasticsearch, and renders with the
+numpy rasterizer, or through the blender code paths with blender_stub.py
+standing in for blender (--renderer blender-stub). Needs the Python
+dependencies of match3d (image_match, elasticsearch) but no elasticsearch
+server and no blender.
+
+Benchmarks:
+
+* ``geometry``: inertia matrix and scale of a mesh, the numpy work behind ImagesBuilder's
+  _inertia_matrix and _scale_object, for every --faces
+* ``render``: the three search views, for every --faces
+* ``signatures``: make_record over all the views of a design, in this process and in the pool
+* ``scoring``: composite_score, tournament_score, best_single_image and _best_single_image on synthetic hits
+* ``search_images``: signatures and queries of the views of a query model, one at a time and batched
+* ``add``: APIOperations.add of every design, and add_many of the whole corpus
+* ``search``: APIOperations.search with every variant in the corpus, also progressively, and of every
+  design against an empty index, where nothing matches
+
+Every benchmark reports the best of --repeat runs, and add and search the mean of
+every stage (see match3d/timing.py). Results are written as JSON, so runs can be
+compared over time.
+
+    $ python benchmarks/bench_pipeline.py --output results.json
+    $ python benchmarks/bench_pipeline.py --benchmarks geometry render --faces 1000 1000000 5000000
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from collections import OrderedDict
+from os import environ, listdir, pathsep
+from os.path import abspath, dirname, join
+from shutil import rmtree
+
+import numpy as np
+
+BENCHMARKS_DIRECTORY = dirname(abspath(__file__))
+sys.path.append(join(dirname(BENCHMARKS_DIRECTORY), 'match3d'))
+from geometry import inertia_matrix, max_vertex_norm
+from local_index import LocalOperations
+from rasterizer import NumpyRenderer, render_views
+from stl_reader import STLMesh
+from three_d_match import ThreeDSearch
+
+import blender_stub
+from synthetic_corpus import generate_corpus, random_primitive
+
+
+def best_of(function, repeat):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+class Bench(object):
+    def __init__(self, args):
+        self.args = args
+        self.work_directory = tempfile.mkdtemp()
+        self.corpus = generate_corpus(join(self.work_directory, 'corpus'), designs=args.designs,
+                                      variants=args.variants, faces=args.corpus_faces, seed=args.seed)
+        self.results = []
+        self.stages = {}
+        self._ops = None
+
+        if args.renderer == 'blender-stub':
+            stub_directory = join(self.work_directory, 'bin')
+            blender_stub.install(stub_directory, resolution=args.resolution)
+            environ['PATH'] = stub_directory + pathsep + environ.get('PATH', '')
+
+    def close(self):
+        if self._ops is not None:
+            self._ops.close()
+        rmtree(self.work_directory)
+
+    def operations(self, fresh=False):
+        """A LocalOperations on an empty index in the work directory"""
+        if fresh or self._ops is None:
+            if self._ops is not None:
+                self._ops.close()
+            self._ops = LocalOperations(tempfile.mkdtemp(dir=self.work_directory),
+                                        render_backend='numpy' if self.args.renderer == 'numpy' else 'blender',
+                                        processes=self.args.processes,
+                                        blender_processes=self.args.blender_processes,
+                                        timing_hook=self._record_stage)
+            self._ops.render_backends['numpy'] = NumpyRenderer(resolution=self.args.resolution)
+        return self._ops
+
+    def _record_stage(self, stage, seconds, info):
+        self.stages.setdefault(stage, []).append(seconds)
+
+    def stage_means(self):
+        """Mean seconds of every stage recorded since the last call"""
+        means = dict((stage, float(np.mean(seconds))) for stage, seconds in self.stages.items())
+        self.stages = {}
+        return means
+
+    def report(self, benchmark, seconds, **params):
+        result = OrderedDict([('benchmark', benchmark), ('seconds', seconds)])
+        result.update(sorted(params.items()))
+        self.results.append(result)
+        details = ' '.join('{}={}'.format(key, value) for key, value in sorted(params.items())
+                           if not isinstance(value, dict))
+        sys.stderr.write('{:<32} {:>12.6f}s  {}\n'.format(benchmark, seconds, details))
+
+    def render(self, stl_path, rotations=True, front_and_back=True, reflections=True):
+        """Views of a model, rendered with the numpy rasterizer into a new directory"""
+        output_directory = tempfile.mkdtemp(dir=self.work_directory)
+        NumpyRenderer(resolution=self.args.resolution).render(dirname(stl_path), output_directory,
+                                                              rotations=rotations, front_and_back=front_and_back,
+                                                              reflections=reflections)
+        return output_directory
+
+
+def bench_geometry(bench):
+    for n_faces in bench.args.faces:
+        triangles = random_primitive('ellipsoid', n_faces, np.random.RandomState(bench.args.seed)).astype(np.float32)
+        areas, centroids = STLMesh(triangles).areas_and_centroids()
+        vertices = triangles.reshape(-1, 3)
+        bench.report('geometry.inertia_matrix', best_of(lambda: inertia_matrix(areas, centroids), bench.args.repeat),
+                     faces=len(triangles))
+        bench.report('geometry.max_vertex_norm', best_of(lambda: max_vertex_norm(vertices), bench.args.repeat),
+                     faces=len(triangles))
+
+
+def bench_render(bench):
+    for n_faces in bench.args.faces:
+        triangles = random_primitive('ellipsoid', n_faces, np.random.RandomState(bench.args.seed))
+        seconds = best_of(lambda: list(render_views(triangles, bench.args.resolution)), bench.args.repeat)
+        bench.report('render.search_views', seconds, faces=len(triangles), resolution=bench.args.resolution, views=3)
+
+
+def bench_signatures(bench):
+    images_directory = bench.render(bench.corpus[0]['path'])
+    img_paths = [join(images_directory, name) for name in listdir(images_directory) if name.endswith('.png')]
+    for processes in sorted(set([1, bench.args.processes or 0])):
+        ops = ThreeDSearch(signature_database=bench.operations().ses, processes=processes or None)
+        try:
+            seconds = best_of(lambda: ops.make_records(img_paths), bench.args.repeat)
+        finally:
+            ops.close()
+        bench.report('signatures.make_records', seconds, views=len(img_paths), processes=processes or 'cores',
+                     resolution=bench.args.resolution)
+
+
+def synthetic_hits(n_views, n_hits, n_designs, seed=0):
+    """Search results like search_images returns: n_hits hits for every view, among n_designs designs"""
+    rng = np.random.RandomState(seed)
+    results = []
+    for _ in range(n_views):
+        designs = rng.randint(0, n_designs, n_hits)
+        results.append(sorted(({'id': 'design{}.{}'.format(design, i),
+                                'path': '/images/design{}/view{}.png'.format(design, i),
+                                'metadata': {'stl_id': 'design{}'.format(design)},
+                                'score': 1.0,
+                                'dist': float(dist)}
+                               for i, (design, dist) in enumerate(zip(designs, rng.uniform(0, 0.5, n_hits)))),
+                              key=lambda hit: hit['dist']))
+    return results
+
+
+def bench_scoring(bench):
+    ops = bench.operations()
+    for n_views in (3, 48):
+        results = synthetic_hits(n_views, 100, 1000, bench.args.seed)
+        for name, function in (('composite_score', ThreeDSearch.composite_score),
+                               ('tournament_score', ThreeDSearch.tournament_score),
+                               ('best_single_image', ThreeDSearch.best_single_image),
+                               ('_best_single_image', ops._best_single_image)):
+            seconds = best_of(lambda: function(results), bench.args.repeat)
+            bench.report('scoring.' + name, seconds, views=n_views, hits=100)
+
+
+def bench_search_images(bench):
+    ops = bench.operations()
+    if not ops.list_designs():
+        ops.add_many([(design['stl_id'], design['path']) for design in bench.corpus])
+    images_directory = bench.render(bench.corpus[-1]['path'], rotations=False, front_and_back=False,
+                                    reflections=False)
+    for batch in (False, True):
+        seconds = best_of(lambda: ops.search_images(images_directory, batch=batch), bench.args.repeat)
+        bench.report('search_images', seconds, batch=batch, designs=len(bench.corpus), views=3)
+
+
+def bench_add(bench):
+    ops = bench.operations(fresh=True)
+    bench.stage_means()
+    started = time.time()
+    for design in bench.corpus:
+        ops.add(design['stl_id'], stl_file=design['path'])
+    seconds = time.time() - started
+    bench.report('add', seconds / len(bench.corpus), designs=len(bench.corpus), renderer=bench.args.renderer,
+                 stages=bench.stage_means())
+
+    ops = bench.operations(fresh=True)
+    started = time.time()
+    ops.add_many([(design['stl_id'], design['path']) for design in bench.corpus])
+    seconds = time.time() - started
+    bench.report('add_many', seconds / len(bench.corpus), designs=len(bench.corpus), renderer=bench.args.renderer,
+                 stages=bench.stage_means())
+
+
+def bench_search(bench):
+    ops = bench.operations()
+    if not ops.list_designs():
+        ops.add_many([(design['stl_id'], design['path']) for design in bench.corpus])
+    queries = [design for design in bench.corpus if design['stl_id'] != design['family']] or bench.corpus
+    for ranking, progressive in (('single', False), ('single', True), ('shape', False)):
+        bench.stage_means()
+        tiers = {}
+        started = time.time()
+        for design in queries:
+            result = ops.search(stl_file=design['path'], ranking=ranking, progressive=progressive)
+            if progressive:
+                tiers[result['tier']] = tiers.get(result['tier'], 0) + 1
+        seconds = time.time() - started
+        bench.report('search.progressive' if progressive else 'search', seconds / len(queries), ranking=ranking,
+                     queries=len(queries), designs=len(bench.corpus), renderer=bench.args.renderer,
+                     stages=bench.stage_means(), **({'tiers': tiers} if progressive else {}))
+
+    # queries that match nothing, which progressive searches shouldn't escalate
+    ops = bench.operations(fresh=True)
+    for progressive in (False, True):
+        bench.stage_means()
+        tiers = {}
+        started = time.time()
+        for design in bench.corpus:
+            result = ops.search(stl_file=design['path'], progressive=progressive)
+            if progressive:
+                tiers[result['tier']] = tiers.get(result['tier'], 0) + 1
+        seconds = time.time() - started
+        bench.report('search.no_match.progressive' if progressive else 'search.no_match', seconds / len(bench.corpus),
+                     queries=len(bench.corpus), renderer=bench.args.renderer, stages=bench.stage_means(),
+                     **({'tiers': tiers} if progressive else {}))
+
+
+BENCHMARKS = OrderedDict([('geometry', bench_geometry),
+                          ('render', bench_render),
+                          ('signatures', bench_signatures),
+                          ('scoring', bench_scoring),
+                          ('search_images', bench_search_images),
+                          ('add', bench_add),
+                          ('search', bench_search)])
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARKS_DIRECTORY,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--benchmarks', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument('--faces', type=int, nargs='+', default=[1000, 100000, 1000000],
+                        help='mesh sizes of the geometry and render benchmarks (up to 5000000 or so)')
+    parser.add_argument('--designs', type=int, default=1, help='corpus designs of every primitive')
+    parser.add_argument('--variants', type=int, default=2, help='perturbed copies of every corpus design')
+    parser.add_argument('--corpus-faces', type=int, nargs='+', default=[2000], help='mesh sizes of the corpus')
+    parser.add_argument('--resolution', type=int, default=256)
+    parser.add_argument('--renderer', choices=['numpy', 'blender-stub', 'blender'], default='numpy',
+                        help='render with the numpy backend, or spawn blender (or blender_stub.py as blender)')
+    parser.add_argument('--processes', type=int, help='signature pool size (default: one per core)')
+    parser.add_argument('--blender-processes', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this JSON file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    bench = Bench(args)
+    try:
+        for name in args.benchmarks:
+            BENCHMARKS[name](bench)
+    finally:
+        bench.close()
+
+    output = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                       'revision': git_revision(),
+                       'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'platform': platform.platform(),
+                       'args': vars(args)},
+              'results': bench.results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""Time the numpy rasterizer on synthetic meshes
+
+Renders the three front views that search uses (no rotations, front only) of an
+ellipsoid tessellated into a given number of faces.
+
+    $ python benchmarks/bench_rasterizer.py --faces 1000 100000 1000000 --resolution 256 1024
+"""
+import argparse
+import sys
+import timeit
+from os.path import abspath, dirname, join
+
+import numpy as np
+
+sys.path.append(join(dirname(dirname(abspath(__file__))), 'match3d'))
+from rasterizer import render_views
+
+
+def ellipsoid(n_faces, radii=(3., 2., 1.)):
+    """Tessellated ellipsoid with roughly n_faces triangles"""
+    n_lat = max(2, int(np.sqrt(n_faces / 4.)))
+    n_lon = max(3, n_faces // (2 * n_lat))
+    theta, phi = np.meshgrid(np.linspace(0, np.pi, n_lat + 1), np.linspace(0, 2 * np.pi, n_lon + 1), indexing='ij')
+    points = np.stack([np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi), np.cos(theta)], axis=-1) * radii
+    a, b, c, d = points[:-1, :-1], points[1:, :-1], points[1:, 1:], points[:-1, 1:]
+    return np.concatenate([np.stack([a, b, c], axis=-2).reshape(-1, 3, 3),
+                           np.stack([a, c, d], axis=-2).reshape(-1, 3, 3)])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--faces', type=int, nargs='+', default=[1000, 100000, 1000000])
+    parser.add_argument('--resolution', type=int, nargs='+', default=[256, 1024])
+    parser.add_argument('--supersample', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    print('{:>10} {:>10} {:>14}'.format('faces', 'resolution', '3 views'))
+    for n_faces in args.faces:
+        triangles = ellipsoid(n_faces)
+        for resolution in args.resolution:
+            seconds = min(timeit.repeat(lambda: list(render_views(triangles, resolution,
+                                                                  supersample=args.supersample)),
+                                        number=1, repeat=args.repeat))
+            print('{:>10} {:>10} {:>13.4f}s'.format(len(triangles), resolution, seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Stand-in for the blender executable that renders with the numpy rasterizer
+
+Takes blender's command line as match3d runs it
+(``blender -b -P image_match_generator.py -- -d DIR -o OUT [options]``),
+ignores which script was asked for, and renders the views of
+image_match_generator.py with :py:class:`rasterizer.NumpyRenderer`, honouring
+--file-list, --report and the view options and printing the same progress
+lines. Benchmarks use it to time the blender code paths (spawning processes,
+render_driver.py, render pools) on machines without blender.
+
+:py:func:`install` puts an executable named blender, running this script, in
+a directory to prepend to PATH.
+"""
+import argparse
+import os
+import stat
+import sys
+from os import makedirs
+from os.path import abspath, dirname, exists, expanduser, join
+
+sys.path.append(join(dirname(dirname(abspath(__file__))), 'match3d'))
+from rasterizer import NumpyRenderer
+from report import read_file_list, report_progress
+from stl_reader import find_stl_files
+
+
+def install(directory, resolution=None):
+    """
+    Write a blender executable running this script into directory
+
+    :param resolution: render at this resolution, whatever the command line asks for (optional)
+    :return: directory, to put in front of PATH
+    """
+    if not exists(directory):
+        makedirs(directory)
+    path = join(directory, 'blender')
+    forced = ' --resolution {}'.format(int(resolution)) if resolution else ''
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\nexec "{}" "{}" "$@"{}\n'.format(sys.executable, abspath(__file__), forced))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return directory
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    script_args = argv[argv.index('--') + 1:] if '--' in argv else []
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-d', '--target-directory', required=True)
+    parser.add_argument('-o', '--output-directory', required=True)
+    parser.add_argument('-r', '--resolution', type=int, default=1024)
+    parser.add_argument('--no-rotations', dest='rotations', action='store_false')
+    parser.add_argument('--only-front-view', dest='front_and_back', action='store_false')
+    parser.add_argument('--no-reflections', dest='reflections', action='store_false')
+    parser.add_argument('--keep-duplicate-views', dest='dedupe', action='store_false')
+    parser.add_argument('--file-list')
+    parser.add_argument('--report')
+    args, _ = parser.parse_known_args(script_args)
+
+    output_directory = abspath(expanduser(args.output_directory))
+    if not exists(output_directory):
+        makedirs(output_directory)
+    if args.file_list:
+        stl_files = read_file_list(args.file_list)
+    else:
+        stl_files = find_stl_files(abspath(expanduser(args.target_directory)))
+
+    renderer = NumpyRenderer(resolution=args.resolution, dedupe=args.dedupe)
+    renderer.render_files(stl_files, output_directory, rotations=args.rotations,
+                          front_and_back=args.front_and_back, reflections=args.reflections,
+                          report_path=args.report, progress=report_progress)
+
+
+if __name__ == '__main__':
+    main()
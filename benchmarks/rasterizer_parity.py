@@ -0,0 +1,70 @@
+"""Compare numpy rasterizer views with blender renders of the same models
+
+Renders every STL file below a directory with image_match_generator.py in
+blender and with the numpy rasterizer, then reports the image_match signature
+distance between matching views. Exits with status 1 if any view is further
+apart than --max-distance, so it can gate changes to either renderer.
+
+Needs blender on the PATH and image_match installed.
+
+    $ python benchmarks/rasterizer_parity.py ~/stl_set_a/ --resolution 256
+"""
+import argparse
+import sys
+import tempfile
+from os import listdir, spawnvp, P_WAIT
+from os.path import abspath, dirname, join, expanduser
+from shutil import rmtree
+
+from image_match.goldberg import ImageSignature
+
+MATCH3D = join(dirname(dirname(abspath(__file__))), 'match3d')
+sys.path.append(MATCH3D)
+from rasterizer import NumpyRenderer
+
+
+def render_with_blender(stl_directory, output_directory, resolution):
+    spawnvp(P_WAIT, 'blender', ['blender', '-b', '-P', join(MATCH3D, 'image_match_generator.py'), '--',
+                                '-d', stl_directory, '-o', output_directory,
+                                '--resolution', str(resolution),
+                                '--no-rotations', '--only-front-view', '--no-reflections'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('stl_directory')
+    parser.add_argument('--resolution', type=int, default=256)
+    parser.add_argument('--max-distance', type=float, default=0.3)
+    args = parser.parse_args(argv)
+    stl_directory = abspath(expanduser(args.stl_directory))
+
+    blender_directory = tempfile.mkdtemp()
+    numpy_directory = tempfile.mkdtemp()
+    try:
+        render_with_blender(stl_directory, blender_directory, args.resolution)
+        NumpyRenderer(resolution=args.resolution).render(stl_directory, numpy_directory)
+
+        gis = ImageSignature()
+        distances = []
+        for filename in sorted(listdir(blender_directory)):
+            if not filename.endswith('.png'):
+                continue
+            blender_signature = gis.generate_signature(join(blender_directory, filename))
+            numpy_signature = gis.generate_signature(join(numpy_directory, filename))
+            distance = gis.normalized_distance(blender_signature, numpy_signature)
+            distances.append(distance)
+            print('{:<50} {:.4f}'.format(filename, distance))
+    finally:
+        rmtree(blender_directory)
+        rmtree(numpy_directory)
+
+    if not distances:
+        print('no views rendered')
+        return 1
+    print('{} views, mean distance {:.4f}, max {:.4f}'.format(len(distances), sum(distances) / len(distances),
+                                                            max(distances)))
+    return 1 if max(distances) > args.max_distance else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
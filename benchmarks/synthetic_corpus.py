@@ -0,0 +1,202 @@
+"""Generate a corpus of synthetic STL files to benchmark and evaluate match3d with
+
+Every design is a parametric primitive (box, ellipsoid, cylinder, cone, torus)
+with random proportions, tessellated into about --faces triangles. Each one
+gets --variants perturbed copies: rescaled, rotated and smoothly deformed, so
+they are near duplicates of it without being the same mesh. Designs are
+written one per directory (the renderers name images after the directory), as
+binary STL, along with manifest.csv listing stl_id, path and family (the
+design a variant was made from) for APIOperations.add_many and evaluations.
+
+    $ python benchmarks/synthetic_corpus.py ~/synthetic --designs 4 --variants 3 --faces 1000 100000
+"""
+import argparse
+import csv
+import sys
+from os import makedirs
+from os.path import abspath, dirname, exists, expanduser, join
+
+import numpy as np
+
+sys.path.append(join(dirname(dirname(abspath(__file__))), 'match3d'))
+from stl_reader import BINARY_FACE, BINARY_HEADER_SIZE
+
+MANIFEST_FILENAME = 'manifest.csv'
+
+
+def _surface(points):
+    """Triangulate a grid of points of shape (n_u + 1, n_v + 1, 3)"""
+    a, b, c, d = points[:-1, :-1], points[1:, :-1], points[1:, 1:], points[:-1, 1:]
+    return np.concatenate([np.stack([a, b, c], axis=-2).reshape(-1, 3, 3),
+                           np.stack([a, c, d], axis=-2).reshape(-1, 3, 3)])
+
+
+def _grid(n_faces, aspect=1.0):
+    # grid dimensions giving about n_faces triangles, n_v / n_u about aspect
+    n_u = max(2, int(np.sqrt(n_faces / (2. * aspect))))
+    n_v = max(3, n_faces // (2 * n_u))
+    return np.meshgrid(np.linspace(0, 1, n_u + 1), np.linspace(0, 1, n_v + 1), indexing='ij')
+
+
+def ellipsoid(n_faces, radii=(3., 2., 1.)):
+    u, v = _grid(n_faces, aspect=2.0)
+    theta, phi = np.pi * u, 2 * np.pi * v
+    points = np.stack([np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi), np.cos(theta)], axis=-1)
+    return _surface(points * radii)
+
+
+def torus(n_faces, major=3., minor=1.):
+    u, v = _grid(n_faces, aspect=3.0)
+    theta, phi = 2 * np.pi * u, 2 * np.pi * v
+    ring = major + minor * np.cos(theta)
+    return _surface(np.stack([ring * np.cos(phi), ring * np.sin(phi), minor * np.sin(theta)], axis=-1))
+
+
+def _solid_of_revolution(n_faces, radius_top, radius_bottom, height):
+    # side, bottom cap and top cap, with faces shared out by area
+    u, v = _grid(n_faces * 2 // 3, aspect=4.0)
+    phi = 2 * np.pi * v
+    radius = radius_bottom + (radius_top - radius_bottom) * u
+    side = _surface(np.stack([radius * np.cos(phi), radius * np.sin(phi), height * (u - 0.5)], axis=-1))
+    caps = []
+    for r, z, flip in ((radius_bottom, -0.5 * height, True), (radius_top, 0.5 * height, False)):
+        if r <= 0:
+            continue
+        u, v = _grid(n_faces // 6, aspect=4.0)
+        phi = 2 * np.pi * v
+        cap = _surface(np.stack([r * u * np.cos(phi), r * u * np.sin(phi), np.full_like(u, z)], axis=-1))
+        caps.append(cap[:, ::-1] if flip else cap)
+    return np.concatenate([side] + caps)
+
+
+def cylinder(n_faces, radius=1., height=4.):
+    return _solid_of_revolution(n_faces, radius, radius, height)
+
+
+def cone(n_faces, radius=1.5, height=4.):
+    return _solid_of_revolution(n_faces, 0., radius, height)
+
+
+def box(n_faces, size=(3., 2., 1.)):
+    faces = []
+    u, v = _grid(max(2, n_faces // 6))
+    u, v = u - 0.5, v - 0.5
+    half = np.full_like(u, 0.5)
+    for axis in range(3):
+        for sign in (-1, 1):
+            coordinates = [None, None, None]
+            coordinates[axis] = sign * half
+            coordinates[(axis + 1) % 3], coordinates[(axis + 2) % 3] = (u, v) if sign > 0 else (v, u)
+            faces.append(_surface(np.stack(coordinates, axis=-1) * size))
+    return np.concatenate(faces)
+
+
+PRIMITIVES = {'box': box, 'ellipsoid': ellipsoid, 'cylinder': cylinder, 'cone': cone, 'torus': torus}
+
+
+def random_primitive(name, n_faces, rng):
+    """A primitive with random proportions"""
+    if name == 'box':
+        return box(n_faces, size=rng.uniform(0.5, 4, 3))
+    if name == 'ellipsoid':
+        return ellipsoid(n_faces, radii=rng.uniform(0.5, 4, 3))
+    if name == 'torus':
+        major = rng.uniform(1.5, 4)
+        return torus(n_faces, major=major, minor=rng.uniform(0.2, 0.8) * major)
+    radius, height = rng.uniform(0.5, 2), rng.uniform(1, 6)
+    return PRIMITIVES[name](n_faces, radius, height)
+
+
+def perturb(triangles, rng, scale=0.1, deformation=0.05):
+    """
+    A near duplicate of a mesh: rescaled, rotated and smoothly deformed
+
+    The deformation is a smooth function of position, so vertices shared by several faces move together
+    and closed meshes stay closed.
+
+    :param scale: largest relative change of each dimension
+    :param deformation: amplitude of the deformation, relative to the size of the mesh
+    """
+    vertices = triangles.reshape(-1, 3).astype(np.float64)
+    size = np.abs(vertices).max()
+    frequencies = rng.normal(size=(3, 3)) / size
+    phases = rng.uniform(0, 2 * np.pi, 3)
+    vertices = vertices + deformation * size * np.sin(vertices.dot(frequencies) + phases)
+    vertices *= 1 + rng.uniform(-scale, scale, 3)
+    rotation, _ = np.linalg.qr(rng.normal(size=(3, 3)))
+    return vertices.dot(rotation.T).reshape(-1, 3, 3)
+
+
+def write_binary_stl(path, triangles, name='synthetic'):
+    """Write triangles of shape (n, 3, 3) as a binary STL file"""
+    triangles = np.asarray(triangles, dtype=np.float32)
+    records = np.zeros(len(triangles), dtype=BINARY_FACE)
+    normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    lengths = np.linalg.norm(normals, axis=1)[:, np.newaxis]
+    records['normal'] = np.where(lengths > 0, normals / np.where(lengths > 0, lengths, 1), 0)
+    records['vertices'] = triangles
+    with open(path, 'wb') as f:
+        f.write(name.encode('ascii')[:BINARY_HEADER_SIZE].ljust(BINARY_HEADER_SIZE, b' '))
+        f.write(np.array([len(triangles)], dtype='<u4').tobytes())
+        f.write(records.tobytes())
+
+
+def generate_corpus(directory, designs=2, variants=3, faces=(1000,), primitives=None, seed=0):
+    """
+    Write a synthetic corpus
+
+    :param directory: where to write it
+    :param designs: designs of every primitive and size
+    :param variants: perturbed copies of every design
+    :param faces: sizes of the meshes, in faces
+    :param primitives: names of the PRIMITIVES to use (default: all)
+    :param seed: seed of the random proportions and perturbations
+    :return: list of dicts with the stl_id, path, family and faces of every design, as in the manifest
+    """
+    directory = abspath(expanduser(directory))
+    rng = np.random.RandomState(seed)
+    corpus = []
+    for name in sorted(primitives or PRIMITIVES):
+        for n_faces in faces:
+            for i in range(designs):
+                family = '{}_{}_{}'.format(name, n_faces, i)
+                triangles = random_primitive(name, n_faces, rng)
+                models = [(family, triangles)]
+                models += [('{}_v{}'.format(family, j), perturb(triangles, rng)) for j in range(variants)]
+                for stl_id, model in models:
+                    path = join(directory, stl_id, 'model.stl')
+                    if not exists(dirname(path)):
+                        makedirs(dirname(path))
+                    write_binary_stl(path, model, name=stl_id)
+                    corpus.append({'stl_id': stl_id, 'path': path, 'family': family, 'faces': len(model)})
+
+    with open(join(directory, MANIFEST_FILENAME), 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=['stl_id', 'path', 'family', 'faces'])
+        writer.writeheader()
+        writer.writerows(corpus)
+    return corpus
+
+
+def read_corpus(directory):
+    """The designs of a corpus written by generate_corpus, from its manifest"""
+    with open(join(abspath(expanduser(directory)), MANIFEST_FILENAME)) as f:
+        return [dict(row, faces=int(row['faces'])) for row in csv.DictReader(f)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('directory')
+    parser.add_argument('--designs', type=int, default=2, help='designs of every primitive and size')
+    parser.add_argument('--variants', type=int, default=3, help='perturbed copies of every design')
+    parser.add_argument('--faces', type=int, nargs='+', default=[1000], help='mesh sizes, e.g. 1000 5000000')
+    parser.add_argument('--primitives', nargs='+', choices=sorted(PRIMITIVES))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    corpus = generate_corpus(args.directory, designs=args.designs, variants=args.variants, faces=args.faces,
+                             primitives=args.primitives, seed=args.seed)
+    print('{} designs written to {}'.format(len(corpus), abspath(expanduser(args.directory))))
+
+
+if __name__ == '__main__':
+    main()
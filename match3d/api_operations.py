@@ -1,27 +1,96 @@
 from three_d_match import ThreeDSearch
+from caching import LRUCache, file_digest
+from descriptors import shape_descriptors, descriptor_distance
+from download import Downloader
+from report import REPORT_FILENAME, read_report
+from render_pool import RenderError
+from timing import Timings
 from shutil import copy
-from elasticsearch.helpers import bulk, scan
-from os.path import join, abspath, expanduser
-from os import listdir, remove, environ
-from image_match.signature_database_base import make_record
+from elasticsearch.exceptions import TransportError
+from elasticsearch.helpers import streaming_bulk, scan
+from os.path import join, abspath, basename, dirname, exists, getsize, splitext
+from os import listdir, remove, environ, mkdir
+from operator import itemgetter
+from itertools import islice
+import csv
+import heapq
+import json
 import tempfile
+import time
 from shutil import rmtree
-import requests
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+# tiers of a progressive search, cheapest first: the resolution (None for the renderer's default) and
+# image_match_generator view options of each
+PROGRESSIVE_TIERS = ({'name': 'coarse', 'resolution': 128},
+                     {'name': 'fine'},
+                     {'name': 'all_views', 'rotations': True, 'front_and_back': True, 'reflections': True})
 
 
 class APIOperations(ThreeDSearch):
     def __init__(self, es_nodes=environ.get('ES_HOSTS', 'localhost'),
                  index_name='match3d',
-                 cutoff=0.5):
+                 cutoff=0.5,
+                 render_pool=None,
+                 render_backend='blender',
+                 stl_id_cache_size=100000,
+                 batch_search=False,
+                 processes=None,
+                 render_cache=None,
+                 downloader=None,
+                 signature_database=None,
+                 blender_processes=1,
+                 result_cache=None,
+                 timing_hook=None,
+                 progressive_tiers=PROGRESSIVE_TIERS,
+                 decisive_fraction=0.5,
+                 min_separation=0.1,
+                 escalate_no_match=False):
 
         self.index_name = index_name
 
+        # progressive searches stop at the first tier whose best design is within decisive_fraction of the
+        # cutoff, or at least min_separation closer than the next best. A tier finding nothing within the
+        # cutoff ends the search too, unless escalate_no_match: most queries match nothing, and finer tiers
+        # would rarely change that at several times the cost
+        self.progressive_tiers = progressive_tiers
+        self.decisive_fraction = decisive_fraction
+        self.min_separation = min_separation
+        self.escalate_no_match = escalate_no_match
+
+        # optional caching.ResultCache: repeated searches for the same model skip rendering and querying
+        self.result_cache = result_cache
+
+        # one small document per design: stl_id, number of views indexed and where it came from
+        self.catalog_index = index_name + '_designs'
+        self._index_ready = False
+        self._es_version = None
+
+        # fetches stl_urls: pooled connections, size and time limits, hashing while streaming
+        self.downloader = downloader or Downloader()
+
+        # image document id -> stl_id, for images that don't carry their stl_id in the search hits
+        self.stl_id_cache = LRUCache(stl_id_cache_size)
+
         # the parent class provides the methods for rendering in blender
         super(APIOperations, self).__init__(es_nodes=es_nodes,
                                             index_name=index_name,
-                                            cutoff=cutoff)
+                                            cutoff=cutoff,
+                                            render_pool=render_pool,
+                                            render_backend=render_backend,
+                                            batch_search=batch_search,
+                                            processes=processes,
+                                            render_cache=render_cache,
+                                            signature_database=signature_database,
+                                            blender_processes=blender_processes,
+                                            timing_hook=timing_hook)
 
-    def add(self, stl_id, stl_url=None, stl_file=None, doc_type='image'):
+    def add(self, stl_id, stl_url=None, stl_file=None, doc_type='image',
+            chunk_size=500, max_retries=3, initial_backoff=2):
         """
         Add an STL design to an elasticsearch database for matching
 
@@ -29,129 +98,718 @@ class APIOperations(ThreeDSearch):
         :param stl_url: the PUBLIC url pointing to the STL file (optional)
         :param stl_file: path to an STL file. ignored if stl_url is provided, but one must be given (optional)
         :param doc_type: specify the doc_type for elasticsearch renders. You shouldn't need to change this
+        :param chunk_size: number of images per bulk request
+        :param max_retries: times to retry images rejected with 429 (too many requests)
+        :param initial_backoff: seconds to wait before the first retry, doubled for every following one
+        :return: dict with the number of images indexed and the errors of any that failed
         """
 
         # set up temporary directories
         input_directory = tempfile.mkdtemp()
         output_directory = tempfile.mkdtemp()
         temporary_stl = tempfile.mkstemp(suffix='.stl')[-1]
+        timings = Timings(self.timing_hook)
 
-        # TODO: many of these functions should be parallelized
         try:
             # if a url is supplied, attempt to download the STL
+            stl_digest = None
             if stl_url:
-                r = requests.get(stl_url)
-                with open(temporary_stl, 'wb') as f:
-                    f.write(r.content)
+                with timings.stage('download') as info:
+                    stl_digest, info['bytes'] = self.downloader.fetch(stl_url, temporary_stl)
                 stl_file = temporary_stl
 
+            # fail early on a broken model, before paying for blender
+            with timings.stage('load_stl', bytes=getsize(stl_file)) as info:
+                mesh = self.check_stl(stl_file)
+                info['faces'] = len(mesh)
+            with timings.stage('descriptors', faces=len(mesh)):
+                descriptors = shape_descriptors(mesh)
+
             # copy the supplied stl file or requested data to a temp dir
             copy(stl_file, input_directory)
 
             # TODO remove, as it seems to be unused
             path = join(input_directory, stl_file)
 
-            # set up and run the rendering process. fork and wait for completion
-            blender_args = ['blender',
-                            '-b', '-P', 'image_match_generator.py', '--',
-                            '-d', abspath(expanduser(input_directory)),
-                            '-o', output_directory,
-                            ]
+            # render every view of the model, in the render pool if there is one
+            self.generate_images(input_directory,
+                                 output_directory=output_directory,
+                                 rotations=True,
+                                 front_and_back=True,
+                                 reflections=True,
+                                 stl_digest=stl_digest,
+                                 timings=timings)
+
+            # add image signatures to elasticsearch, ignoring the .csv report generated by the renderer
+            images = [(stl_id, join(output_directory, image_path))
+                      for image_path in listdir(output_directory) if image_path.split('.')[-1] != 'csv']
+            result = self._timed_index_images(timings, images, doc_type=doc_type, chunk_size=chunk_size,
+                                              max_retries=max_retries, initial_backoff=initial_backoff)
+            if result['indexed'] and not result['errors']:
+                with timings.stage('catalog', designs=1):
+                    result['errors'].extend(self._index_designs([stl_id], images, {stl_id: stl_url or stl_file},
+                                                                {stl_id: descriptors}))
+            self._invalidate_results()
+            return result
+
+        finally:
+            # clean up temporary locations
+            rmtree(input_directory)
+            rmtree(output_directory)
+            remove(temporary_stl)
+
+    def _timed_index_images(self, timings, images, **index_options):
+        # signatures are computed while earlier chunks are indexed, so they are a single stage
+        with timings.stage('index', images=len(images)) as info:
+            result = self.index_images(images, **index_options)
+            info['errors'] = len(result['errors'])
+        return result
+
+    def index_images(self, images, doc_type='image', chunk_size=500, max_retries=3, initial_backoff=2):
+        """
+        Compute the signatures of rendered images and stream them into elasticsearch
+
+        Signatures are computed in the signature process pool while earlier chunks are being indexed.
+
+        :param images: list of (stl_id, image path) pairs
+        :param doc_type: specify the doc_type for elasticsearch renders
+        :param chunk_size: number of images per bulk request
+        :param max_retries: times to retry images rejected with 429 (too many requests)
+        :param initial_backoff: seconds to wait before the first retry, doubled for every following one
+        :return: dict with the number of images indexed and the errors of any that failed
+        """
+        self.create_index(doc_type)
+        result = {'indexed': 0, 'errors': []}
+        for ok, item in self._bulk(self._index_actions(images, doc_type), chunk_size=chunk_size,
+                                   max_retries=max_retries, initial_backoff=initial_backoff):
+            if ok:
+                result['indexed'] += 1
+            else:
+                result['errors'].append(item)
+        return result
+
+    def _bulk(self, actions, chunk_size=500, max_retries=3, initial_backoff=2):
+        """
+        Index actions with streaming_bulk, a chunk at a time, re-sending those rejected with 429
+
+        elasticsearch-py only retries rejections itself from 5.0 on, and image_match needs 2.3.
+
+        :param actions: bulk actions, each with an _id
+        :param chunk_size: number of actions per bulk request
+        :param max_retries: times to re-send actions rejected with 429 (too many requests)
+        :param initial_backoff: seconds to wait before the first retry, doubled for every following one
+        :return: iterator of (ok, item) pairs, like streaming_bulk
+        """
+        actions = iter(actions)
+        while True:
+            chunk = list(islice(actions, chunk_size))
+            if not chunk:
+                return
+            for attempt in range(max_retries + 1):
+                rejected = []
+                # results come back in the order of the actions; copies, as older clients pop keys off them
+                for action, (ok, item) in zip(chunk, streaming_bulk(self.es, [dict(action) for action in chunk],
+                                                                    chunk_size=len(chunk),
+                                                                    raise_on_error=False,
+                                                                    raise_on_exception=False)):
+                    if not ok and attempt < max_retries and list(item.values())[0].get('status') == 429:
+                        rejected.append(action)
+                    else:
+                        yield ok, item
+                if not rejected:
+                    break
+                time.sleep(initial_backoff * 2 ** attempt)
+                chunk = rejected
+
+    def add_many(self, items, shard_size=50, checkpoint=None, doc_type='image',
+                 chunk_size=500, max_retries=3, initial_backoff=2):
+        """
+        Add many STL designs, rendering a shard of them per blender run
+
+        :param items: list of (stl_id, path or url) pairs, or the path of a CSV manifest with those two columns
+        :param shard_size: number of designs rendered by one blender run
+        :param checkpoint: path of a file listing the stl_ids already added (optional). They are skipped, and
+            every finished shard is appended, so an interrupted load resumes where it stopped. Its first line
+            records the index, cutoff, doc_type and render settings, and a checkpoint written with others is
+            refused, rather than skipping designs that were never added under these
+        :param doc_type: specify the doc_type for elasticsearch renders. You shouldn't need to change this
+        :param chunk_size: number of images per bulk request
+        :param max_retries: times to retry images rejected with 429 (too many requests)
+        :param initial_backoff: seconds to wait before the first retry, doubled for every following one
+        :return: dict with the numbers of designs and images indexed, and errors for designs or images that failed
+        """
+        if isinstance(items, string_types):
+            items = self.read_manifest(items)
+
+        done = set()
+        if checkpoint:
+            done = self._read_checkpoint(checkpoint, self._checkpoint_config(doc_type))
+        pending = [(stl_id, source) for stl_id, source in items if stl_id not in done]
+
+        result = {'designs': 0, 'indexed': 0, 'errors': []}
+        for start in range(0, len(pending), shard_size):
+            added, indexed, errors = self._add_shard(pending[start:start + shard_size], doc_type=doc_type,
+                                                     chunk_size=chunk_size, max_retries=max_retries,
+                                                     initial_backoff=initial_backoff)
+            result['designs'] += len(added)
+            result['indexed'] += indexed
+            result['errors'].extend(errors)
+            if checkpoint:
+                with open(checkpoint, 'a') as f:
+                    f.writelines(stl_id + '\n' for stl_id in added)
+            if indexed:
+                self._invalidate_results()
+        return result
+
+    def _checkpoint_config(self, doc_type):
+        # what the designs in an add_many checkpoint were added with
+        backend = self.render_backend
+        return {'index': self.index_name,
+                'cutoff': self.ses.distance_cutoff,
+                'doc_type': doc_type,
+                'render_backend': backend if isinstance(backend, str) else type(backend).__name__,
+                'render': self._render_settings(backend)}
+
+    @staticmethod
+    def _read_checkpoint(checkpoint, config):
+        # the stl_ids an add_many checkpoint lists, writing its config line first if it is new
+        if not exists(checkpoint) or not getsize(checkpoint):
+            with open(checkpoint, 'w') as f:
+                f.write(json.dumps({'config': config}, sort_keys=True) + '\n')
+            return set()
+        with open(checkpoint) as f:
+            lines = [line.rstrip('\n') for line in f]
+        try:
+            written = json.loads(lines[0])['config']
+        except (ValueError, KeyError, TypeError):
+            raise ValueError('{} is not an add_many checkpoint: its first line has no config'.format(checkpoint))
+        # compared as JSON, so tuples and lists are alike
+        if written != json.loads(json.dumps(config)):
+            raise ValueError('{} was written with {}, not {}'.format(checkpoint, written, config))
+        return set(line for line in lines[1:] if line)
+
+    def _invalidate_results(self):
+        # make the new documents searchable before anyone caches a search that should find them
+        if not self.result_cache:
+            return
+        if self.es is not None:
+            self.es.indices.refresh(index=','.join(sorted(set([self.index_name, self.catalog_index]))),
+                                    ignore_unavailable=True)
+        self.result_cache.invalidate(self.index_name)
+
+    @staticmethod
+    def read_manifest(manifest):
+        """
+        Read (stl_id, path or url) pairs from a CSV file, skipping a header row if there is one
+
+        :param manifest: path of the CSV file
+        """
+        with open(manifest) as f:
+            rows = [row for row in csv.reader(f) if row]
+        if rows and rows[0][0] == 'stl_id':
+            rows = rows[1:]
+        return [(row[0], row[1]) for row in rows]
 
-            self.generate_images(input_directory, blender_args=blender_args)
+    @staticmethod
+    def _discard(path):
+        # remove a staged file that may or may not have been written
+        if exists(path):
+            remove(path)
 
-            to_insert = []
+    def _add_shard(self, shard, **index_options):
+        # stage every design in a directory of its own, render them all in one go, and use the
+        # report to tell which design each image belongs to
+        input_directory = tempfile.mkdtemp()
+        output_directory = tempfile.mkdtemp()
+        timings = Timings(self.timing_hook)
+        try:
+            staged = {}
+            errors = []
+            downloads = []
+            for i, (stl_id, source) in enumerate(shard):
+                stl_file = join(input_directory, str(i), 'model.stl')
+                mkdir(dirname(stl_file))
+                if source.startswith('http://') or source.startswith('https://'):
+                    downloads.append((stl_id, source, stl_file))
+                    continue
+                try:
+                    copy(source, stl_file)
+                except (IOError, OSError) as e:
+                    errors.append({'stl_id': stl_id, 'error': repr(e)})
+                    self._discard(stl_file)
+                    continue
+                staged[abspath(stl_file)] = stl_id
 
-            # add image signatures to elasticsearch
-            for image_path in listdir(output_directory):
-                # ignore the .csv report generated by the renderer
-                if image_path.split('.')[-1] != 'csv':
-                    rec = make_record(join(output_directory, image_path),
-                                      self.ses.gis,
-                                      self.ses.k,
-                                      self.ses.N)
+            # fetch the whole shard's downloads at once
+            fetched = []
+            if downloads:
+                with timings.stage('download', designs=len(downloads)) as info:
+                    fetched = self.downloader.prefetch([(url, stl_file) for _, url, stl_file in downloads])
+                    info['bytes'] = sum(outcome[1] for outcome in fetched if not isinstance(outcome, Exception))
+            for (stl_id, _, stl_file), outcome in zip(downloads, fetched):
+                if isinstance(outcome, Exception):
+                    # failed downloads stop part way through (too large, too slow), and mustn't be rendered
+                    errors.append({'stl_id': stl_id, 'error': repr(outcome)})
+                    self._discard(stl_file)
+                else:
+                    staged[abspath(stl_file)] = stl_id
 
-                    rec['stl_id'] = stl_id
+            descriptors = {}
+            with timings.stage('descriptors', designs=len(staged), faces=0) as info:
+                for stl_file, stl_id in list(staged.items()):
+                    try:
+                        mesh = self.check_stl(stl_file)
+                        info['faces'] += len(mesh)
+                        descriptors[stl_id] = shape_descriptors(mesh)
+                    except (IOError, OSError, ValueError) as e:
+                        errors.append({'stl_id': stl_id, 'error': repr(e)})
+                        del staged[stl_file]
+                        remove(stl_file)
 
-                    to_insert.append({
-                        '_index': self.ses.index,
-                        '_type': doc_type,
-                        '_source': rec
-                    })
+            if not staged:
+                return [], 0, errors
 
-            _, errs = bulk(self.es, to_insert)
+            try:
+                self.generate_images(input_directory,
+                                     output_directory=output_directory,
+                                     rotations=True,
+                                     front_and_back=True,
+                                     reflections=True,
+                                     timings=timings)
+            except RenderError as e:
+                # nothing in the shard rendered
+                failed = dict(getattr(e, 'failed', []))
+                errors.extend({'stl_id': stl_id, 'error': failed.get(stl_file, str(e))}
+                              for stl_file, stl_id in staged.items())
+                return [], 0, errors
 
+            images = [(staged[row['stl_filename']], row['image_filename'])
+                      for row in read_report(join(output_directory, REPORT_FILENAME))
+                      if row['stl_filename'] in staged and not row.get('canonical_id')]
+            result = self._timed_index_images(timings, images, **index_options)
+
+            # a design only counts as added if every one of its images made it
+            failed = set(error[list(error)[0]].get('_id') for error in result['errors'])
+            rendered = set(stl_id for stl_id, _ in images)
+            if None in failed:
+                # errors without a document id (e.g. connection failures) could be anyone's
+                incomplete = rendered
+            else:
+                incomplete = set(stl_id for stl_id, image_path in images
+                                 if self._image_id(stl_id, image_path) in failed)
+            for stl_id in set(staged.values()) - rendered:
+                errors.append({'stl_id': stl_id, 'error': 'no images rendered'})
+            errors.extend(result['errors'])
+            added = sorted(rendered - incomplete)
+            with timings.stage('catalog', designs=len(added)):
+                catalog_errors = self._index_designs(added, images, dict(shard), descriptors)
+            # nor without its catalog document, which listing and shape ranking read
+            if catalog_errors:
+                failed = set(error[list(error)[0]].get('_id') for error in catalog_errors)
+                added = [] if None in failed else [stl_id for stl_id in added if stl_id not in failed]
+                errors.extend(catalog_errors)
+            return added, result['indexed'], errors
         finally:
-            # clean up temporary locations
             rmtree(input_directory)
             rmtree(output_directory)
-            remove(temporary_stl)
 
-    def search(self, stl_url=None, stl_file=None, return_raw=False, ranking='single'):
+    def _index_designs(self, stl_ids, images, sources, descriptors):
+        # write the catalog documents of designs whose images are indexed; returns the bulk errors
+        views = dict((stl_id, 0) for stl_id in stl_ids)
+        for stl_id, _ in images:
+            if stl_id in views:
+                views[stl_id] += 1
+        actions = [{'_index': self.catalog_index,
+                    '_type': 'design',
+                    '_id': stl_id,
+                    '_source': self._design_document(stl_id, views[stl_id], sources.get(stl_id),
+                                                     descriptors.get(stl_id))}
+                   for stl_id in stl_ids]
+        return [item for ok, item in self._bulk(actions) if not ok]
+
+    @staticmethod
+    def _design_document(stl_id, views, source, descriptors=None):
+        return {'stl_id': stl_id, 'views': views, 'source': source, 'descriptors': descriptors}
+
+    def create_index(self, doc_type='image'):
+        """
+        Create the image index and the design catalog, mapping stl_id as an exact-match keyword
+
+        Does nothing for indexes that exist already. With the keyword mapping, designs can be listed and
+        counted with aggregations instead of reading every image document.
+        """
+        if self._index_ready:
+            return
+        keyword = self._keyword_mapping()
+        for index, index_doc_type in ((self.index_name, doc_type), (self.catalog_index, 'design')):
+            body = {'mappings': {index_doc_type: {'properties': {'stl_id': keyword}}}}
+            if index_doc_type == 'design':
+                body['mappings']['design']['properties'].update({
+                    'source': keyword,
+                    # only ever read back, never searched
+                    'descriptors': {'type': 'object', 'enabled': False}})
+            self.es.indices.create(index=index, body=body, ignore=400)
+        self._index_ready = True
+
+    def _keyword_mapping(self):
+        # exact-match string field: keyword since elasticsearch 5, not_analyzed string before
+        if self.es_version() >= (5, 0):
+            return {'type': 'keyword'}
+        return {'type': 'string', 'index': 'not_analyzed'}
+
+    def es_version(self):
+        """The elasticsearch version, as a tuple of ints"""
+        if self._es_version is None:
+            number = self.es.info()['version']['number']
+            self._es_version = tuple(int(part) for part in number.split('-')[0].split('.'))
+        return self._es_version
+
+    @staticmethod
+    def _image_id(stl_id, image_path):
+        # stl_id plus the view part of the image name (dropping the hash of the STL path), so
+        # adding the same design again overwrites its images instead of duplicating them
+        view = splitext(basename(image_path))[0].split('.', 1)[-1]
+        return '{}.{}'.format(stl_id, view)
+
+    def _index_actions(self, images, doc_type):
+        records = self.iter_records([image_path for _, image_path in images])
+        for i, rec in enumerate(records):
+            stl_id, image_path = images[i]
+            rec['stl_id'] = stl_id
+            # returned with search hits, so searches needn't look the stl_id up
+            rec['metadata'] = {'stl_id': stl_id}
+            yield {
+                '_index': self.ses.index,
+                '_type': doc_type,
+                '_id': self._image_id(stl_id, image_path),
+                '_source': rec
+            }
+
+    def search(self, stl_url=None, stl_file=None, return_raw=False, ranking='single', render_backend=None,
+               prefilter=None, shape_weight=0.0, timings=False, progressive=False):
         """
         Search by STL file for similar designs
         :param stl_url: the PUBLIC url pointing to the STL file (optional)
         :param stl_file: path to an STL file. ignored if stl_id is provided, but you must provide one of the two (optional)
         :param return_raw: if True, return raw scores per image instead of a composite score (default False)
-        :param ranking: ranking system to use. No need to changes this
-        :return: list of matches, or None
+        :param ranking: ranking system to use. No need to changes this. 'shape' ranks by the shape descriptors
+            alone, without rendering anything
+        :param render_backend: 'blender' or 'numpy' to override the render backend for this search (optional)
+        :param prefilter: only search the images of this many designs with the closest shape descriptors (optional)
+        :param shape_weight: weight of the shape descriptor distance in the score, from 0 (images only) to 1
+        :param timings: True to add the time taken by every stage to the result, under 'timings' (see
+            timing.Timings.summary), or a timing.Timings to record them in. Raw results only support the latter
+        :param progressive: search with the progressive_tiers in turn, starting with a few low resolution views,
+            until one finds a decisive best match, or no match at all (see escalate_no_match). The name of the tier that answered is added to the result,
+            under 'tier' ('cache' for cached results)
+        :return: list of matches, or None. With a result_cache, repeated searches for the same model
+            with the same options are answered from the cache until designs are added
         """
+        timer = timings if isinstance(timings, Timings) else Timings(self.timing_hook)
+        result = self._search(timer, stl_url, stl_file, return_raw, ranking, render_backend, prefilter, shape_weight,
+                              progressive)
+        if timings is True and isinstance(result, dict):
+            result['timings'] = timer.summary()
+        return result
 
+    def _search(self, timings, stl_url, stl_file, return_raw, ranking, render_backend, prefilter, shape_weight,
+                progressive):
         # add index names if necessary (this is a hack, should really be in image_search)
-        if 'index_names' not in self.ses.__dict__:
-            example_res = self.es.search(index=self.index_name, size=1)
+        if self.es is not None and 'index_names' not in self.ses.__dict__:
+            example_res = self.es.search(index=self.index_name, doc_type='image', size=1)
             if example_res['hits']['total'] > 0:
                 self.ses.index_names = [field for field in example_res['hits']['hits'][0]['_source'].keys() if field.find('simple') > -1]
 
+        key = stl_url or stl_file
+        tier = None
+        input_directory = tempfile.mkdtemp()
+        temporary_stl = tempfile.mkstemp(suffix='.stl')[-1]
+        images_directory = None
         try:
-            input_directory = tempfile.mkdtemp()
-            temporary_stl = tempfile.mkstemp(suffix='.stl')[-1]
 
             # if a url is supplied, attempt to download the STL
+            stl_digest = None
             if stl_url:
-                r = requests.get(stl_url)
-                with open(temporary_stl, 'wb') as f:
-                    f.write(r.content)
+                with timings.stage('download') as info:
+                    stl_digest, info['bytes'] = self.downloader.fetch(stl_url, temporary_stl)
                 stl_file = temporary_stl
 
+            cache_key = generation = None
+            if self.result_cache:
+                with timings.stage('result_cache') as info:
+                    # the generation before searching: a result found while designs are added is never reused
+                    generation = self.result_cache.generation(self.index_name)
+                    backend = render_backend or self.render_backend
+                    # progressive results only differ from the others when asked for
+                    options = {'progressive': list(self.progressive_tiers),
+                               'escalate_no_match': self.escalate_no_match} if progressive else {}
+                    cache_key = self.result_cache.key(stl_digest or file_digest(stl_file),
+                                                      index=self.index_name,
+                                                      cutoff=self.ses.distance_cutoff,
+                                                      ranking=ranking,
+                                                      return_raw=return_raw,
+                                                      backend=backend if isinstance(backend, str) else type(backend).__name__,
+                                                      render=self._render_settings(backend),
+                                                      prefilter=prefilter,
+                                                      shape_weight=shape_weight,
+                                                      **options)
+                    cached = self.result_cache.get(cache_key, self.index_name, generation)
+                    info['hit'] = cached is not None
+                if cached is not None:
+                    if return_raw:
+                        return cached
+                    return dict({key: cached}, tier='cache') if progressive else {key: cached}
+
+            with timings.stage('load_stl', bytes=getsize(stl_file)) as info:
+                mesh = self.check_stl(stl_file)
+                info['faces'] = len(mesh)
+            descriptors = None
+            if prefilter or shape_weight or ranking == 'shape':
+                with timings.stage('descriptors', faces=len(mesh)):
+                    descriptors = shape_descriptors(mesh)
+            if ranking == 'shape':
+                with timings.stage('shape_search') as info:
+                    shape_distances = self.shape_search(descriptors, prefilter)
+                    info['designs'] = len(shape_distances)
+                return {key: self._cache_result(cache_key, generation, shape_distances)}
+
+            # narrow the image search down to the designs of roughly the right shape
+            shape_distances = None
+            search_filter = None
+            if prefilter:
+                with timings.stage('shape_search') as info:
+                    shape_distances = self.shape_search(descriptors, prefilter)
+                    info['designs'] = len(shape_distances)
+            if shape_distances:
+                search_filter = {'terms': {self._stl_id_field() or 'stl_id': list(shape_distances)}}
+
             copy(stl_file, input_directory)
-            images_directory = self.generate_images(input_directory)
-            res = self.search_images(images_directory)
+            if progressive:
+                res, scores, tier = self._progressive_search(input_directory, render_backend, stl_digest,
+                                                             search_filter, timings)
+            else:
+                images_directory = self.generate_images(input_directory, render_backend=render_backend,
+                                                        stl_digest=stl_digest, timings=timings)
+                res = self.search_images(images_directory, search_filter=search_filter, timings=timings)
         finally:
             rmtree(input_directory)
-            rmtree(images_directory)
+            remove(temporary_stl)
+            if images_directory:
+                rmtree(images_directory)
         if return_raw:
-            return res
+            return self._cache_result(cache_key, generation, res)
         elif ranking == 'single':
-            if stl_url:
-                return {stl_url: self._best_single_image(res)}
-            else:
-                return {stl_file: self._best_single_image(res)}
+            if tier is None:
+                with timings.stage('rank', hits=sum(len(hits) for hits in res)) as info:
+                    scores = self._best_single_image(res)
+                    info['designs'] = len(scores)
+            if shape_weight:
+                with timings.stage('rerank', designs=len(scores)):
+                    scores = self._rerank(scores, descriptors, shape_weight, shape_distances)
+            result = {key: self._cache_result(cache_key, generation, scores)}
+            if tier is not None:
+                result['tier'] = tier
+            return result
+
+    def _progressive_search(self, input_directory, render_backend, stl_digest, search_filter, timings):
+        # search with one tier after the other until the best match is decisive, or the tiers run out:
+        # (hits of every view, single image scores, name of the tier that answered)
+        for tier in self.progressive_tiers:
+            images_directory = self.generate_images(input_directory, render_backend=render_backend,
+                                                    stl_digest=stl_digest, timings=timings,
+                                                    resolution=tier.get('resolution'),
+                                                    rotations=tier.get('rotations', False),
+                                                    front_and_back=tier.get('front_and_back', False),
+                                                    reflections=tier.get('reflections', False))
+            try:
+                res = self.search_images(images_directory, search_filter=search_filter, timings=timings)
+            finally:
+                rmtree(images_directory)
+            with timings.stage('rank', hits=sum(len(hits) for hits in res), tier=tier['name']) as info:
+                scores = self._best_single_image(res)
+                info['designs'] = len(scores)
+                info['decisive'] = self._decisive(scores)
+            if info['decisive']:
+                break
+        return res, scores, tier['name']
+
+    def _decisive(self, scores):
+        # the best design is well within the cutoff, or well ahead of the next best (or of the cutoff).
+        # No design within the cutoff at all is decisive too, unless escalate_no_match
+        dists = sorted(scores.values())
+        if not dists:
+            return not self.escalate_no_match
+        cutoff = self.ses.distance_cutoff
+        runner_up = dists[1] if len(dists) > 1 else cutoff
+        return bool(dists[0] <= self.decisive_fraction * cutoff or runner_up - dists[0] >= self.min_separation)
+
+    def _cache_result(self, cache_key, generation, result):
+        if cache_key:
+            self.result_cache.put(cache_key, self.index_name, generation, result)
+        return result
+
+    def shape_search(self, descriptors, n=None, page_size=1000):
+        """
+        Rank the designs by how close their shape descriptors are, without looking at any images
+
+        Reads the descriptors of every design from the design catalog: one small document per design.
+        Designs added before descriptors were stored are left out.
+
+        :param descriptors: descriptors.shape_descriptors of the model searched for
+        :param n: number of designs to return (all if not given)
+        :return: dict of stl_id to descriptors.descriptor_distance
+        """
+        distances = []
+        for stl_id, design_descriptors in self._iter_descriptors(page_size):
+            distances.append((descriptor_distance(descriptors, design_descriptors), stl_id))
+        if n:
+            distances = heapq.nsmallest(n, distances)
+        return dict((stl_id, distance) for distance, stl_id in distances)
+
+    def _iter_descriptors(self, page_size=1000):
+        for hit in scan(self.es, index=self.catalog_index, doc_type='design', size=page_size,
+                        query={'_source': ['stl_id', 'descriptors']}):
+            if hit['_source'].get('descriptors'):
+                yield hit['_source']['stl_id'], hit['_source']['descriptors']
+
+    def _get_descriptors(self, stl_ids):
+        # stl_id to descriptors, of the designs that have them
+        if not stl_ids:
+            return {}
+        docs = self.es.mget(body={'ids': list(stl_ids)}, index=self.catalog_index, doc_type='design',
+                            _source=['descriptors'])['docs']
+        return dict((doc['_id'], doc['_source']['descriptors']) for doc in docs
+                    if doc.get('found') and doc['_source'].get('descriptors'))
 
-    def list_designs(self):
+    def _rerank(self, scores, descriptors, shape_weight, shape_distances=None):
+        # mix the shape distance into the image score. Designs without descriptors keep their image score
+        shape_distances = dict(shape_distances or {})
+        missing = [stl_id for stl_id in scores if stl_id not in shape_distances]
+        for stl_id, design_descriptors in self._get_descriptors(missing).items():
+            shape_distances[stl_id] = descriptor_distance(descriptors, design_descriptors)
+        return dict((stl_id, (1 - shape_weight) * score + shape_weight * shape_distances[stl_id]
+                     if stl_id in shape_distances else score)
+                    for stl_id, score in scores.items())
+
+    def list_designs(self, counts=False, catalog=False, page_size=1000):
         """
         Return a list designs in corpus
 
+        :param counts: return a dict of design id to the number of views indexed instead
+        :param catalog: read the design catalog rather than aggregating the image index. Only lists designs
+            added since the catalog was introduced
+        :param page_size: designs fetched per request
         :return: a list of all design ids
         """
-        result = {}
-        s = scan(self.es, index=self.index_name)
-        for r in s:
-            result.update({r['_source']['stl_id']: True})
+        designs = self.iter_designs(catalog=catalog, page_size=page_size)
+        if counts:
+            return dict(designs)
+        return [stl_id for stl_id, _ in designs]
+
+    def iter_designs(self, catalog=False, page_size=1000):
+        """
+        Stream the designs in the corpus, a page at a time
+
+        Designs are aggregated by stl_id: paged with a composite aggregation on elasticsearch 6.1 and
+        later, with a single terms aggregation before that. Indexes created before stl_id was mapped as a
+        keyword (and without a keyword sub-field) fall back to reading every image document.
+
+        :param catalog: read the one-per-design catalog documents instead of aggregating images
+        :param page_size: designs fetched per request
+        :return: generator of (stl_id, number of views indexed) pairs
+        """
+        if catalog:
+            for hit in scan(self.es, index=self.catalog_index, doc_type='design', size=page_size,
+                            query={'_source': ['stl_id', 'views']}):
+                yield hit['_source']['stl_id'], hit['_source']['views']
+            return
 
-        return result.keys()
+        field = self._stl_id_field()
+        if field is None:
+            views = {}
+            for hit in scan(self.es, index=self.index_name, doc_type='image', size=page_size,
+                            query={'_source': ['stl_id']}):
+                stl_id = hit['_source']['stl_id']
+                views[stl_id] = views.get(stl_id, 0) + 1
+            for design in views.items():
+                yield design
+            return
+
+        if self.es_version() < (6, 1):
+            # size 0 meant "all terms" until 5.0, which requires an actual number
+            size = 0 if self.es_version() < (5, 0) else 2 ** 31 - 1
+            body = {'size': 0, 'aggs': {'designs': {'terms': {'field': field, 'size': size}}}}
+            response = self.es.search(index=self.index_name, doc_type='image', body=body)
+            for bucket in response['aggregations']['designs']['buckets']:
+                yield bucket['key'], bucket['doc_count']
+            return
+
+        composite = {'size': page_size, 'sources': [{'stl_id': {'terms': {'field': field}}}]}
+        while True:
+            response = self.es.search(index=self.index_name, body={'size': 0, 'aggs': {'designs': {'composite': composite}}})
+            designs = response['aggregations']['designs']
+            for bucket in designs['buckets']:
+                yield bucket['key']['stl_id'], bucket['doc_count']
+            if len(designs['buckets']) < page_size:
+                return
+            # after_key only came with 6.3
+            composite['after'] = designs.get('after_key') or designs['buckets'][-1]['key']
+
+    def _stl_id_field(self, doc_type='image'):
+        # the aggregatable field holding stl_id, or None if there isn't one
+        try:
+            mappings = list(self.es.indices.get_mapping(index=self.index_name).values())[0]['mappings']
+        except (TransportError, IndexError):
+            return None
+        properties = mappings.get('properties') or mappings.get(doc_type, {}).get('properties', {})
+        mapping = properties.get('stl_id', {})
+        if mapping.get('type') == 'keyword' or mapping.get('index') == 'not_analyzed':
+            return 'stl_id'
+        if mapping.get('fields', {}).get('keyword', {}).get('type') == 'keyword':
+            # dynamic mapping of elasticsearch 5 and later
+            return 'stl_id.keyword'
+        return None
 
     def _best_single_image(self, results, n_per_view=5):
+        # only the n_per_view closest hits of every view count
+        top_hits = [heapq.nsmallest(n_per_view, result, key=itemgetter('dist')) for result in results]
+        stl_ids = self._stl_ids([hit for hits in top_hits for hit in hits])
+
         scores = {}
-        for result in results:
-            for i in range(n_per_view):
-                if result:
-                    best = min(result, key=lambda x: x['dist'])
-                    k = self.es.get(id=best['id'], index=self.ses.index, doc_type='image',
-                                         fields=['stl_id'])['fields']['stl_id'][0]
-                    if k not in scores:
-                        scores[k] = best['dist']
-                    elif best['dist'] < scores[k]:
-                        scores[k] = best['dist']
-                    result.remove(best)
+        for hits in top_hits:
+            for hit in hits:
+                k = stl_ids.get(hit['id'])
+                if k is None:
+                    continue
+                if k not in scores or hit['dist'] < scores[k]:
+                    scores[k] = hit['dist']
         return scores
+
+    def _stl_ids(self, hits, doc_type='image'):
+        """
+        Find the stl_id of the designs that search hits belong to
+
+        Images added by this version carry the stl_id in their metadata, which comes back with
+        the hit. Older images are looked up with a single mget, and remembered.
+
+        :param hits: search hits, as returned by search_images
+        :return: dict of image document id to stl_id
+        """
+        stl_ids = {}
+        missing = set()
+        for hit in hits:
+            metadata = hit.get('metadata') or {}
+            if 'stl_id' in metadata:
+                stl_ids[hit['id']] = metadata['stl_id']
+            elif hit['id'] in self.stl_id_cache:
+                stl_ids[hit['id']] = self.stl_id_cache[hit['id']]
+            else:
+                missing.add(hit['id'])
+
+        if missing:
+            docs = self.es.mget(body={'ids': list(missing)}, index=self.ses.index, doc_type=doc_type,
+                                fields=['stl_id'])['docs']
+            for doc in docs:
+                if doc.get('found'):
+                    stl_ids[doc['_id']] = self.stl_id_cache[doc['_id']] = doc['fields']['stl_id'][0]
+        return stl_ids
@@ -0,0 +1,299 @@
+"""APIOperations for asyncio, so one process can serve many adds and searches at once
+
+:py:class:`AsyncAPIOperations` runs the same pipeline as
+:py:class:`api_operations.APIOperations` without blocking the event loop:
+
+* downloads stream over aiohttp, when it is installed (otherwise in a thread)
+* blender runs with asyncio.create_subprocess_exec; the numpy backend and render pools in a thread
+* signatures are computed in a process pool executor
+* elasticsearch searches run in a thread: the elasticsearch 2.x client has no asyncio support
+
+Every stage has its own concurrency limit, so a burst of searches queues up
+for render slots instead of starting a blender process each.
+
+Python 3.7 or later only: this module is a SyntaxError on Python 2, and
+nothing else in match3d imports it. ::
+
+    ops = AsyncAPIOperations(index_name='3d_test', renders=4)
+    results = await asyncio.gather(*[ops.search(stl_url=url) for url in urls])
+"""
+__author__ = 'ryan'
+
+from api_operations import APIOperations
+from caching import file_digest
+from three_d_match import _make_record
+from descriptors import shape_descriptors
+from timing import Timings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from os import listdir, remove
+from os.path import join, getsize, splitext
+from shutil import copy, rmtree
+import asyncio
+import hashlib
+import tempfile
+
+from download import DownloadError
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AsyncAPIOperations(object):
+    def __init__(self, operations=None, downloads=16, renders=2, signatures=None, queries=32, threads=None,
+                 **kwargs):
+        """
+        :param operations: the APIOperations (or a subclass) to build on. Made from kwargs if not given
+        :param downloads: downloads at a time
+        :param renders: renders at a time: blender processes, or numpy renders
+        :param signatures: processes computing signatures (default: operations.processes, or one per core)
+        :param queries: elasticsearch requests at a time
+        :param threads: size of the thread pool running the blocking steps (default: enough for every stage)
+        :param kwargs: passed on to APIOperations
+        """
+        self.operations = operations or APIOperations(**kwargs)
+        self.concurrency = {'download': downloads, 'render': renders, 'signatures': signatures or self.operations.processes,
+                            'query': queries}
+        self._limits = {}
+        self._threads = ThreadPoolExecutor(threads or downloads + renders + queries)
+        self._signature_executor = ProcessPoolExecutor(signatures or self.operations.processes)
+        self._session = None
+
+    def _limit(self, stage):
+        # made on first use, in the running event loop
+        if stage not in self._limits:
+            self._limits[stage] = asyncio.Semaphore(self.concurrency[stage] or 2 ** 16)
+        return self._limits[stage]
+
+    async def _run(self, function, *args, **kwargs):
+        # run a blocking call in the thread pool
+        return await asyncio.get_running_loop().run_in_executor(self._threads, partial(function, *args, **kwargs))
+
+    async def close(self):
+        """Shut down the executors and close the connections"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        self._threads.shutdown(wait=False)
+        self._signature_executor.shutdown(wait=False)
+        self.operations.close()
+
+    async def fetch(self, url, path):
+        """
+        Download url to path, with the limits of operations.downloader
+
+        :return: (SHA-1 of the contents, number of bytes), like download.Downloader.fetch
+        """
+        downloader = self.operations.downloader
+        async with self._limit('download'):
+            if aiohttp is None:
+                return await self._run(downloader.fetch, url, path)
+
+            if self._session is None:
+                self._session = aiohttp.ClientSession()
+            connect, read = downloader.timeout if isinstance(downloader.timeout, tuple) else (downloader.timeout,) * 2
+            timeout = aiohttp.ClientTimeout(total=downloader.max_seconds, sock_connect=connect, sock_read=read)
+            digest = hashlib.sha1()
+            size = 0
+            try:
+                async with self._session.get(url, timeout=timeout) as r:
+                    r.raise_for_status()
+                    if r.content_length and downloader.max_bytes and r.content_length > downloader.max_bytes:
+                        raise DownloadError('{} is {} bytes, more than the {} allowed'.format(
+                            url, r.content_length, downloader.max_bytes))
+                    with open(path, 'wb') as f:
+                        async for chunk in r.content.iter_chunked(downloader.chunk_size):
+                            size += len(chunk)
+                            if downloader.max_bytes and size > downloader.max_bytes:
+                                raise DownloadError('{} is more than the {} bytes allowed'.format(
+                                    url, downloader.max_bytes))
+                            digest.update(chunk)
+                            f.write(chunk)
+            except asyncio.TimeoutError:
+                raise DownloadError('{} took more than {} seconds'.format(url, downloader.max_seconds))
+            return digest.hexdigest(), size
+
+    async def generate_images(self, stl_directory_name, output_directory=None, rotations=False, front_and_back=False,
+                              reflections=False, render_backend=None, stl_digest=None, timings=None, resolution=None):
+        """
+        Render the views of every STL file in a directory, like ThreeDSearch.generate_images
+
+        Blender runs as an asyncio subprocess; the render cache, render pools and in-process backends in a thread.
+        Waits for a render slot first.
+
+        :return: the output directory
+        """
+        ops = self.operations
+        output_directory = output_directory or tempfile.mkdtemp()
+        backend = render_backend or ops.render_backend
+        timings = timings or Timings(ops.timing_hook)
+        async with self._limit('render'):
+            if backend != 'blender' or ops.render_pool or ops.render_cache or ops.blender_processes > 1:
+                return await self._run(ops.generate_images, stl_directory_name, output_directory=output_directory,
+                                       rotations=rotations, front_and_back=front_and_back, reflections=reflections,
+                                       render_backend=backend, stl_digest=stl_digest, timings=timings,
+                                       resolution=resolution)
+
+            with timings.stage('render', backend=backend) as info:
+                command = ops._blender_command(stl_directory_name, output_directory, rotations=rotations,
+                                               front_and_back=front_and_back, reflections=reflections,
+                                               resolution=resolution)
+                process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.DEVNULL)
+                await process.wait()
+                info.update(ops._render_stats(output_directory))
+        return output_directory
+
+    async def make_records(self, img_paths, timings=None):
+        """image_match records of images, computed in the process pool"""
+        ses = self.operations.ses
+        loop = asyncio.get_running_loop()
+        timings = timings or Timings(self.operations.timing_hook)
+        if self.operations.render_cache and self.operations.render_cache.signatures:
+            # looked up in the cache one by one, the misses computed in the operations' own pool
+            with timings.stage('signatures', views=len(img_paths)):
+                async with self._limit('signatures'):
+                    return await self._run(self.operations.make_records, img_paths)
+
+        async def make_record(img_path):
+            async with self._limit('signatures'):
+                return await loop.run_in_executor(self._signature_executor, _make_record,
+                                                  (img_path, ses.gis, ses.k, ses.N))
+
+        with timings.stage('signatures', views=len(img_paths)):
+            return list(await asyncio.gather(*[make_record(img_path) for img_path in img_paths]))
+
+    async def search_records(self, records, search_filter=None, timings=None):
+        """Search the index for image_match records, like APIOperations.search_records, in a thread"""
+        ops = self.operations
+        timings = timings or Timings(ops.timing_hook)
+        async with self._limit('query'):
+            with timings.stage('query', views=len(records)) as info:
+                res = await self._run(ops.search_records, records, search_filter=search_filter)
+                info['hits'] = sum(len(hits) for hits in res)
+        return res
+
+    async def search(self, stl_url=None, stl_file=None, return_raw=False, ranking='single', render_backend=None,
+                     timings=False):
+        """
+        Search by STL file for similar designs, like APIOperations.search
+
+        Only the image rankings: 'single', or the raw hits with return_raw. Answered from operations.result_cache
+        when it has the result.
+
+        :param timings: True to add the time taken by every stage to the result, under 'timings'
+        :return: {stl_url or stl_file: {stl_id: distance}}, or the hits of every view with return_raw
+        """
+        if ranking != 'single' and not return_raw:
+            raise ValueError('ranking {} is not supported asynchronously'.format(ranking))
+        ops = self.operations
+        timer = Timings(ops.timing_hook)
+        key = stl_url or stl_file
+        input_directory = tempfile.mkdtemp()
+        temporary_stl = tempfile.mkstemp(suffix='.stl')[-1]
+        images_directory = None
+        try:
+            stl_digest = None
+            if stl_url:
+                with timer.stage('download') as info:
+                    stl_digest, info['bytes'] = await self.fetch(stl_url, temporary_stl)
+                stl_file = temporary_stl
+
+            cache_key = generation = None
+            if ops.result_cache:
+                generation = ops.result_cache.generation(ops.index_name)
+                backend = render_backend or ops.render_backend
+                cache_key = ops.result_cache.key(stl_digest or await self._run(file_digest, stl_file),
+                                                 index=ops.index_name,
+                                                 cutoff=ops.ses.distance_cutoff,
+                                                 ranking=ranking,
+                                                 return_raw=return_raw,
+                                                 backend=backend if isinstance(backend, str) else type(backend).__name__,
+                                                 render=ops._render_settings(backend),
+                                                 prefilter=None,
+                                                 shape_weight=0.0)
+                cached = ops.result_cache.get(cache_key, ops.index_name, generation)
+                if cached is not None:
+                    return cached if return_raw else self._with_timings({key: cached}, timer, timings)
+
+            with timer.stage('load_stl', bytes=getsize(stl_file)) as info:
+                info['faces'] = len(await self._run(ops.check_stl, stl_file))
+            copy(stl_file, input_directory)
+            images_directory = await self.generate_images(input_directory, render_backend=render_backend,
+                                                          stl_digest=stl_digest, timings=timer)
+            img_paths = [join(images_directory, name) for name in listdir(images_directory)
+                         if splitext(name)[-1] == '.png']
+            records = await self.make_records(img_paths, timings=timer)
+            res = await self.search_records(records, timings=timer)
+        finally:
+            rmtree(input_directory)
+            remove(temporary_stl)
+            if images_directory:
+                rmtree(images_directory)
+
+        if return_raw:
+            return ops._cache_result(cache_key, generation, res)
+        with timer.stage('rank', hits=sum(len(hits) for hits in res)) as info:
+            # may look stl_ids up in elasticsearch
+            scores = await self._run(ops._best_single_image, res)
+            info['designs'] = len(scores)
+        return self._with_timings({key: ops._cache_result(cache_key, generation, scores)}, timer, timings)
+
+    @staticmethod
+    def _with_timings(result, timer, timings):
+        if timings:
+            result['timings'] = timer.summary()
+        return result
+
+    async def add(self, stl_id, stl_url=None, stl_file=None, doc_type='image', chunk_size=500, max_retries=3,
+                  initial_backoff=2):
+        """
+        Add an STL design, like APIOperations.add
+
+        :return: dict with the number of images indexed and the errors of any that failed
+        """
+        ops = self.operations
+        timings = Timings(ops.timing_hook)
+        input_directory = tempfile.mkdtemp()
+        output_directory = tempfile.mkdtemp()
+        temporary_stl = tempfile.mkstemp(suffix='.stl')[-1]
+        try:
+            stl_digest = None
+            if stl_url:
+                with timings.stage('download') as info:
+                    stl_digest, info['bytes'] = await self.fetch(stl_url, temporary_stl)
+                stl_file = temporary_stl
+
+            with timings.stage('load_stl', bytes=getsize(stl_file)) as info:
+                mesh = await self._run(ops.check_stl, stl_file)
+                info['faces'] = len(mesh)
+            with timings.stage('descriptors', faces=len(mesh)):
+                descriptors = await self._run(shape_descriptors, mesh)
+
+            copy(stl_file, input_directory)
+            await self.generate_images(input_directory, output_directory=output_directory, rotations=True,
+                                       front_and_back=True, reflections=True, stl_digest=stl_digest, timings=timings)
+
+            images = [(stl_id, join(output_directory, image_path))
+                      for image_path in listdir(output_directory) if image_path.split('.')[-1] != 'csv']
+            async with self._limit('query'):
+                # the signatures are computed in the operations' own pool while the bulk requests stream
+                result = await self._run(ops._timed_index_images, timings, images, doc_type=doc_type,
+                                         chunk_size=chunk_size, max_retries=max_retries,
+                                         initial_backoff=initial_backoff)
+                if result['indexed'] and not result['errors']:
+                    with timings.stage('catalog', designs=1):
+                        result['errors'].extend(await self._run(ops._index_designs, [stl_id], images,
+                                                                {stl_id: stl_url or stl_file}, {stl_id: descriptors}))
+                await self._run(ops._invalidate_results)
+            return result
+        finally:
+            rmtree(input_directory)
+            rmtree(output_directory)
+            remove(temporary_stl)
+
+    async def list_designs(self, counts=False, catalog=False, page_size=1000):
+        """The designs in the corpus, like APIOperations.list_designs"""
+        async with self._limit('query'):
+            return await self._run(self.operations.list_designs, counts=counts, catalog=catalog, page_size=page_size)
@@ -6,6 +6,7 @@ __author__ = 'ryan'
 import bpy  # blender-specific module
 from mathutils import Matrix, Vector    # blender-specific classes
 import numpy as np
+from geometry import max_vertex_norm
 
 
 class BlenderBase():
@@ -15,6 +16,12 @@ class BlenderBase():
         self.scene.camera.data.type = 'ORTHO'
         self.scene.camera.location = 5 * Vector([1, 0, 0])
 
+        self._set_resolution(resolution)
+
+        # turning off raytracing can greatly speed up the non-parallel parts of rendering
+        self.scene.render.use_raytrace = False
+
+    def _set_resolution(self, resolution):
         # render resolution
         # If you want the final rendered image to be N x N pixels,
         # then you need to set resolution_x=2*N and resolution_y=2*N.
@@ -22,11 +29,14 @@ class BlenderBase():
         self.scene.render.resolution_x = 2 * resolution
         self.scene.render.resolution_y = 2 * resolution
 
-        # turning off raytracing can greatly speed up the non-parallel parts of rendering
-        self.scene.render.use_raytrace = False
-
     def _set_tracking(self, obj):
-        cns = self.scene.camera.constraints.new('TRACK_TO')
+        # reuse the camera constraint between models, so a long-lived blender
+        # process doesn't pile up one stale constraint per rendered STL
+        for cns in self.scene.camera.constraints:
+            if cns.type == 'TRACK_TO':
+                break
+        else:
+            cns = self.scene.camera.constraints.new('TRACK_TO')
         cns.target = obj
         cns.track_axis = 'TRACK_NEGATIVE_Z'
         cns.up_axis = 'UP_Y'
@@ -44,6 +54,11 @@ class BlenderBase():
         bpy.ops.object.select_by_type(type='MESH')
         bpy.ops.object.delete(use_global=False)
 
+        # deleting the object leaves its mesh datablock behind
+        for mesh in bpy.data.meshes:
+            if mesh.users == 0:
+                bpy.data.meshes.remove(mesh)
+
     @staticmethod
     def _load_stl(stl_path):
         # load stl
@@ -58,11 +73,62 @@ class BlenderBase():
 
     @staticmethod
     def _scale_object(obj):
-        factor = 3/max([np.linalg.norm(x.co) for x in obj.data.vertices.values()])
+        vertices = obj.data.vertices
+        coordinates = np.empty(3 * len(vertices), dtype=np.float32)
+        vertices.foreach_get('co', coordinates)
+        factor = 3/max_vertex_norm(coordinates)
         bpy.ops.transform.resize(value=(factor, factor, factor))
         bpy.ops.object.origin_set(type='ORIGIN_CENTER_OF_MASS')
 
     @staticmethod
     def _render_scene(path):
         bpy.data.scenes["Scene"].render.filepath = path
-        bpy.ops.render.render(write_still=True)
\ No newline at end of file
+        bpy.ops.render.render(write_still=True)
+
+    def _use_viewer_node(self):
+        # Route the render through the compositor into a Viewer node. Its image holds the
+        # pixels of the last render, so they can be read without writing a file
+        self.scene.use_nodes = True
+        self.scene.render.use_compositing = True
+        tree = self.scene.node_tree
+        layers = tree.nodes.get('Render Layers') or tree.nodes.new('CompositorNodeRLayers')
+        viewer = tree.nodes.get('Viewer') or tree.nodes.new('CompositorNodeViewer')
+        viewer.use_alpha = False
+        tree.links.new(layers.outputs['Image'], viewer.inputs['Image'])
+
+    @staticmethod
+    def _render_pixels():
+        """
+        Render the scene into memory (needs _use_viewer_node)
+
+        :return: float array of shape (height, width, 3), rows top to bottom, values in [0, 1] as they'd be in a PNG
+        """
+        bpy.ops.render.render()
+        viewer = bpy.data.images['Viewer Node']
+        width, height = viewer.size
+        pixels = np.array(viewer.pixels[:]).reshape(height, width, 4)[:, :, :3]
+        # the viewer holds linear values; saving a PNG would have applied the sRGB curve
+        pixels = np.clip(pixels, 0, 1)
+        pixels = np.where(pixels <= 0.0031308, 12.92 * pixels, 1.055 * pixels ** (1 / 2.4) - 0.055)
+        return np.flipud(pixels)
+
+    @staticmethod
+    def _load_pixels(path):
+        # blender stores pixels bottom row first; flip so rows run top to bottom
+        img = bpy.data.images.load(path)
+        width, height = img.size
+        pixels = np.array(img.pixels[:]).reshape(height, width, img.channels)
+        bpy.data.images.remove(img)
+        return np.flipud(pixels)
+
+    @staticmethod
+    def _save_pixels(pixels, path):
+        height, width, channels = pixels.shape
+        if channels == 3:
+            pixels = np.dstack([pixels, np.ones((height, width))])
+        img = bpy.data.images.new('match3d_pixels', width=width, height=height, alpha=True)
+        img.pixels = np.flipud(pixels).ravel().tolist()
+        img.filepath_raw = path
+        img.file_format = 'PNG'
+        img.save()
+        bpy.data.images.remove(img)
@@ -0,0 +1,344 @@
+"""Caches used to avoid repeating expensive lookups
+
+"""
+__author__ = 'ryan'
+
+from collections import OrderedDict
+from copy import deepcopy
+from hashlib import md5
+from os import getpid, listdir, makedirs, remove, rename, utime
+from os.path import abspath, exists, expanduser, getmtime, getsize, isdir, join
+from shutil import copyfile, rmtree
+from tempfile import mkdtemp
+from uuid import uuid4
+
+import csv
+import hashlib
+import json
+import threading
+
+from report import REPORT_FILENAME, REPORT_FIELDS, read_report, report_writer
+
+
+class LRUCache(object):
+    def __init__(self, maxsize=100000):
+        """
+        Dictionary that forgets its least recently used entries. Safe to share between threads
+
+        :param maxsize: number of entries to keep
+        """
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __getitem__(self, key):
+        with self._lock:
+            # re-insert to mark as most recently used
+            value = self._entries.pop(key)
+            self._entries[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._entries[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def file_digest(path, chunk_size=2 ** 20):
+    """SHA-1 of a file's contents, read in chunks"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class RenderCache(object):
+    def __init__(self, directory, max_bytes=10 * 2 ** 30, signatures=True):
+        """
+        On-disk cache of rendered views, keyed by the content of the STL file and the render options
+
+        Views are stored without the hash of the STL path that starts their names, and get the hash of
+        the new path when restored, so a cache hit looks just like a fresh render. Entries are evicted
+        least recently used first once the cache holds more than max_bytes.
+
+        :param directory: where to keep the cache
+        :param max_bytes: size limit of the cache
+        :param signatures: also cache the image_match records of images, keyed by the image contents
+        """
+        self.directory = abspath(expanduser(directory))
+        self.max_bytes = max_bytes
+        self.signatures = signatures
+        for sub_directory in ('renders', 'records'):
+            if not exists(join(self.directory, sub_directory)):
+                makedirs(join(self.directory, sub_directory))
+        self._lock = threading.Lock()
+        self._size = None
+
+    @staticmethod
+    def key(stl_digest, **render_options):
+        """
+        Cache key of a render
+
+        :param stl_digest: file_digest of the STL file
+        :param render_options: everything that changes the rendered images
+        """
+        return hashlib.sha1(json.dumps({'stl': stl_digest, 'options': render_options},
+                                       sort_keys=True).encode('utf-8')).hexdigest()
+
+    def restore(self, key, stl_file, output_directory):
+        """
+        Copy cached views into output_directory, as if they had been rendered from stl_file
+
+        :return: True on a hit, False on a miss
+        """
+        entry = join(self.directory, 'renders', key)
+        if not exists(entry):
+            return False
+        stl_hash = md5(stl_file.encode('utf-8')).hexdigest()
+        try:
+            with open(join(entry, REPORT_FILENAME)) as cached_report, \
+                    open(join(output_directory, REPORT_FILENAME), 'w') as report_file:
+                writer = report_writer(report_file)
+                for row in csv.DictReader(cached_report):
+                    filename = '{}.{}'.format(stl_hash, row['id'])
+                    # nothing was rendered this time
+                    row.update({'id': filename, 'stl_filename': stl_file, 'seconds': '', 'model_seconds': ''})
+                    if row.get('canonical_id'):
+                        # a duplicate view, no image
+                        row['canonical_id'] = '{}.{}'.format(stl_hash, row['canonical_id'])
+                    else:
+                        copyfile(join(entry, row['id'].split('.', 1)[-1]), join(output_directory, filename))
+                        row['image_filename'] = abspath(join(output_directory, filename))
+                    writer.writerow(row)
+        except (IOError, OSError):
+            # evicted while we were reading it
+            return False
+        utime(entry, None)
+        return True
+
+    def store(self, key, images_directory):
+        """Add the views rendered into images_directory (from a single STL file) to the cache"""
+        entry = join(self.directory, 'renders', key)
+        report_path = join(images_directory, REPORT_FILENAME)
+        # don't remember failed renders
+        if exists(entry) or not exists(report_path):
+            return
+        rows = list(read_report(report_path))
+        if not rows:
+            return
+
+        staging = mkdtemp(dir=join(self.directory, 'renders'))
+        size = 0
+        with open(join(staging, REPORT_FILENAME), 'w') as cached_report:
+            writer = csv.DictWriter(cached_report, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            for row in rows:
+                view = row['id'].split('.', 1)[-1]
+                if row.get('canonical_id'):
+                    row['canonical_id'] = row['canonical_id'].split('.', 1)[-1]
+                else:
+                    copyfile(row['image_filename'], join(staging, view))
+                    size += getsize(join(staging, view))
+                    row['image_filename'] = view
+                row.update({'id': view, 'stl_filename': ''})
+                writer.writerow(row)
+        try:
+            rename(staging, entry)
+        except OSError:
+            # another process cached the same render first
+            rmtree(staging)
+            return
+        self._grow(size)
+
+    def get_record(self, image_digest, image_path):
+        """Cached image_match record of an image, or None"""
+        path = join(self.directory, 'records', image_digest + '.json')
+        try:
+            with open(path) as f:
+                rec = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        utime(path, None)
+        rec['path'] = image_path
+        return rec
+
+    def put_record(self, image_digest, rec):
+        path = join(self.directory, 'records', image_digest + '.json')
+        staging = path + '.{}.tmp'.format(getpid())
+        with open(staging, 'w') as f:
+            json.dump(rec, f)
+        rename(staging, path)
+        self._grow(getsize(path))
+
+    def _entries(self):
+        # (last used, size, path) of every entry. Other processes may be evicting at the same time
+        for sub_directory in ('renders', 'records'):
+            for name in listdir(join(self.directory, sub_directory)):
+                entry = join(self.directory, sub_directory, name)
+                try:
+                    if isdir(entry):
+                        size = sum(getsize(join(entry, f)) for f in listdir(entry))
+                    else:
+                        size = getsize(entry)
+                    yield getmtime(entry), size, entry
+                except OSError:
+                    continue
+
+    def _grow(self, size):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(entry_size for _, entry_size, _ in self._entries())
+            else:
+                self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # down to 90% of the limit, so we don't evict again on the very next store
+        entries = sorted(self._entries())
+        self._size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, entry in entries:
+            if self._size <= 0.9 * self.max_bytes:
+                break
+            try:
+                if isdir(entry):
+                    rmtree(entry)
+                else:
+                    remove(entry)
+            except OSError:
+                continue
+            self._size -= entry_size
+
+
+class ResultCache(object):
+    def __init__(self, maxsize=1000, directory=None):
+        """
+        Cache of search results, in memory and optionally on disk, forgotten whenever the index changes
+
+        Every index has a generation, a random token replaced by invalidate after each write. Results are
+        stored under the generation read before the search started, so a result computed while designs
+        were being added is never returned afterwards. With a directory, the generations and results are
+        shared by every process using it; without one, only this process's writes invalidate its results.
+
+        :param maxsize: number of results kept in memory
+        :param directory: where to keep results on disk too (optional)
+        """
+        self._memory = LRUCache(maxsize)
+        self._generations = {}
+        # shared by the server's worker threads: one of them at a time reads or replaces a generation
+        self._lock = threading.RLock()
+        self.directory = abspath(expanduser(directory)) if directory else None
+        if self.directory and not exists(self.directory):
+            makedirs(self.directory)
+
+    @staticmethod
+    def key(stl_digest, **search_options):
+        """
+        Cache key of a search
+
+        :param stl_digest: file_digest of the STL file searched for
+        :param search_options: everything that changes the result (ranking, cutoff...)
+        """
+        return RenderCache.key(stl_digest, **search_options)
+
+    def generation(self, index_name):
+        """The current generation of an index"""
+        with self._lock:
+            if not self.directory:
+                return self._generations.setdefault(index_name, uuid4().hex)
+            try:
+                with open(join(self._index_directory(index_name), 'GENERATION')) as f:
+                    return f.read().strip()
+            except (IOError, OSError):
+                return self.invalidate(index_name)
+
+    def invalidate(self, index_name):
+        """Forget every result of an index, after writing to it. Returns the new generation"""
+        generation = uuid4().hex
+        with self._lock:
+            self._generations[index_name] = generation
+            if self.directory:
+                index_directory = self._index_directory(index_name)
+                if not exists(index_directory):
+                    try:
+                        makedirs(index_directory)
+                    except OSError:
+                        # another process made it first
+                        pass
+                staging = join(index_directory, 'GENERATION.{}.tmp'.format(getpid()))
+                with open(staging, 'w') as f:
+                    f.write(generation)
+                rename(staging, join(index_directory, 'GENERATION'))
+                # results of older generations will never be read again
+                for name in listdir(index_directory):
+                    if isdir(join(index_directory, name)) and name != generation:
+                        rmtree(join(index_directory, name), ignore_errors=True)
+        return generation
+
+    def get(self, key, index_name, generation):
+        """A copy of the cached result, or None"""
+        try:
+            return deepcopy(self._memory[(index_name, generation, key)])
+        except KeyError:
+            pass
+        if not self.directory:
+            return None
+        try:
+            with open(join(self._index_directory(index_name), generation, key + '.json')) as f:
+                result = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        self._memory[(index_name, generation, key)] = result
+        return deepcopy(result)
+
+    def put(self, key, index_name, generation, result):
+        """Cache the result of a search started when the index was at generation"""
+        self._memory[(index_name, generation, key)] = deepcopy(result)
+        if not self.directory:
+            return
+        with self._lock:
+            if generation != self.generation(index_name):
+                return
+            generation_directory = join(self._index_directory(index_name), generation)
+            try:
+                if not exists(generation_directory):
+                    makedirs(generation_directory)
+                path = join(generation_directory, key + '.json')
+                staging = path + '.{}.tmp'.format(getpid())
+                with open(staging, 'w') as f:
+                    json.dump(result, f)
+                rename(staging, path)
+            except (IOError, OSError):
+                # invalidated meanwhile; the result is stale anyway
+                pass
+
+    def _index_directory(self, index_name):
+        # index names may be paths (local_index.LocalOperations)
+        return join(self.directory, md5(index_name.encode('utf-8')).hexdigest())
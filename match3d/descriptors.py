@@ -0,0 +1,138 @@
+"""Rotation and scale invariant shape descriptors of a mesh, in plain numpy
+
+Much cheaper than rendering and searching views: they are computed straight
+from the STL triangles, so they can narrow down or rerank the candidates of an
+image search. Every descriptor is a plain dict of floats and lists, ready to be
+stored in elasticsearch:
+
+* ``eigenvalue_ratios``: the two smaller principal moments of inertia over the largest
+* ``d2``: histogram of the distances between random points on the surface, over their mean (Osada et al.)
+* ``compactness``: 36 pi V^2 / A^3, the surface area to volume ratio made scale invariant (1 for a sphere)
+"""
+__author__ = 'ryan'
+
+import numpy as np
+
+
+D2_BINS = 32
+# distances are histogrammed in units of their mean, up to this many
+D2_RANGE = 4.0
+
+
+def shape_descriptors(mesh, bins=D2_BINS, points=1024, pairs=2 ** 15, seed=0, chunk_size=1000000):
+    """
+    Shape descriptors of a mesh
+
+    Makes two passes over the faces, chunk_size at a time, accumulating sums rather than
+    keeping per-face arrays, so streamed ASCII meshes never have to be read into memory.
+
+    :param mesh: a :py:class:`stl_reader.STLMesh`
+    :param bins: number of bins of the D2 histogram
+    :param points: number of points sampled on the surface for D2
+    :param pairs: number of random pairs of those points
+    :param seed: seed of the sampling, so the same mesh always gets the same descriptors
+    :param chunk_size: faces processed at a time
+    :return: dict with eigenvalue_ratios, d2 and compactness
+    """
+    # sums over the faces, relative to a vertex of the mesh to keep the float error down:
+    # area, area-weighted centroid and second moment, and for the volume the triple products
+    # and the pairwise cross products of the vertices, so it can be moved to the center afterwards
+    origin = None
+    area = 0.0
+    first = np.zeros(3)
+    second = np.zeros((3, 3))
+    triple = 0.0
+    crosses = np.zeros(3)
+    for chunk in mesh.iter_chunks(chunk_size):
+        if origin is None:
+            finite = chunk[np.isfinite(chunk).all(axis=(1, 2))]
+            origin = finite[0, 0] if len(finite) else np.zeros(3)
+        chunk = chunk - origin
+        areas, centroids, usable = _face_areas(chunk)
+        chunk = chunk[usable]
+        area += areas.sum()
+        first += areas.dot(centroids)
+        second += (centroids * areas[:, np.newaxis]).T.dot(centroids)
+        triple += np.einsum('ij,ij->', chunk[:, 0], np.cross(chunk[:, 1], chunk[:, 2]))
+        crosses += (np.cross(chunk[:, 0], chunk[:, 1]) + np.cross(chunk[:, 1], chunk[:, 2]) +
+                    np.cross(chunk[:, 2], chunk[:, 0])).sum(axis=0)
+    if area == 0:
+        raise ValueError('mesh has no surface')
+
+    center = first / area
+    # geometry.inertia_matrix about the center, from the sums about the origin
+    moments = second - area * np.outer(center, center)
+    evals = np.sort(np.linalg.eigvalsh(np.trace(moments) * np.eye(3) - moments))
+    # signed volume of the tetrahedra between the center and every face
+    volume = abs(triple - center.dot(crosses)) / 6.0
+
+    return {'eigenvalue_ratios': [float(r) for r in evals[:2] / evals[2]],
+            'd2': [float(h) for h in d2_histogram(mesh, area, bins, points, pairs, seed, chunk_size)],
+            'compactness': float(min(36 * np.pi * volume ** 2 / area ** 3, 1.0))}
+
+
+def _face_areas(chunk):
+    # areas and centroids of a chunk of faces, those with non-finite coordinates left out
+    areas = 0.5 * np.linalg.norm(np.cross(chunk[:, 1] - chunk[:, 0], chunk[:, 2] - chunk[:, 0]), axis=1)
+    centroids = chunk.mean(axis=1)
+    usable = np.isfinite(areas) & np.isfinite(centroids).all(axis=1)
+    return areas[usable], centroids[usable], usable
+
+
+def d2_histogram(mesh, area, bins=D2_BINS, points=1024, pairs=2 ** 15, seed=0, chunk_size=1000000):
+    """
+    Normalized histogram of distances between random pairs of points on the surface
+
+    :param mesh: a :py:class:`stl_reader.STLMesh`
+    :param area: total area of the faces with finite coordinates
+    :param chunk_size: faces processed at a time
+    :return: array of bins frequencies summing to 1
+    """
+    random = np.random.RandomState(seed)
+    # pick faces in proportion to their area, walking the chunks along the sorted draws
+    draws = random.uniform(0, area, points)
+    order = np.argsort(draws)
+    draws = draws[order]
+    triangles = np.empty((points, 3, 3))
+    offset = 0.0
+    picked = 0
+    last = None
+    for chunk in mesh.iter_chunks(chunk_size):
+        areas, _, usable = _face_areas(chunk)
+        chunk = chunk[usable]
+        if not len(chunk):
+            continue
+        cumulative = offset + np.cumsum(areas)
+        end = np.searchsorted(draws, cumulative[-1], side='left')
+        faces = np.searchsorted(cumulative, draws[picked:end], side='right')
+        triangles[order[picked:end]] = chunk[np.minimum(faces, len(chunk) - 1)]
+        offset, picked, last = cumulative[-1], end, chunk[-1]
+    # draws rounded past the last face
+    triangles[order[picked:]] = last
+
+    # uniform barycentric coordinates
+    u, v = random.uniform(size=(2, points))
+    flip = u + v > 1
+    u[flip], v[flip] = 1 - u[flip], 1 - v[flip]
+    samples = triangles[:, 0] + u[:, np.newaxis] * (triangles[:, 1] - triangles[:, 0]) \
+        + v[:, np.newaxis] * (triangles[:, 2] - triangles[:, 0])
+
+    a, b = random.randint(0, points, size=(2, pairs))
+    distances = np.linalg.norm(samples[a] - samples[b], axis=1)
+    mean = distances.mean()
+    if mean > 0:
+        distances /= mean
+    histogram = np.histogram(np.minimum(distances, D2_RANGE), bins=bins, range=(0, D2_RANGE))[0]
+    return histogram / float(pairs)
+
+
+def descriptor_distance(a, b):
+    """
+    Distance between the shape descriptors of two meshes
+
+    :return: number between 0 (same shape) and 1, the mean of the differences of the three descriptors
+    """
+    eigenvalues = np.abs(np.subtract(a['eigenvalue_ratios'], b['eigenvalue_ratios'])).mean()
+    d2 = 0.5 * np.abs(np.subtract(a['d2'], b['d2'])).sum()
+    compactness = abs(a['compactness'] - b['compactness'])
+    return float(eigenvalues + d2 + compactness) / 3
@@ -0,0 +1,282 @@
+"""API operations on an index with one document per design
+
+Every design is a single document holding the signatures of all its views as
+nested objects, instead of one document per rendered view. The index holds a
+24th to a 48th of the documents, and searches come back already grouped by
+design: each query view is a nested query whose inner hits are the closest
+views of every design, so hits never have to be joined back to their stl_id.
+
+An index in the one-document-per-view layout of :py:class:`APIOperations` can
+be converted with :py:meth:`DesignOperations.migrate_from`, or from the command
+line::
+
+    python design_operations.py match3d match3d_designs
+"""
+__author__ = 'ryan'
+
+from api_operations import APIOperations
+from collections import OrderedDict
+from elasticsearch.helpers import streaming_bulk, scan
+from image_match.signature_database_base import normalized_distance
+from os import environ
+from os.path import basename, splitext
+from operator import itemgetter
+import argparse
+
+import numpy as np
+
+
+class DesignOperations(APIOperations):
+    def __init__(self, es_nodes=environ.get('ES_HOSTS', 'localhost'), index_name='match3d_designs',
+                 views_per_design=5, **kwargs):
+        """
+        :param views_per_design: closest views of each design compared for every query view
+        """
+        self.views_per_design = views_per_design
+        super(DesignOperations, self).__init__(es_nodes=es_nodes, index_name=index_name, **kwargs)
+        # the design documents are their own catalog
+        self.catalog_index = index_name
+
+    def add(self, stl_id, stl_url=None, stl_file=None, doc_type='design', **kwargs):
+        return super(DesignOperations, self).add(stl_id, stl_url=stl_url, stl_file=stl_file,
+                                                 doc_type=doc_type, **kwargs)
+
+    def add_many(self, items, shard_size=50, checkpoint=None, doc_type='design', **kwargs):
+        return super(DesignOperations, self).add_many(items, shard_size=shard_size, checkpoint=checkpoint,
+                                                      doc_type=doc_type, **kwargs)
+
+    def index_images(self, images, doc_type='design', chunk_size=50, max_retries=3, initial_backoff=2):
+        """
+        Compute the signatures of rendered images and index one document per design
+
+        :param images: list of (stl_id, image path) pairs
+        :param chunk_size: number of designs per bulk request
+        :return: dict with the number of images indexed and the errors of any designs that failed
+        """
+        self.create_index(doc_type)
+        designs = OrderedDict()
+        for stl_id, image_path in images:
+            designs.setdefault(stl_id, []).append(image_path)
+
+        result = {'indexed': 0, 'errors': []}
+        for ok, item in self._bulk(self._design_actions(designs, doc_type), chunk_size=chunk_size,
+                                   max_retries=max_retries, initial_backoff=initial_backoff):
+            if ok:
+                result['indexed'] += len(designs[item[list(item)[0]]['_id']])
+            else:
+                result['errors'].append(item)
+        return result
+
+    def _design_actions(self, designs, doc_type):
+        records = self.iter_records([image_path for image_paths in designs.values() for image_path in image_paths])
+        for stl_id, image_paths in designs.items():
+            views = [self._view(self._view_name(image_path), next(records)) for image_path in image_paths]
+            yield self._design_action(stl_id, views, doc_type)
+
+    def _design_action(self, stl_id, views, doc_type, descriptors=None):
+        source = {'stl_id': stl_id, 'view_count': len(views), 'views': views}
+        if descriptors:
+            source['descriptors'] = descriptors
+        return {
+            '_index': self.index_name,
+            '_type': doc_type,
+            '_id': stl_id,
+            '_source': source
+        }
+
+    @staticmethod
+    def _view(view_name, rec):
+        # only what searching needs: the signature and the words
+        view = dict((key, value) for key, value in rec.items() if key.startswith('simple_word_'))
+        view.update({'view': view_name, 'signature': list(rec['signature'])})
+        return view
+
+    @staticmethod
+    def _view_name(image_path):
+        return splitext(basename(image_path))[0].split('.', 1)[-1]
+
+    @staticmethod
+    def _image_id(stl_id, image_path):
+        # all of a design's images are in its one document
+        return stl_id
+
+    def _index_designs(self, stl_ids, images, sources, descriptors):
+        # no separate catalog: the shape descriptors go into the design documents themselves
+        actions = [{'_op_type': 'update',
+                    '_index': self.index_name,
+                    '_type': 'design',
+                    '_id': stl_id,
+                    'doc': {'descriptors': descriptors[stl_id]}}
+                   for stl_id in stl_ids if stl_id in descriptors]
+        return [item for ok, item in self._bulk(actions) if not ok]
+
+    def create_index(self, doc_type='design'):
+        """Create the index, with the views of a design as nested objects"""
+        if self._index_ready:
+            return
+        keyword = self._keyword_mapping()
+        signature = {'type': 'byte', 'index': False if self.es_version() >= (5, 0) else 'no'}
+        body = {'mappings': {doc_type: {'properties': {
+            'stl_id': keyword,
+            'view_count': {'type': 'integer'},
+            'descriptors': {'type': 'object', 'enabled': False},
+            'views': {'type': 'nested', 'properties': {'view': keyword, 'signature': signature}}
+        }}}}
+        self.es.indices.create(index=self.index_name, body=body, ignore=400)
+        self._index_ready = True
+
+    def iter_designs(self, catalog=True, page_size=1000):
+        """
+        Stream the designs in the corpus
+
+        :return: generator of (stl_id, number of views indexed) pairs
+        """
+        for hit in scan(self.es, index=self.index_name, doc_type='design', size=page_size,
+                        query={'_source': ['stl_id', 'view_count']}):
+            yield hit['_source']['stl_id'], hit['_source']['view_count']
+
+    def search_images(self, _images_directory, batch=None, search_filter=None, timings=None):
+        """
+        Search the index with every image in a directory, in a single request
+
+        :return: a list of hits for each image, like APIOperations.search_images. Hit ids are
+            '<stl_id>.<view>', and every hit carries its stl_id in the metadata
+        """
+        return super(DesignOperations, self).search_images(_images_directory, batch=True,
+                                                           search_filter=search_filter, timings=timings)
+
+    def search_records(self, records, doc_type='design', search_filter=None):
+        """
+        Search the designs for many image_match records at once
+
+        Every record is a nested query on the views. A design matches if any of its views shares a word
+        with a record, and its closest views for each record come back as inner hits.
+
+        :param records: records from make_records
+        :return: a list of hits for each record
+        """
+        records = list(records)
+        if not records:
+            return []
+
+        queries = []
+        for i, rec in enumerate(records):
+            words = [key for key in rec if key.startswith('simple_word_')]
+            queries.append({'nested': {
+                'path': 'views',
+                'score_mode': 'max',
+                'query': {'bool': {'should': [{'term': {'views.' + word: rec[word]}} for word in words]}},
+                'inner_hits': {'name': 'record_{}'.format(i), 'size': self.views_per_design}
+            }})
+        query = {'bool': {'should': queries}}
+        if search_filter:
+            query['bool'].update({'filter': search_filter, 'minimum_should_match': 1})
+        body = {'query': query,
+                '_source': ['stl_id'],
+                'size': getattr(self.ses, 'size', 100)}
+        designs = self.es.search(index=self.index_name, doc_type=doc_type, body=body)['hits']['hits']
+
+        results = []
+        for i, rec in enumerate(records):
+            views = []
+            for design in designs:
+                inner_hits = design.get('inner_hits', {}).get('record_{}'.format(i), {}).get('hits', {}).get('hits', [])
+                views.extend((design['_source']['stl_id'], view) for view in inner_hits)
+            results.append(self._format_views(views, rec['signature']))
+        return results
+
+    def _format_views(self, views, signature):
+        if not views:
+            return []
+        dists = normalized_distance(np.array([view['_source']['signature'] for _, view in views]), np.array(signature))
+        res = []
+        for (stl_id, view), dist in zip(views, dists):
+            if dist < self.ses.distance_cutoff:
+                res.append({'id': '{}.{}'.format(stl_id, view['_source']['view']),
+                            'score': view['_score'],
+                            'metadata': {'stl_id': stl_id},
+                            'path': None,
+                            'dist': dist})
+        return sorted(res, key=itemgetter('dist'))
+
+    def search_designs(self, records):
+        """
+        Best distance of every design to any of the records
+
+        :param records: records from make_records
+        :return: dict of stl_id to distance
+        """
+        return self._best_single_image(self.search_records(records), n_per_view=self.views_per_design)
+
+    def migrate_from(self, image_index, doc_type='image', page_size=100, chunk_size=50):
+        """
+        Copy an index with one document per image (APIOperations' layout) into this one
+
+        Signatures and words are copied as they are, nothing is rendered again. Designs are listed with
+        APIOperations.iter_designs and their images fetched page_size designs at a time, along with their
+        shape descriptors from its design catalog, if it has one.
+
+        :param image_index: name of the index to copy
+        :param doc_type: doc_type of the images in it
+        :param page_size: designs read per request
+        :param chunk_size: designs per bulk request
+        :return: dict with the numbers of designs and images copied, and the errors of designs that failed
+        """
+        self.create_index()
+        source = APIOperations(es_nodes=self.es.transport.hosts, index_name=image_index)
+        stl_id_field = source._stl_id_field(doc_type) or 'stl_id'
+        # indexes from before the catalog have no descriptors to copy
+        has_catalog = self.es.indices.exists(index=source.catalog_index)
+        view_counts = {}
+
+        def pages():
+            page = []
+            for design in source.iter_designs(page_size=page_size):
+                page.append(design)
+                if len(page) == page_size:
+                    yield page
+                    page = []
+            if page:
+                yield page
+
+        def actions():
+            for page in pages():
+                views = OrderedDict((stl_id, []) for stl_id, _ in page)
+                hits = scan(self.es, index=image_index, doc_type=doc_type,
+                            query={'query': {'terms': {stl_id_field: list(views)}},
+                                   '_source': ['stl_id', 'path', 'signature', 'simple_word_*']})
+                for hit in hits:
+                    rec = hit['_source']
+                    if rec['stl_id'] in views:
+                        views[rec['stl_id']].append(self._view(self._view_name(rec['path']), rec))
+                descriptors = source._get_descriptors(list(views)) if has_catalog else {}
+                for stl_id, design_views in views.items():
+                    if design_views:
+                        view_counts[stl_id] = len(design_views)
+                        yield self._design_action(stl_id, design_views, 'design', descriptors.get(stl_id))
+
+        result = {'designs': 0, 'indexed': 0, 'errors': []}
+        for ok, item in streaming_bulk(self.es, actions(), chunk_size=chunk_size,
+                                       raise_on_error=False, raise_on_exception=False):
+            if ok:
+                result['designs'] += 1
+                result['indexed'] += view_counts[item[list(item)[0]]['_id']]
+            else:
+                result['errors'].append(item)
+        if result['designs']:
+            self._invalidate_results()
+        return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Copy an index of image documents into one of design documents')
+    parser.add_argument('image_index', help='index with one document per image')
+    parser.add_argument('design_index', help='index to write one document per design to')
+    parser.add_argument('--es-hosts', default=environ.get('ES_HOSTS', 'localhost'))
+    parser.add_argument('--page-size', type=int, default=100, help='designs read per request')
+    args = parser.parse_args()
+
+    result = DesignOperations(es_nodes=args.es_hosts.split(','), index_name=args.design_index)\
+        .migrate_from(args.image_index, page_size=args.page_size)
+    print('{designs} designs, {indexed} images copied, {errors} errors'.format(
+        designs=result['designs'], indexed=result['indexed'], errors=len(result['errors'])))
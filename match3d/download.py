@@ -0,0 +1,91 @@
+"""Download STL files straight to disk
+
+"""
+__author__ = 'ryan'
+
+from contextlib import closing
+from multiprocessing.pool import ThreadPool
+
+import hashlib
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class DownloadError(Exception):
+    pass
+
+
+class Downloader(object):
+    def __init__(self, max_bytes=500 * 2 ** 20, timeout=(10, 60), max_seconds=600,
+                 chunk_size=2 ** 16, pool_size=10, session=None):
+        """
+        Streams downloads to disk over a pooled session, hashing them on the way
+
+        :param max_bytes: refuse files larger than this
+        :param timeout: requests timeout, (connect, read) seconds
+        :param max_seconds: give up on a download that takes longer than this altogether
+        :param chunk_size: bytes read and written at a time
+        :param pool_size: connections kept open per host
+        :param session: a requests.Session to use instead of a new one
+        """
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.max_seconds = max_seconds
+        self.chunk_size = chunk_size
+        self.session = session or requests.Session()
+        if session is None:
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+
+    def fetch(self, url, path):
+        """
+        Download url to path
+
+        :param url: the PUBLIC url of the file
+        :param path: where to write it
+        :return: (SHA-1 of the contents, the same as caching.file_digest, number of bytes)
+        """
+        deadline = time.time() + self.max_seconds if self.max_seconds else None
+        with closing(self.session.get(url, stream=True, timeout=self.timeout)) as r:
+            r.raise_for_status()
+            length = r.headers.get('Content-Length')
+            if length and self.max_bytes and int(length) > self.max_bytes:
+                raise DownloadError('{} is {} bytes, more than the {} allowed'.format(url, length, self.max_bytes))
+
+            digest = hashlib.sha1()
+            size = 0
+            with open(path, 'wb') as f:
+                for chunk in r.iter_content(self.chunk_size):
+                    size += len(chunk)
+                    if self.max_bytes and size > self.max_bytes:
+                        raise DownloadError('{} is more than the {} bytes allowed'.format(url, self.max_bytes))
+                    if deadline and time.time() > deadline:
+                        raise DownloadError('{} took more than {} seconds'.format(url, self.max_seconds))
+                    digest.update(chunk)
+                    f.write(chunk)
+        return digest.hexdigest(), size
+
+    def prefetch(self, downloads, threads=8):
+        """
+        Download many files concurrently
+
+        :param downloads: list of (url, path) pairs
+        :param threads: number of concurrent downloads
+        :return: list with (digest, size) for each download, or the exception that stopped it
+        """
+        def fetch(download):
+            try:
+                return self.fetch(*download)
+            except (IOError, OSError, DownloadError, requests.RequestException) as e:
+                return e
+
+        if not downloads:
+            return []
+        pool = ThreadPool(min(threads, len(downloads)))
+        try:
+            return pool.map(fetch, downloads)
+        finally:
+            pool.close()
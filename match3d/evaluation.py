@@ -0,0 +1,328 @@
+"""Measure how well searches find the designs they should, over a whole corpus
+
+Every query model is rendered and searched once, in a pool of worker
+processes, and the hits of each view (stl_id and distance) are appended to a
+checkpoint file as soon as the query finishes. A run that is interrupted picks
+up where it stopped when started again with the same checkpoint. The rankings
+('dist', 'tournament' and 'single') are all computed from the same hits, and
+can be recomputed from the checkpoint for any cutoff up to the one searched
+with, without rendering or querying again:
+
+* precision@k: fraction of the first k designs that are relevant
+* recall@k: fraction of the relevant designs among the first k
+* mean reciprocal rank: mean over the queries of 1 / rank of the first relevant design (0 if none)
+
+Relevance comes from a manifest with stl_id, path and family columns (like
+benchmarks/synthetic_corpus.py writes): the designs of a family are relevant
+to each other. From the command line::
+
+    python evaluation.py corpus/manifest.csv --index-name match3d --checkpoint run.jsonl --processes 8
+"""
+__author__ = 'ryan'
+
+from api_operations import APIOperations
+from caching import RenderCache
+from rasterizer import NumpyRenderer
+from three_d_match import ThreeDSearch
+from timing import Timings
+from functools import partial
+from multiprocessing import Pool
+from operator import itemgetter
+from os import environ
+from os.path import exists
+from shutil import copy, rmtree
+import argparse
+import csv
+import json
+import sys
+import tempfile
+import time
+
+RANKINGS = ('dist', 'tournament', 'single')
+
+# the operations object of a worker process, made by the factory passed to evaluate
+_operations = None
+
+
+def read_ground_truth(manifest):
+    """
+    Read the queries of an evaluation from a manifest
+
+    :param manifest: CSV file with stl_id, path and optionally family columns, with or without a header.
+        Without a family, a design is only relevant to itself
+    :return: list of (stl_id, path, set of the other stl_ids of its family) triples
+    """
+    with open(manifest) as f:
+        rows = [row for row in csv.reader(f) if row]
+    if rows and rows[0][0] == 'stl_id':
+        rows = rows[1:]
+    families = {}
+    for row in rows:
+        families.setdefault(row[2] if len(row) > 2 and row[2] else row[0], set()).add(row[0])
+    return [(row[0], row[1], families[row[2] if len(row) > 2 and row[2] else row[0]] - set([row[0]]))
+            for row in rows]
+
+
+def evaluate(queries, operations_factory, checkpoint, processes=None, ks=(1, 5, 10), rankings=RANKINGS,
+             render_options=None, progress=None):
+    """
+    Search every query and measure the rankings
+
+    :param queries: list of (query id, path of the STL file, set of relevant stl_ids) triples
+    :param operations_factory: picklable function returning the APIOperations (or ThreeDSearch) to search with,
+        e.g. functools.partial(make_operations, APIOperations, index_name='match3d'). Called once in every
+        worker process
+    :param checkpoint: file the hits of every query are appended to. Queries already in it are not searched again
+    :param processes: number of worker processes (default: one per core, 1 to search in this process)
+    :param ks: cutoffs of precision@k and recall@k
+    :param rankings: rankings to measure, from RANKINGS
+    :param render_options: generate_images options, e.g. {'rotations': True} (default: the search views)
+    :param progress: function called with (done, total, query id, error or None) as every query finishes
+    :return: the metrics, see :py:func:`metrics`
+    """
+    render_options = dict(render_options or {})
+    config = {'render_options': render_options}
+    done = set(record['query'] for record in read_checkpoint(checkpoint, config) if 'error' not in record)
+    pending = [(query_id, stl_path, render_options) for query_id, stl_path, _ in queries if query_id not in done]
+
+    started = time.time()
+    with open(checkpoint, 'a') as f:
+        if f.tell() == 0:
+            f.write(json.dumps({'config': config}) + '\n')
+        elif not _ends_with_newline(checkpoint):
+            # finish the line an interrupted run was writing, so it doesn't swallow the next record
+            f.write('\n')
+        for i, record in enumerate(_search_all(pending, operations_factory, processes)):
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            if progress:
+                progress(len(done) + i + 1, len(done) + len(pending), record['query'], record.get('error'))
+    elapsed = time.time() - started
+
+    result = metrics(read_checkpoint(checkpoint), queries, ks=ks, rankings=rankings)
+    result['throughput'] = {'queries': len(pending), 'seconds': elapsed,
+                            'queries_per_second': len(pending) / elapsed if elapsed and pending else None}
+    return result
+
+
+def _ends_with_newline(path):
+    with open(path, 'rb') as f:
+        f.seek(-1, 2)
+        return f.read(1) == b'\n'
+
+
+def _search_all(pending, operations_factory, processes):
+    if processes == 1 or len(pending) < 2:
+        _init_worker(operations_factory, in_pool=False)
+        try:
+            for args in pending:
+                yield _search_query(args)
+        finally:
+            _operations.close()
+        return
+
+    pool = Pool(processes, initializer=_init_worker, initargs=(operations_factory,))
+    try:
+        for record in pool.imap_unordered(_search_query, pending):
+            yield record
+    finally:
+        pool.terminate()
+
+
+def make_operations(operations_class, render_cache=None, **kwargs):
+    """
+    Operations for a worker process, with a render cache of its own
+
+    A RenderCache holds a lock, so it can't be pickled into the workers under the spawn start method.
+    Partials of this function only carry the cache's directory.
+
+    :param operations_class: APIOperations, local_index.LocalOperations...
+    :param render_cache: directory of a render cache (optional)
+    :param kwargs: passed on to operations_class
+    """
+    if render_cache:
+        kwargs['render_cache'] = RenderCache(render_cache)
+    return operations_class(**kwargs)
+
+
+def _init_worker(operations_factory, in_pool=True):
+    global _operations
+    _operations = operations_factory()
+    if in_pool:
+        # pool workers can't have pools of their own
+        _operations.processes = 1
+
+
+def _search_query(args):
+    query_id, stl_path, render_options = args
+    timings = Timings()
+    input_directory = tempfile.mkdtemp()
+    images_directory = None
+    try:
+        copy(stl_path, input_directory)
+        images_directory = _operations.generate_images(input_directory, timings=timings, **render_options)
+        results = _operations.search_images(images_directory, timings=timings)
+        views = _compact_views(_operations, results)
+    except Exception as e:
+        return {'query': query_id, 'error': repr(e), 'seconds': timings.summary()['total']}
+    finally:
+        rmtree(input_directory)
+        if images_directory:
+            rmtree(images_directory)
+
+    summary = timings.summary()
+    stages = {}
+    for stage in summary['stages']:
+        stages[stage['stage']] = stages.get(stage['stage'], 0) + stage['seconds']
+    return {'query': query_id, 'views': views, 'seconds': summary['total'], 'stages': stages,
+            'cutoff': _operations.ses.distance_cutoff}
+
+
+def _compact_views(operations, results):
+    # [stl_id, distance] of every hit of every view: all the rankings need
+    if isinstance(operations, APIOperations):
+        stl_ids = operations._stl_ids([hit for hits in results for hit in hits])
+        design = lambda hit: stl_ids.get(hit['id'])
+    else:
+        design = ThreeDSearch._design_key
+    return [[[design(hit), round(float(hit['dist']), 6)] for hit in hits if design(hit) is not None]
+            for hits in results]
+
+
+def read_checkpoint(checkpoint, config=None):
+    """
+    The query records of a checkpoint
+
+    :param config: refuse a checkpoint written with a different configuration (optional)
+    :return: list of dicts with the query id and either the hits of its views or an error. The latest record of
+        every query wins
+    """
+    if not exists(checkpoint):
+        return []
+    records = {}
+    with open(checkpoint) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line of an interrupted run
+                continue
+            if 'config' in record:
+                if config is not None and record['config'] != config:
+                    raise ValueError('{} was written with {}, not {}'.format(checkpoint, record['config'], config))
+                continue
+            records[record['query']] = record
+    return list(records.values())
+
+
+def rank(views, ranking, cutoff=None, exclude=None, depth=None):
+    """
+    Rank the designs found by a query's views
+
+    :param views: list of [stl_id, distance] hits of every view, as in the checkpoint
+    :param ranking: one of RANKINGS
+    :param cutoff: ignore hits this far or further (optional)
+    :param exclude: stl_id to leave out, e.g. the query itself (optional)
+    :param depth: number of winners of a tournament (default: all)
+    :return: list of stl_ids, best first
+    """
+    results = [[{'stl_id': stl_id, 'dist': dist} for stl_id, dist in hits
+                if (cutoff is None or dist < cutoff) and stl_id != exclude]
+               for hits in views]
+    key = itemgetter('stl_id')
+    if ranking == 'dist':
+        scores = ThreeDSearch.composite_score(results, key=key)
+    elif ranking == 'tournament':
+        scores = ThreeDSearch.tournament_score(results, max_matches=depth, key=key)
+    elif ranking == 'single':
+        scores = ThreeDSearch.best_single_image(results, key=key)
+    else:
+        raise ValueError('unknown ranking: {}'.format(ranking))
+    return [stl_id for stl_id, _ in sorted(scores.items(), key=lambda item: (item[1], item[0]))]
+
+
+def metrics(records, queries, ks=(1, 5, 10), rankings=RANKINGS, cutoff=None, exclude_self=True):
+    """
+    Precision@k, recall@k and mean reciprocal rank of every ranking
+
+    :param records: query records, from read_checkpoint
+    :param queries: list of (query id, path, set of relevant stl_ids) triples
+    :param cutoff: only count hits closer than this; no more than the cutoff searched with (optional)
+    :param exclude_self: leave the query's own design out of its ranking, if it is in the index
+    :return: dict with, for every ranking, a dict of 'precision@k', 'recall@k' and 'mrr', plus the numbers of
+        queries measured, skipped (nothing relevant to find) and failed
+    """
+    relevant = dict((query_id, set(stl_ids)) for query_id, _, stl_ids in queries)
+    records = [record for record in records if record['query'] in relevant]
+    searched_cutoff = min([record['cutoff'] for record in records if 'cutoff' in record] or [None])
+    if cutoff is not None and searched_cutoff is not None and cutoff > searched_cutoff:
+        raise ValueError('searched with cutoff {}, so hits at {} are missing'.format(searched_cutoff, cutoff))
+
+    measured = [record for record in records if 'error' not in record and relevant[record['query']]]
+    result = {'queries': len(measured),
+              'skipped': len([record for record in records if 'error' not in record and not relevant[record['query']]]),
+              'failed': len([record for record in records if 'error' in record])}
+    for ranking in rankings:
+        sums = dict.fromkeys(['mrr'] + ['precision@{}'.format(k) for k in ks] + ['recall@{}'.format(k) for k in ks], 0.)
+        for record in measured:
+            ranked = rank(record['views'], ranking, cutoff, record['query'] if exclude_self else None, max(ks))
+            wanted = relevant[record['query']]
+            for k in ks:
+                found = len(wanted.intersection(ranked[:k]))
+                sums['precision@{}'.format(k)] += found / float(k)
+                sums['recall@{}'.format(k)] += found / float(len(wanted))
+            for position, stl_id in enumerate(ranked):
+                if stl_id in wanted:
+                    sums['mrr'] += 1. / (position + 1)
+                    break
+        result[ranking] = dict((name, total / len(measured) if measured else None) for name, total in sums.items())
+
+    seconds = [record['seconds'] for record in records if 'error' not in record]
+    result['seconds_per_query'] = sum(seconds) / len(seconds) if seconds else None
+    return result
+
+
+def print_progress(done, total, query_id, error):
+    sys.stderr.write('[{}/{}] {}{}\n'.format(done, total, query_id, ' FAILED: ' + error if error else ''))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure search rankings over a corpus, resumably')
+    parser.add_argument('manifest', help='CSV of stl_id, path and family of the queries')
+    parser.add_argument('--checkpoint', required=True, help='file to record progress in, and resume from')
+    parser.add_argument('--index-name', default='match3d')
+    parser.add_argument('--es-hosts', default=environ.get('ES_HOSTS', 'localhost'))
+    parser.add_argument('--local-index', help='directory of a local_index.LocalOperations index instead')
+    parser.add_argument('--cutoff', type=float, default=0.5, help='cutoff to search with')
+    parser.add_argument('--measure-cutoffs', type=float, nargs='+', help='also measure these (smaller) cutoffs')
+    parser.add_argument('--render-backend', default='blender', choices=['blender', 'numpy'])
+    parser.add_argument('--resolution', type=int, help='resolution of the numpy backend')
+    parser.add_argument('--render-cache', help='directory of a render cache, so queries render once across runs')
+    parser.add_argument('--all-views', action='store_true', help='search with all 48 views instead of 3')
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--k', type=int, nargs='+', default=[1, 5, 10])
+    args = parser.parse_args()
+
+    options = {'cutoff': args.cutoff, 'render_backend': args.render_backend}
+    if args.render_backend == 'numpy' and args.resolution:
+        options['render_backend'] = NumpyRenderer(resolution=args.resolution)
+    if args.local_index:
+        from local_index import LocalOperations
+        factory = partial(make_operations, LocalOperations, directory=args.local_index,
+                          render_cache=args.render_cache, **options)
+    else:
+        factory = partial(make_operations, APIOperations, es_nodes=args.es_hosts.split(','),
+                          index_name=args.index_name, render_cache=args.render_cache, **options)
+    render_options = {'rotations': True, 'front_and_back': True, 'reflections': True} if args.all_views else {}
+
+    queries = read_ground_truth(args.manifest)
+    result = evaluate(queries, factory, args.checkpoint, processes=args.processes, ks=args.k,
+                      render_options=render_options, progress=print_progress)
+    results = {'cutoff {}'.format(args.cutoff): result}
+    for cutoff in args.measure_cutoffs or []:
+        results['cutoff {}'.format(cutoff)] = metrics(read_checkpoint(args.checkpoint), queries, ks=args.k,
+                                                      cutoff=cutoff)
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
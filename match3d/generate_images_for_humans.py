@@ -7,10 +7,10 @@ sys.path.append('.')
 sys.path.append('./hidden_PIL/')
 
 from blenderbase import BlenderBase
+from report import report_writer, report_progress, read_file_list
 
-from os import walk, remove, mkdir
+from os import walk, mkdir
 from os.path import join, abspath, sep
-from shutil import rmtree
 
 # Note: Be sure to use a version of PIL that works with Python 3
 # (which is the version of Python that Blender uses)
@@ -18,7 +18,8 @@ from PIL import Image, ImageFont, ImageDraw
 
 from math import cos, sin, sqrt, floor
 import argparse
-import tempfile
+
+import numpy as np
 
 
 class ImagesBuilder(BlenderBase):
@@ -27,12 +28,21 @@ class ImagesBuilder(BlenderBase):
         self.target_dir = abspath(args['target-directory'])
         self.output_dir = abspath(args['output-directory'])
         self.custom_name = args.get('custom_name')
+        # render only the STL files listed in this file, and write a report (see render_driver.py)
+        self.file_list = args.get('file_list')
+        self.report_path = args.get('report')
         # Set subimage resolution = the width of the smaller squares
         # in the 3x3 grid. The width of the final image will be
         # three times the subimage resolution.
         self.sub_res = 116
         super(ImagesBuilder, self).__init__(self.sub_res)
 
+        # everything that is the same for every model is set up once
+        self._set_background_colors('white')
+        self._use_viewer_node()
+        self.camera_positions = self._camera_positions()
+        self.font = ImageFont.truetype("DroidSansMono.ttf", 10)
+
         # initialize the directory structure
         try:
             mkdir(self.output_dir)
@@ -44,8 +54,29 @@ class ImagesBuilder(BlenderBase):
                 raise e
 
     def run(self):
-        for stl_name in self._get_filesnames_of_type(self.target_dir):
-            self.generate_image(stl_name)
+        if self.file_list:
+            stl_names = read_file_list(self.file_list)
+        else:
+            stl_names = self._get_filesnames_of_type(self.target_dir)
+
+        report_file = open(self.report_path, 'w') if self.report_path else None
+        try:
+            for stl_name in stl_names:
+                # one bad model shouldn't stop the rest
+                try:
+                    final_img_path = self.generate_image(stl_name)
+                except Exception as e:
+                    report_progress(stl_name, error=repr(e))
+                    continue
+                if report_file:
+                    report_writer(report_file).writerow({'id': final_img_path.rsplit(sep, 1)[-1],
+                                                         'image_filename': final_img_path,
+                                                         'stl_filename': stl_name})
+                    report_file.flush()
+                report_progress(stl_name)
+        finally:
+            if report_file:
+                report_file.close()
 
     def generate_image(self, stl_name):
         self._clear_scene()
@@ -53,54 +84,24 @@ class ImagesBuilder(BlenderBase):
         self._center_object(obj)
         self._scale_object(obj)
         self._set_tracking(obj)
-        self._set_background_colors('white')
 
+        # Composite the 3x3 grid in memory, straight from the rendered pixels.
+        # Note that rows run from top to bottom, as in PIL.
         side_len = 3 * self.sub_res  # 3 x subimage resolution
-        final_img = Image.new('RGB', (side_len, side_len))
-
-        # Variables associated with generating the points on the sphere
-        # https://stackoverflow.com/questions/9600801/evenly-distributing-n-points-on-a-sphere
-        numpoints = 9
-        dlon = 2.399963230  # radians
-        dz = 2.0/numpoints
-        lon = 0.0
-        z = 1.0 - dz/2.0
-        cam_dist = 5.0
-
-        for y_index in range(3):
-            for x_index in range(3):
-                # Compute the camera position
-                r = sqrt(1.0 - z*z)
-                x_cam = cam_dist * r * cos(lon)
-                y_cam = cam_dist * r * sin(lon)
-                z_cam = cam_dist * z
-                camera_pos = (x_cam, y_cam, z_cam)
-
-                # Set the camera and lamp positions
-                self.scene.camera.location = camera_pos
-                self.scene.objects['Lamp'].location = camera_pos
-
-                # Render the view to a temp file
-                temp_dir = tempfile.mkdtemp()
-                temp_path = join(temp_dir, 'temp.png')
-                self._render_scene(temp_path)
-
-                # Open the just-written temp image file using PIL
-                temp_img = Image.open(temp_path)
-
-                # Paste the temp image into the final image.
-                # Note that in PIL, x increases from left to right
-                # and y increases from top to bottom.
-                paste_x = x_index * self.sub_res
-                paste_y = y_index * self.sub_res
-                final_img.paste(temp_img, (paste_x, paste_y))
-
-                # Delete the temp image file
-                rmtree(temp_dir)
-
-                # Update variables used to calculate the camera position
-                z = z - dz
-                lon = lon + dlon
+        sheet = np.zeros((side_len, side_len, 3), dtype=np.uint8)
+        for i, camera_pos in enumerate(self.camera_positions):
+            # Set the camera and lamp positions
+            self.scene.camera.location = camera_pos
+            self.scene.objects['Lamp'].location = camera_pos
+
+            y_index, x_index = divmod(i, 3)
+            tile = np.round(255 * self._render_pixels()).astype(np.uint8)
+            if tile.shape[:2] != (self.sub_res, self.sub_res):
+                # the viewer image needn't be sub_res square (resolution percentage, HiDPI); scale the whole view
+                tile = np.asarray(Image.fromarray(tile, 'RGB').resize((self.sub_res, self.sub_res), Image.BILINEAR))
+            sheet[y_index * self.sub_res:(y_index + 1) * self.sub_res,
+                  x_index * self.sub_res:(x_index + 1) * self.sub_res] = tile
+        final_img = Image.fromarray(sheet, 'RGB')
 
         if self.custom_name is None:
             # Get the name of the parent directory = object ID
@@ -110,17 +111,33 @@ class ImagesBuilder(BlenderBase):
 
         # Add a text label to the image
         draw = ImageDraw.Draw(final_img)
-        font1 = ImageFont.truetype("DroidSansMono.ttf", 10)
         textwidth, textheight = draw.textsize(parent_dir_name)
         x_pos = floor(((3 * self.sub_res) - textwidth)/2)
         y_pos = (3 * self.sub_res) - textheight - 1
-        draw.text((x_pos, y_pos), parent_dir_name, (30, 30, 30), font=font1)
+        draw.text((x_pos, y_pos), parent_dir_name, (30, 30, 30), font=self.font)
 
         # Save the final image to the output directory.
         # Name the image file after its parent directory.
         final_img_fname = parent_dir_name + '.png'
         final_img_path = abspath(join(self.output_dir, final_img_fname))
         final_img.save(final_img_path)
+        return final_img_path
+
+    @staticmethod
+    def _camera_positions(numpoints=9, cam_dist=5.0):
+        # Points evenly spread on a sphere
+        # https://stackoverflow.com/questions/9600801/evenly-distributing-n-points-on-a-sphere
+        dlon = 2.399963230  # radians
+        dz = 2.0/numpoints
+        lon = 0.0
+        z = 1.0 - dz/2.0
+        positions = []
+        for _ in range(numpoints):
+            r = sqrt(1.0 - z*z)
+            positions.append((cam_dist * r * cos(lon), cam_dist * r * sin(lon), cam_dist * z))
+            z = z - dz
+            lon = lon + dlon
+        return positions
 
     @staticmethod
     def _get_filesnames_of_type(directory, filetypes=['stl'], ignore_path=''):
@@ -149,6 +166,8 @@ parser.add_argument('output-directory', metavar='o',
                     type=str,
                     help='directory where images will be written')
 parser.add_argument('--custom-name', type=str, help='override default name')
+parser.add_argument('--file-list', dest='file_list', help='file listing the STL files to render, one per line')
+parser.add_argument('--report', help='write a report CSV of the images to this file')
 
 
 # get the script args and run
@@ -0,0 +1,37 @@
+"""Mesh geometry in plain numpy
+
+Used by the blender scripts as well as the Python side, so nothing in here may
+import bpy or mathutils.
+"""
+__author__ = 'ryan'
+
+import numpy as np
+
+
+def inertia_matrix(areas, centroids):
+    """
+    Moment of inertia matrix of a mesh treated as a hollow shell
+
+    Every face is a point mass at its centroid, with mass equal to its area (the
+    same assumptions Blender uses when calculating the center of mass).
+
+    :param areas: face areas, shape (n,)
+    :param centroids: face centroids relative to the center of mass, shape (n, 3) or flat (3n,)
+    :return: 3x3 inertia matrix
+    """
+    # see http://en.wikipedia.org/wiki/Moment_of_inertia
+    # sum of -area * [c]^2 over faces, where [c]^2 = c c^T - |c|^2 I for the cross product matrix [c]
+    areas = np.asarray(areas, dtype=np.float64)
+    centroids = np.asarray(centroids, dtype=np.float64).reshape(-1, 3)
+    weighted = centroids * areas[:, np.newaxis]
+    return np.einsum('ij,ij->', weighted, centroids) * np.eye(3) - weighted.T.dot(centroids)
+
+
+def max_vertex_norm(coordinates):
+    """
+    Distance of the furthest vertex from the origin
+
+    :param coordinates: vertex coordinates, shape (n, 3) or flat (3n,)
+    """
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 3)
+    return np.sqrt(np.einsum('ij,ij->i', coordinates, coordinates).max())
@@ -8,23 +8,34 @@ __author__ = 'ryan'
 import sys
 sys.path.append('.')
 from blenderbase import BlenderBase
+from geometry import inertia_matrix
+from views import RENDER_DEFAULTS, view_filename, transform_view, ViewDeduplicator
+from report import REPORT_FILENAME, report_writer, report_progress, read_file_list
 from mathutils import Matrix, Vector    # blender-specific classes
 
-from functools import reduce
 from itertools import product
-from operator import add
-from os import mkdir, walk
+from os import mkdir, remove, walk
 from hashlib import md5
 from os.path import join, abspath, basename
 from numpy.linalg import eig
 
 import numpy as np
 import argparse
-import csv
+import time
 
 
 class ImagesBuilder(BlenderBase):
     def __init__(self, args):
+        super(ImagesBuilder, self).__init__(args.get('resolution') or RENDER_DEFAULTS['resolution'])
+        self.scene.objects['Lamp'].location = 5 * Vector([1, 0, 0])
+        self.configure(args)
+
+    def configure(self, args):
+        """Set the directories and view options for the next call to run
+
+        Kept apart from __init__ so a long-lived blender process (see render_worker.py)
+        can render many jobs without setting up the scene again.
+        """
         self.output_dir = abspath(args['output-directory'])
         self.target_dir = abspath(args['target-directory'])
         resolution = args.get('resolution')
@@ -34,11 +45,22 @@ class ImagesBuilder(BlenderBase):
         self.front_and_back = args.get('front_and_back')
         if self.front_and_back is None:
             self.front_and_back = True
+        self.reflections = args.get('reflections')
+        if self.reflections is None:
+            self.reflections = True
+        self.image_transforms = args.get('image_transforms')
+        if self.image_transforms is None:
+            self.image_transforms = RENDER_DEFAULTS['image_transforms']
         self.octahedral = args.get('octahedral')
+        self.dedupe = args.get('dedupe')
+        if self.dedupe is None:
+            self.dedupe = RENDER_DEFAULTS['dedupe']
+        # render only the STL files listed in this file, and write the report here (see render_driver.py)
+        self.file_list = args.get('file_list')
+        self.report_path = abspath(args.get('report') or join(self.output_dir, REPORT_FILENAME))
         if not resolution:
-            resolution = 1024
-        super(ImagesBuilder, self).__init__(resolution)
-        self.scene.objects['Lamp'].location = 5 * Vector([1, 0, 0])
+            resolution = RENDER_DEFAULTS['resolution']
+        self._set_resolution(resolution)
 
         # initialize the directory structure
         try:
@@ -51,14 +73,39 @@ class ImagesBuilder(BlenderBase):
                 raise e
 
     def run(self):
-        with open(join(self.output_dir, 'image_match_generator_report.csv'), 'w') as report_file:
-            for stl_name in self._get_filesnames_of_type(self.target_dir):
-                self.generate_images(stl_name,
-                                     report_file=report_file,
-                                     rotations=self.all_rotations,
-                                     front_and_back=self.front_and_back)
-
-    def generate_images(self, stl_name, report_file=None, rotations=True, front_and_back=True, octahedral=False):
+        """
+        Render every STL file, carrying on past the ones that fail
+
+        :return: list of (STL file, error) pairs of the files that failed
+        """
+        if self.file_list:
+            stl_names = read_file_list(self.file_list)
+        else:
+            stl_names = self._get_filesnames_of_type(self.target_dir)
+
+        failures = []
+        with open(self.report_path, 'w') as report_file:
+            for stl_name in stl_names:
+                try:
+                    self.generate_images(stl_name,
+                                         report_file=report_file,
+                                         rotations=self.all_rotations,
+                                         front_and_back=self.front_and_back,
+                                         reflections=self.reflections,
+                                         image_transforms=self.image_transforms,
+                                         dedupe=self.dedupe)
+                except Exception as e:
+                    failures.append((stl_name, repr(e)))
+                    report_progress(stl_name, error=repr(e))
+                else:
+                    report_progress(stl_name)
+                # so the rows of finished models survive blender crashing on a later one
+                report_file.flush()
+        return failures
+
+    def generate_images(self, stl_name, report_file=None, rotations=True, front_and_back=True,
+                        reflections=True, image_transforms=True, octahedral=False, dedupe=True):
+        started = time.time()
         self._clear_scene()
         obj = self._load_stl(stl_name)
         self._center_object(obj)
@@ -77,9 +124,20 @@ class ImagesBuilder(BlenderBase):
         evals, evecs = eig(Ic)
         evecs = evecs.T
 
-        if report_file:
-            report_writer = csv.DictWriter(report_file,
-                                           fieldnames=['id', 'image_filename', 'stl_filename'])
+        writer = report_writer(report_file) if report_file else None
+        # timings and mesh size for the report; every view is charged the time since the previous one
+        self._model_stats = {'model_seconds': time.time() - started,
+                             'faces': len(faces),
+                             'vertices': len(obj.data.vertices)}
+        self._lap = time.time()
+
+        stl_hash = md5(stl_name.encode('utf-8')).hexdigest()
+        sides = ['front', 'back'] if front_and_back else ['front']
+        n_rotations = 4 if rotations else 1
+        mirrors = [0, 1] if reflections else [0]
+
+        # views that look just like an earlier one (symmetric models) aren't written, only reported
+        dedupe = ViewDeduplicator(evals) if dedupe else None
 
         for eig_vec_num in range(3):
             # cycle through possible orientations by rolling columns
@@ -89,29 +147,49 @@ class ImagesBuilder(BlenderBase):
             # rotate object to principal axes
             obj.data.transform(transform_matrix)
 
-            # render for +/- each eigenvector and include every 90deg rotation
-            for i, radian in enumerate(2 * np.pi * np.arange(4) / 4.0):
-                obj.data.transform(Matrix.Rotation(radian, 4, [1, 0, 0]))
-                self.scene.objects['Lamp'].location = 5 * Vector([1, 0, 0])
-                self.scene.camera.location = 5 * Vector([1, 0, 0])
-                path = '{}.{}.{}.front.png'.format(md5(stl_name.encode('utf-8')).hexdigest(), eig_vec_num, i)
-                self._render_scene(join(self.output_dir, path))
-                if report_file:
-                    report_writer.writerow({'id': path, 'image_filename': abspath(join(self.output_dir, path)), 'stl_filename': stl_name})
-                if not front_and_back:
-                    if not rotations:
-                        break
-                    else:
+            if image_transforms:
+                # The camera looks down the x axis at an orthographic projection with z up, and the lamp
+                # sits on the camera, so turning the object about x only turns the image, and mirroring z
+                # only flips it upside down. One render per side is enough; the rest are pixel operations.
+                for side in sides:
+                    self._set_view(side)
+                    rendered = view_filename(stl_hash, eig_vec_num, 0, side, 0)
+                    self._render_scene(join(self.output_dir, rendered))
+                    if n_rotations == 1 and not reflections and not dedupe:
+                        self._report(writer, rendered, stl_name)
                         continue
-                self.scene.objects['Lamp'].location = 5 * Vector([-1, 0, 0])
-                self.scene.camera.location = 5 * Vector([-1, 0, 0])
-                path = '{}.{}.{}.back.png'.format(md5(stl_name.encode('utf-8')).hexdigest(), eig_vec_num, i)
-                self._render_scene(join(self.output_dir, path))
-                if report_file:
-                    report_writer.writerow({'id': path, 'image_filename': abspath(join(self.output_dir, path)), 'stl_filename': stl_name})
-                obj.data.transform(Matrix.Rotation(-radian, 4, [1, 0, 0]))
-                if not rotations:
-                    break
+                    pixels = self._load_pixels(join(self.output_dir, rendered))
+                    for i, reflected in product(range(n_rotations), mirrors):
+                        path = view_filename(stl_hash, eig_vec_num, i, side, reflected)
+                        view = transform_view(pixels, i, reflected, side)
+                        canonical = dedupe.canonical(path, eig_vec_num, view) if dedupe else None
+                        if path == rendered:
+                            if canonical:
+                                remove(join(self.output_dir, path))
+                        elif not canonical:
+                            self._save_pixels(view, join(self.output_dir, path))
+                        self._report(writer, path, stl_name, canonical)
+            else:
+                # render every view, rotating and reflecting the object itself
+                for i, radian in enumerate(2 * np.pi * np.arange(n_rotations) / 4.0):
+                    obj.data.transform(Matrix.Rotation(radian, 4, [1, 0, 0]))
+                    for reflected in mirrors:
+                        if reflected:
+                            obj.data.transform(Matrix.Scale(-1, 4, [0, 0, 1]))
+                        for side in sides:
+                            self._set_view(side)
+                            path = view_filename(stl_hash, eig_vec_num, i, side, reflected)
+                            self._render_scene(join(self.output_dir, path))
+                            canonical = None
+                            if dedupe:
+                                canonical = dedupe.canonical(path, eig_vec_num,
+                                                             self._load_pixels(join(self.output_dir, path)))
+                                if canonical:
+                                    remove(join(self.output_dir, path))
+                            self._report(writer, path, stl_name, canonical)
+                        if reflected:
+                            obj.data.transform(Matrix.Scale(-1, 4, [0, 0, 1]))
+                    obj.data.transform(Matrix.Rotation(-radian, 4, [1, 0, 0]))
 
             # rotate back
             transform_matrix.invert()
@@ -127,10 +205,27 @@ class ImagesBuilder(BlenderBase):
                     obj.data.transform(Matrix.Rotation(radian, 4, axis))
                     path = '{}.{}.{}.oct.png'.format(md5(stl_name.encode('utf-8')).hexdigest(), i, j)
                     self._render_scene(join(self.output_dir, path))
-                    if report_file:
-                        report_writer.writerow({'id': path, 'image_filename': abspath(join(self.output_dir, path)), 'stl_filename': stl_name})
+                    self._report(writer, path, stl_name)
                     obj.data.transform(Matrix.Rotation(-radian, 4, axis))
 
+    def _set_view(self, side):
+        # put the camera and lamp on the +x (front) or -x (back) end of the principal axis
+        direction = 5 * Vector([1, 0, 0]) if side == 'front' else 5 * Vector([-1, 0, 0])
+        self.scene.objects['Lamp'].location = direction
+        self.scene.camera.location = direction
+
+    def _report(self, writer, path, stl_name, canonical=None):
+        now = time.time()
+        row = dict(self._model_stats, seconds=now - self._lap)
+        self._lap = now
+        if writer and canonical:
+            # skipped as a duplicate of the view canonical
+            row.update({'id': path, 'image_filename': '', 'stl_filename': stl_name, 'canonical_id': canonical})
+            writer.writerow(row)
+        elif writer:
+            row.update({'id': path, 'image_filename': abspath(join(self.output_dir, path)), 'stl_filename': stl_name})
+            writer.writerow(row)
+
     @staticmethod
     def _octahedral_directions(evecs):
         s = product(*zip(evecs, -evecs))  # lol unreadable python magic
@@ -150,47 +245,49 @@ class ImagesBuilder(BlenderBase):
                     yield abspath(join(t[0], filename))
 
     @staticmethod
-    def _bracketB(v):
-        return Matrix([[    0, -v[2], v[1]],
-                        [v[2],    0, -v[0]],
-                        [-v[1], v[0],   0]])
-
-    @staticmethod
-    def _matrix_square(M):
-        # dot product is defined for blender Matrix class, but not power
-        return M * M
-
-    @classmethod
-    def _inertia_matrix(cls, faces):
+    def _inertia_matrix(faces):
         # see http://en.wikipedia.org/wiki/Moment_of_inertia
         # and https://www.blender.org/api/blender_python_api_2_74_release/bpy.types.MeshPolygon.html
-        return reduce(add, map(lambda f: -1 * f.area * cls._matrix_square(cls._bracketB(f.center)), faces))
-
+        # pull every face area and centroid out in one go instead of visiting the faces one by one
+        areas = np.empty(len(faces), dtype=np.float32)
+        centers = np.empty(3 * len(faces), dtype=np.float32)
+        faces.foreach_get('area', areas)
+        faces.foreach_get('center', centers)
+        return inertia_matrix(areas, centers)
 
 
-parser = argparse.ArgumentParser(description='Generate oriented images for image matching')
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate oriented images for image matching')
 
-# handle incoming blender args
-_, all_arguments = parser.parse_known_args()
-double_dash_index = all_arguments.index('--')
-script_args = all_arguments[double_dash_index + 1:]
+    # handle incoming blender args
+    _, all_arguments = parser.parse_known_args()
+    double_dash_index = all_arguments.index('--')
+    script_args = all_arguments[double_dash_index + 1:]
 
-# define our args
-parser.add_argument('target-directory', metavar='d', type=str, help='directory containing STL files')
-parser.add_argument('output-directory', metavar='o', type=str, help='directory where to put images')
+    # define our args
+    parser.add_argument('target-directory', metavar='d', type=str, help='directory containing STL files')
+    parser.add_argument('output-directory', metavar='o', type=str, help='directory where to put images')
 
-parser.add_argument('--resolution', type=int, help='resolution of renderings (n x n)')
-parser.add_argument('--no-rotations', dest='all_rotations', help='do not generate rotations', action='store_false')
-parser.add_argument('--only-front-view', dest='front_and_back', help='only generate front views', action='store_false')
-parser.add_argument('--octahedral-views', dest='octahedral', help='more views', action='store_true')
-parser.set_defaults(all_rotations=True)
-parser.set_defaults(front_and_back=True)
-parser.set_defaults(octahedral=False)
+    parser.add_argument('--resolution', type=int, help='resolution of renderings (n x n)')
+    parser.add_argument('--no-rotations', dest='all_rotations', help='do not generate rotations', action='store_false')
+    parser.add_argument('--only-front-view', dest='front_and_back', help='only generate front views', action='store_false')
+    parser.add_argument('--no-reflections', dest='reflections', help='do not generate reflections', action='store_false')
+    parser.add_argument('--no-image-transforms', dest='image_transforms', help='generate all images by rendering', action='store_false')
+    parser.add_argument('--octahedral-views', dest='octahedral', help='more views', action='store_true')
+    parser.add_argument('--keep-duplicate-views', dest='dedupe', help='write views of symmetric models that look the same as another view', action='store_false')
+    parser.add_argument('--file-list', dest='file_list', help='file listing the STL files to render, one per line')
+    parser.add_argument('--report', help='where to write the report (default: in the output directory)')
+    parser.set_defaults(all_rotations=True)
+    parser.set_defaults(front_and_back=True)
+    parser.set_defaults(reflections=True)
+    parser.set_defaults(image_transforms=RENDER_DEFAULTS['image_transforms'])
+    parser.set_defaults(octahedral=False)
+    parser.set_defaults(dedupe=RENDER_DEFAULTS['dedupe'])
 
-# get the script args
-parsed_script_args, _ = parser.parse_known_args(script_args)
+    # get the script args
+    parsed_script_args, _ = parser.parse_known_args(script_args)
 
-# fire awaaay
-args = vars(parsed_script_args)
-trainer = ImagesBuilder(args)
-trainer.run()
\ No newline at end of file
+    # fire awaaay
+    args = vars(parsed_script_args)
+    trainer = ImagesBuilder(args)
+    trainer.run()
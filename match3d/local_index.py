@@ -0,0 +1,421 @@
+"""Signature index in local numpy files, for running without elasticsearch
+
+:py:class:`SignatureIndex` is an image_match signature database like
+``SignatureES``, so it can be handed to :py:class:`ThreeDSearch` in its place.
+Records are kept in immutable segments, each a directory of ``.npy`` files
+that are memory-mapped when the index is opened:
+
+* ``keys.npy``: the words of every record as ``position << 32 | word``, sorted -- the inverted index
+* ``postings.npy``: the row of every key
+* ``signatures.npy``: the signatures, one int8 row per record
+* ``entries.json``: id, path and metadata of every row
+* ``live.npy``: False for rows deleted or replaced since
+
+Searching looks every word of a record up in the inverted index with one
+``searchsorted``, counts the words each row shares with it, and computes the
+distances of the ``size`` rows sharing the most words in one go. Writes are
+buffered until :py:meth:`SignatureIndex.flush`, which adds a segment; segments
+are merged once there are more than ``max_segments``.
+
+:py:class:`LocalOperations` is :py:class:`APIOperations` on top of a
+SignatureIndex, with the design catalog in a JSON file next to it. Both lock
+their state, so the threads of one process can add and search at once, but an
+index is meant to be opened by one process at a time.
+"""
+__author__ = 'ryan'
+
+from api_operations import APIOperations
+from image_match.signature_database_base import SignatureDatabaseBase, normalized_distance
+from operator import itemgetter
+from os import listdir, makedirs, rename
+from os.path import abspath, basename, exists, expanduser, join
+from shutil import rmtree
+from uuid import uuid4
+
+import json
+import threading
+
+import numpy as np
+
+MANIFEST_FILENAME = 'index.json'
+WORD_BITS = 32
+
+
+def _write_json(path, value):
+    staging = path + '.tmp'
+    with open(staging, 'w') as f:
+        json.dump(value, f)
+    rename(staging, path)
+
+
+class _Segment(object):
+    def __init__(self, keys, postings, signatures, entries, live, directory=None):
+        self.keys = keys
+        self.postings = postings
+        self.signatures = signatures
+        self.entries = entries
+        self.live = live
+        self.directory = directory
+        self._stl_ids = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def build(cls, words, signatures, entries):
+        """
+        :param words: array of shape (n, N) of the words of every record
+        :param signatures: array of shape (n, m)
+        :param entries: list of n dicts with id, path and metadata
+        """
+        words = np.asarray(words, dtype=np.int64).reshape(len(entries), -1)
+        keys = (np.arange(words.shape[1], dtype=np.int64) << WORD_BITS) + words
+        order = np.argsort(keys, axis=None, kind='mergesort')
+        return cls(keys.ravel()[order], (order // words.shape[1]).astype(np.int32),
+                   np.asarray(signatures, dtype=np.int8).reshape(len(entries), -1),
+                   entries, np.ones(len(entries), dtype=bool))
+
+    @classmethod
+    def load(cls, directory):
+        def array(name):
+            return np.load(join(directory, name + '.npy'), mmap_mode='r')
+        with open(join(directory, 'entries.json')) as f:
+            entries = json.load(f)
+        return cls(array('keys'), array('postings'), array('signatures'), entries,
+                   np.array(array('live')), directory)
+
+    def save(self, directory):
+        staging = directory + '.tmp'
+        makedirs(staging)
+        for name in ('keys', 'postings', 'signatures', 'live'):
+            np.save(join(staging, name + '.npy'), getattr(self, name))
+        with open(join(staging, 'entries.json'), 'w') as f:
+            json.dump(self.entries, f)
+        rename(staging, directory)
+        self.directory = directory
+
+    def save_live(self):
+        if self.directory:
+            np.save(join(self.directory, 'live.npy'), self.live)
+
+    def words(self):
+        """The words of every row, shape (n, N)"""
+        n_words = len(self.keys) // max(len(self), 1)
+        words = np.empty((len(self), n_words), dtype=np.int64)
+        words[self.postings, np.asarray(self.keys) >> WORD_BITS] = np.asarray(self.keys) & (2 ** WORD_BITS - 1)
+        return words
+
+    def matches(self, words):
+        """
+        Number of words every row shares with a record
+
+        :param words: the record's words, shape (N,)
+        :return: (rows, counts) of the live rows sharing at least one word
+        """
+        query = (np.arange(len(words), dtype=np.int64) << WORD_BITS) + words
+        starts = np.searchsorted(self.keys, query, side='left')
+        ends = np.searchsorted(self.keys, query, side='right')
+        if not (ends > starts).any():
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        rows = np.concatenate([self.postings[start:end] for start, end in zip(starts, ends) if end > start])
+        counts = np.bincount(rows, minlength=len(self))
+        counts[~self.live] = 0
+        rows = np.flatnonzero(counts)
+        return rows, counts[rows]
+
+    def stl_ids(self):
+        """The stl_id in the metadata of every row, '' for rows without one"""
+        if self._stl_ids is None:
+            self._stl_ids = np.array([(entry['metadata'] or {}).get('stl_id') or '' for entry in self.entries],
+                                     dtype=np.str_)
+        return self._stl_ids
+
+
+class SignatureIndex(SignatureDatabaseBase):
+    def __init__(self, directory=None, size=100, max_segments=10, *args, **kwargs):
+        """
+        image_match signature database in memory-mapped numpy arrays
+
+        :param directory: where the index is stored. Without one, it only lives in memory
+        :param size: maximum number of results per record, like SignatureES
+        :param max_segments: merge the segments when there are more than this
+        :param args: passed on to SignatureDatabaseBase (k, N, n_grid, crop_percentile, distance_cutoff...)
+        """
+        super(SignatureIndex, self).__init__(*args, **kwargs)
+        self.directory = abspath(expanduser(directory)) if directory else None
+        self.index = self.directory
+        self.size = size
+        self.max_segments = max_segments
+        self.segments = []
+        self._pending = []
+        self._locations = {}
+        self._next_segment = 0
+        # searches flush, and a flush can merge segments and remove their files, so threads take turns
+        self._lock = threading.RLock()
+        if self.directory:
+            self._open()
+
+    def _open(self):
+        manifest_path = join(self.directory, MANIFEST_FILENAME)
+        if not exists(manifest_path):
+            if not exists(self.directory):
+                makedirs(self.directory)
+            self._save_manifest()
+            return
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if (manifest['k'], manifest['N']) != (self.k, self.N):
+            raise ValueError('index at {} has k={k}, N={N}'.format(self.directory, **manifest))
+        self._next_segment = manifest['next_segment']
+        for name in manifest['segments']:
+            self._add_segment(_Segment.load(join(self.directory, 'segments', name)))
+
+        # leftovers of an interrupted flush or merge
+        for name in listdir(join(self.directory, 'segments')):
+            if name not in manifest['segments']:
+                rmtree(join(self.directory, 'segments', name))
+
+    def _save_manifest(self):
+        segments = [basename(segment.directory) for segment in self.segments]
+        if not exists(join(self.directory, 'segments')):
+            makedirs(join(self.directory, 'segments'))
+        _write_json(join(self.directory, MANIFEST_FILENAME),
+                    {'k': self.k, 'N': self.N, 'segments': segments, 'next_segment': self._next_segment})
+
+    def _add_segment(self, segment):
+        number = len(self.segments)
+        self.segments.append(segment)
+        for row, entry in enumerate(segment.entries):
+            if segment.live[row]:
+                self._delete(entry['id'])
+                self._locations[entry['id']] = (number, row)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._locations) + len(self._pending)
+
+    def insert_single_record(self, rec, refresh_after=False):
+        self.insert_records([rec])
+        if refresh_after:
+            self.flush()
+
+    def insert_records(self, records, ids=None):
+        """
+        Add records, replacing any with the same ids. They are searchable after the next flush
+
+        :param records: image_match records
+        :param ids: an id for every record (random if not given)
+        """
+        with self._lock:
+            for i, rec in enumerate(records):
+                self._pending.append((ids[i] if ids else uuid4().hex, rec))
+
+    def delete(self, ids):
+        """Remove records"""
+        with self._lock:
+            self.flush()
+            changed = set(self._delete(record_id) for record_id in ids)
+            for number in changed - set([None]):
+                self.segments[number].save_live()
+
+    def _delete(self, record_id):
+        location = self._locations.pop(record_id, None)
+        if location is None:
+            return None
+        self.segments[location[0]].live[location[1]] = False
+        return location[0]
+
+    def flush(self):
+        """Write the records inserted since the last flush to a new segment"""
+        with self._lock:
+            if not self._pending:
+                return
+            # the last of several records with the same id wins
+            latest = dict((record_id, i) for i, (record_id, _) in enumerate(self._pending))
+            pending = [item for i, item in enumerate(self._pending) if latest[item[0]] == i]
+            self._pending = []
+
+            words = [[rec['simple_word_{}'.format(i)] for i in range(self.N)] for _, rec in pending]
+            entries = [{'id': record_id, 'path': rec.get('path'), 'metadata': rec.get('metadata')}
+                       for record_id, rec in pending]
+            segment = _Segment.build(words, [rec['signature'] for _, rec in pending], entries)
+            self._store(segment)
+            if len(self.segments) > self.max_segments:
+                self.optimize()
+
+    def _store(self, segment):
+        changed = set(self._locations[entry['id']][0] for entry in segment.entries if entry['id'] in self._locations)
+        if self.directory:
+            segment.save(join(self.directory, 'segments', str(self._next_segment)))
+        self._next_segment += 1
+        self._add_segment(segment)
+        for number in changed:
+            self.segments[number].save_live()
+        if self.directory:
+            self._save_manifest()
+
+    def optimize(self):
+        """Merge all segments into one, dropping deleted rows"""
+        with self._lock:
+            self.flush()
+            old = self.segments
+            words, signatures, entries = [], [], []
+            for segment in old:
+                live = np.flatnonzero(segment.live)
+                words.append(segment.words()[live])
+                signatures.append(np.asarray(segment.signatures)[live])
+                entries.extend(segment.entries[row] for row in live)
+            self.segments = []
+            self._locations = {}
+            if entries:
+                self._store(_Segment.build(np.concatenate(words), np.concatenate(signatures), entries))
+            elif self.directory:
+                self._save_manifest()
+            for segment in old:
+                if segment.directory:
+                    rmtree(segment.directory)
+
+    def search_single_record(self, rec):
+        return self.search_records([rec])[0]
+
+    def search_records(self, records, stl_ids=None):
+        """
+        Search for many records
+
+        :param records: image_match records
+        :param stl_ids: only return rows whose metadata has one of these stl_ids (optional)
+        :return: a list of hits for each record, in the format of SignatureES.search_image
+        """
+        with self._lock:
+            self.flush()
+            if stl_ids is not None:
+                stl_ids = np.array(sorted(stl_ids), dtype=np.str_)
+            results = []
+            for rec in records:
+                words = np.array([rec['simple_word_{}'.format(i)] for i in range(self.N)], dtype=np.int64)
+                numbers, rows, counts = [], [], []
+                for number, segment in enumerate(self.segments):
+                    segment_rows, segment_counts = segment.matches(words)
+                    if stl_ids is not None:
+                        keep = np.isin(segment.stl_ids()[segment_rows], stl_ids)
+                        segment_rows, segment_counts = segment_rows[keep], segment_counts[keep]
+                    segment_rows, segment_counts = _top(segment_rows, segment_counts, self.size)
+                    numbers.append(np.full(len(segment_rows), number, dtype=np.int64))
+                    rows.append(segment_rows)
+                    counts.append(segment_counts)
+                if not rows:
+                    results.append([])
+                    continue
+
+                # like elasticsearch, only the best scoring candidates get their distances computed:
+                # the most shared words first, then the oldest segment and row
+                numbers, rows, counts = np.concatenate(numbers), np.concatenate(rows), np.concatenate(counts)
+                best = np.lexsort((rows, numbers, -counts))[:self.size]
+                numbers, rows, counts = numbers[best], rows[best], counts[best]
+                res = []
+                for number in np.unique(numbers):
+                    segment = self.segments[number]
+                    picked = numbers == number
+                    dists = normalized_distance(np.asarray(segment.signatures)[rows[picked]], np.array(rec['signature']))
+                    for row, count, dist in zip(rows[picked], counts[picked], dists):
+                        if dist < self.distance_cutoff:
+                            entry = segment.entries[row]
+                            res.append({'id': entry['id'],
+                                        'score': int(count),
+                                        'metadata': entry['metadata'],
+                                        'path': entry['path'],
+                                        'dist': dist})
+                results.append(sorted(res, key=itemgetter('dist')))
+            return results
+
+
+def _top(rows, counts, size):
+    # the size rows sharing the most words, ties going to the lowest rows, without sorting them all
+    if len(rows) <= size:
+        return rows, counts
+    threshold = -np.partition(-counts, size - 1)[size - 1]
+    above = np.flatnonzero(counts > threshold)
+    tied = np.flatnonzero(counts == threshold)[:size - len(above)]
+    keep = np.sort(np.concatenate([above, tied]))
+    return rows[keep], counts[keep]
+
+
+class LocalOperations(APIOperations):
+    def __init__(self, directory, cutoff=0.5, **kwargs):
+        """
+        APIOperations without elasticsearch: images go into a :py:class:`SignatureIndex` in directory
+
+        :param directory: where the index is stored
+        :param cutoff: maximum signature distance of a match
+        :param kwargs: passed on to APIOperations (render options, render_cache, downloader...)
+        """
+        self.directory = abspath(expanduser(directory))
+        index = SignatureIndex(join(self.directory, 'signatures'))
+        super(LocalOperations, self).__init__(es_nodes=None, index_name=self.directory, cutoff=cutoff,
+                                              signature_database=index, **kwargs)
+        self.catalog_path = join(self.directory, 'designs.json')
+        self.catalog = {}
+        # the server's worker threads add and search at once
+        self._catalog_lock = threading.Lock()
+        if exists(self.catalog_path):
+            with open(self.catalog_path) as f:
+                self.catalog = json.load(f)
+
+    def create_index(self, doc_type='image'):
+        pass
+
+    def index_images(self, images, doc_type='image', chunk_size=500, max_retries=3, initial_backoff=2):
+        """
+        Compute the signatures of rendered images and add them to the index
+
+        :param images: list of (stl_id, image path) pairs
+        :return: dict with the number of images indexed and the errors of any that failed
+        """
+        records = []
+        for (stl_id, image_path), rec in zip(images, self.iter_records([image_path for _, image_path in images])):
+            rec['metadata'] = {'stl_id': stl_id}
+            records.append(rec)
+        self.ses.insert_records(records, ids=[self._image_id(stl_id, image_path) for stl_id, image_path in images])
+        self.ses.flush()
+        return {'indexed': len(records), 'errors': []}
+
+    def _index_designs(self, stl_ids, images, sources, descriptors):
+        views = dict((stl_id, 0) for stl_id in stl_ids)
+        for stl_id, _ in images:
+            if stl_id in views:
+                views[stl_id] += 1
+        with self._catalog_lock:
+            for stl_id in stl_ids:
+                self.catalog[stl_id] = self._design_document(stl_id, views[stl_id], sources.get(stl_id),
+                                                             descriptors.get(stl_id))
+            _write_json(self.catalog_path, self.catalog)
+        return []
+
+    def _catalog_items(self):
+        # a snapshot, so an add can't change the catalog under an iteration
+        with self._catalog_lock:
+            return list(self.catalog.items())
+
+    def iter_designs(self, catalog=True, page_size=1000):
+        for stl_id, design in self._catalog_items():
+            yield stl_id, design['views']
+
+    def _iter_descriptors(self, page_size=1000):
+        for stl_id, design in self._catalog_items():
+            if design.get('descriptors'):
+                yield stl_id, design['descriptors']
+
+    def _get_descriptors(self, stl_ids):
+        with self._catalog_lock:
+            return dict((stl_id, self.catalog[stl_id]['descriptors']) for stl_id in stl_ids
+                        if self.catalog.get(stl_id, {}).get('descriptors'))
+
+    def _stl_id_field(self, doc_type='image'):
+        return 'stl_id'
+
+    def search_records(self, records, doc_type='image', search_filter=None):
+        stl_ids = None
+        if search_filter:
+            # the only filter searches use: {'terms': {'stl_id': [...]}}
+            stl_ids = search_filter['terms']['stl_id']
+        return self.ses.search_records(records, stl_ids=stl_ids)
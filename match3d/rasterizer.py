@@ -0,0 +1,252 @@
+"""Orthographic software rasterizer in numpy
+
+Renders the principal axis views of image_match_generator.py without blender:
+the model is read with :py:mod:`stl_reader`, centered, scaled and oriented the
+same way ImagesBuilder does it, then every view is z-buffered in batches of
+triangles and shaded by how squarely each face points at the camera (the lamp
+sits on the camera).
+"""
+__author__ = 'ryan'
+
+from hashlib import md5
+from os.path import join, abspath
+
+import time
+
+import numpy as np
+from numpy.linalg import eig
+from PIL import Image
+
+from geometry import inertia_matrix, max_vertex_norm
+from report import REPORT_FILENAME, report_writer
+from stl_reader import load_stl, find_stl_files
+from views import ORTHO_SCALE, MODEL_RADIUS, view_filename, transform_view, screen_coordinates, ViewDeduplicator
+
+# grey levels, roughly those of blender's default world and material
+BACKGROUND = 0.05
+DIFFUSE = 0.8
+
+# rough number of pixels filled per batch
+MAX_FRAGMENTS = 2 ** 21
+
+
+def oriented_models(triangles):
+    """
+    Center, scale and turn a model onto each of its principal axes
+
+    :param triangles: array of shape (n, 3, 3)
+    :return: (list of 3 arrays of shape (n, 3, 3), one per principal axis in ImagesBuilder's order,
+        the principal moments of inertia)
+    """
+    triangles = np.asarray(triangles, dtype=np.float64)
+    edges = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    areas = 0.5 * np.linalg.norm(edges, axis=1)
+    centroids = triangles.mean(axis=1)
+
+    # blender's ORIGIN_CENTER_OF_MASS: area weighted mean of the face centroids
+    center = areas.dot(centroids) / areas.sum()
+    triangles = triangles - center
+    factor = MODEL_RADIUS / max_vertex_norm(triangles)
+    triangles *= factor
+
+    evals, evecs = eig(inertia_matrix(areas * factor ** 2, (centroids - center) * factor))
+    evecs = evecs.T
+
+    oriented = []
+    for eig_vec_num in range(3):
+        orientation = np.roll(evecs, eig_vec_num, axis=1)
+        oriented.append(triangles.reshape(-1, 3).dot(orientation.T).reshape(-1, 3, 3))
+    return oriented, evals
+
+
+def rasterize(triangles, side, resolution):
+    """
+    Render one orthographic view of an oriented model
+
+    :param triangles: array of shape (n, 3, 3), already oriented
+    :param side: 'front' or 'back'
+    :param resolution: width and height of the image in pixels
+    :return: float array of shape (resolution, resolution), rows top to bottom, values in [0, 1]
+    """
+    right, up, depth = screen_coordinates(triangles, side)
+    x = (right / ORTHO_SCALE + 0.5) * resolution
+    y = (0.5 - up / ORTHO_SCALE) * resolution
+
+    # the lamp is on the camera, so lambertian shading is just the normal's depth component
+    normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    lengths = np.linalg.norm(normals, axis=1)
+    area2 = (x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (y[:, 1] - y[:, 0]) * (x[:, 2] - x[:, 0])
+
+    # rows whose pixel centers the triangle may cover
+    row0 = np.clip(np.ceil(y.min(axis=1) - 0.5), 0, resolution).astype(np.int64)
+    row1 = np.clip(np.floor(y.max(axis=1) - 0.5), -1, resolution - 1).astype(np.int64)
+    # degenerate faces have no normal to shade with
+    keep = np.flatnonzero((area2 != 0) & (lengths > 0) & (row1 >= row0))
+    x, y, depth, area2, row0, row1 = x[keep], y[keep], depth[keep], area2[keep], row0[keep], row1[keep]
+    shade = DIFFUSE * np.abs(normals[keep, 0]) / lengths[keep]
+
+    # depth is affine in screen space for an orthographic camera
+    dzdx = ((depth[:, 1] - depth[:, 0]) * (y[:, 2] - y[:, 0]) - (depth[:, 2] - depth[:, 0]) * (y[:, 1] - y[:, 0])) / area2
+    dzdy = ((depth[:, 2] - depth[:, 0]) * (x[:, 1] - x[:, 0]) - (depth[:, 1] - depth[:, 0]) * (x[:, 2] - x[:, 0])) / area2
+
+    zbuffer = np.full(resolution * resolution, -np.inf)
+    image = np.full(resolution * resolution, BACKGROUND)
+
+    # Scan convert: one span of pixels per (triangle, row), batched so the fragments fit in memory.
+    n_rows = row1 - row0 + 1
+    width = np.clip(x.max(axis=1), 0, resolution) - np.clip(x.min(axis=1), 0, resolution) + 2
+    cost_ends = np.cumsum(n_rows * width)
+    start = 0
+    while start < len(keep):
+        already = cost_ends[start - 1] if start else 0
+        stop = max(start + 1, np.searchsorted(cost_ends, already + MAX_FRAGMENTS, side='right'))
+        t = np.repeat(np.arange(start, stop), n_rows[start:stop])
+        row = row0[t] + np.arange(len(t)) - np.repeat(np.cumsum(n_rows[start:stop]) - n_rows[start:stop], n_rows[start:stop])
+        cy = row + 0.5
+
+        # where the row crosses each edge; half open intervals so shared vertices count once
+        left = np.full(len(t), np.inf)
+        right_end = np.full(len(t), -np.inf)
+        for a, b in ((0, 1), (1, 2), (2, 0)):
+            ya, yb = y[t, a], y[t, b]
+            crosses = (np.minimum(ya, yb) <= cy) & (cy < np.maximum(ya, yb))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                xc = x[t, a] + (cy - ya) * (x[t, b] - x[t, a]) / (yb - ya)
+            left = np.where(crosses, np.minimum(left, xc), left)
+            right_end = np.where(crosses, np.maximum(right_end, xc), right_end)
+
+        spanned = np.isfinite(left) & np.isfinite(right_end)
+        col0 = np.zeros(len(t), dtype=np.int64)
+        col1 = np.full(len(t), -1, dtype=np.int64)
+        col0[spanned] = np.clip(np.ceil(left[spanned] - 0.5), 0, resolution)
+        col1[spanned] = np.clip(np.floor(right_end[spanned] - 0.5), -1, resolution - 1)
+        n_cols = np.maximum(col1 - col0 + 1, 0)
+
+        span = np.repeat(np.arange(len(t)), n_cols)
+        col = col0[span] + np.arange(len(span)) - np.repeat(np.cumsum(n_cols) - n_cols, n_cols)
+        tri = t[span]
+        fragment_depth = (depth[tri, 0] + dzdx[tri] * (col + 0.5 - x[tri, 0]) + dzdy[tri] * (cy[span] - y[tri, 0]))
+        pixel = row[span] * resolution + col
+
+        # nearest fragment wins
+        np.maximum.at(zbuffer, pixel, fragment_depth)
+        nearest = fragment_depth >= zbuffer[pixel]
+        image[pixel[nearest]] = shade[tri[nearest]]
+        start = stop
+
+    return image.reshape(resolution, resolution)
+
+
+def render_views(triangles, resolution=1024, rotations=False, front_and_back=False, reflections=False,
+                 supersample=1, dedupe=False):
+    """
+    Render the principal axis views of a model
+
+    :param triangles: array of shape (n, 3, 3)
+    :param resolution: width and height of the images
+    :param rotations: include the 90 degree rotations
+    :param front_and_back: include the back views
+    :param reflections: include the mirrored views
+    :param supersample: render this many times larger and average down, for antialiasing
+    :param dedupe: spot views that look the same as an earlier one, like image_match_generator.py
+    :return: generator of ((eig_vec_num, rotation, side, reflected), uint8 array, canonical) triples.
+        canonical is the view tuple of the earlier view a duplicate looks like, otherwise None
+    """
+    sides = ['front', 'back'] if front_and_back else ['front']
+    n_rotations = 4 if rotations else 1
+    mirrors = [0, 1] if reflections else [0]
+    oriented_triangles, evals = oriented_models(triangles)
+    deduplicator = ViewDeduplicator(evals) if dedupe else None
+    for eig_vec_num, oriented in enumerate(oriented_triangles):
+        for side in sides:
+            pixels = rasterize(oriented, side, resolution * supersample)
+            if supersample > 1:
+                pixels = pixels.reshape(resolution, supersample, resolution, supersample).mean(axis=(1, 3))
+            pixels = np.round(255 * pixels).astype(np.uint8)
+            for i in range(n_rotations):
+                for reflected in mirrors:
+                    view = (eig_vec_num, i, side, reflected)
+                    view_pixels = transform_view(pixels, i, reflected, side)
+                    canonical = deduplicator.canonical(view, eig_vec_num, view_pixels) if deduplicator else None
+                    yield view, view_pixels, canonical
+
+
+class NumpyRenderer(object):
+    def __init__(self, resolution=1024, supersample=1, dedupe=True):
+        """
+        Render backend that draws image_match_generator's views in-process, without blender
+
+        :param resolution: default width and height of the images
+        :param supersample: antialiasing factor
+        :param dedupe: skip views that look the same as another, reporting them like image_match_generator.py
+        """
+        self.resolution = resolution
+        self.supersample = supersample
+        self.dedupe = dedupe
+
+    def settings(self, resolution=None):
+        """Everything besides the view flags that changes the images render draws, for render cache keys"""
+        return {'resolution': resolution or self.resolution, 'supersample': self.supersample, 'dedupe': self.dedupe}
+
+    def render(self, stl_directory_name, output_directory, rotations=False, front_and_back=False,
+               reflections=False, resolution=None):
+        """
+        Render every STL file in a directory, writing the same images and report as image_match_generator.py
+
+        :param stl_directory_name: directory containing STL files
+        :param output_directory: where the images and report are written
+        :return: output_directory
+        """
+        self.render_files(find_stl_files(stl_directory_name), output_directory, rotations=rotations,
+                          front_and_back=front_and_back, reflections=reflections, resolution=resolution)
+        return output_directory
+
+    def render_files(self, stl_files, output_directory, rotations=False, front_and_back=False, reflections=False,
+                     resolution=None, report_path=None, progress=None):
+        """
+        Render a list of STL files, like image_match_generator.py with --file-list
+
+        :param stl_files: paths of STL files
+        :param output_directory: where the images are written
+        :param report_path: where to write the report (default: in output_directory)
+        :param progress: function called with (STL file, error or None) as every model finishes. Without
+            one, the first model that fails stops the render
+        :return: list of (STL file, error) pairs of the files that failed
+        """
+        resolution = resolution or self.resolution
+        failures = []
+        with open(report_path or join(output_directory, REPORT_FILENAME), 'w') as report_file:
+            writer = report_writer(report_file)
+            for stl_name in stl_files:
+                try:
+                    self._render_file(stl_name, output_directory, writer, rotations, front_and_back, reflections,
+                                      resolution)
+                except Exception as e:
+                    if progress is None:
+                        raise
+                    failures.append((stl_name, repr(e)))
+                    progress(stl_name, repr(e))
+                else:
+                    if progress:
+                        progress(stl_name, None)
+                report_file.flush()
+        return failures
+
+    def _render_file(self, stl_name, output_directory, writer, rotations, front_and_back, reflections, resolution):
+        started = time.time()
+        stl_hash = md5(stl_name.encode('utf-8')).hexdigest()
+        mesh = load_stl(stl_name)
+        # timed like image_match_generator.py; the first view includes orienting the model
+        model = {'stl_filename': stl_name, 'model_seconds': time.time() - started, 'faces': len(mesh)}
+        lap = time.time()
+        for view, pixels, canonical in render_views(mesh.triangles, resolution, rotations, front_and_back,
+                                                    reflections, self.supersample, self.dedupe):
+            path = view_filename(stl_hash, *view)
+            row = dict(model, id=path)
+            if canonical:
+                row.update({'image_filename': '', 'canonical_id': view_filename(stl_hash, *canonical)})
+            else:
+                Image.fromarray(pixels).convert('RGB').save(join(output_directory, path))
+                row['image_filename'] = abspath(join(output_directory, path))
+            row['seconds'], lap = time.time() - lap, time.time()
+            writer.writerow(row)
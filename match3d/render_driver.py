@@ -0,0 +1,194 @@
+"""Render a directory of STL files with several blender processes at once
+
+Blender renders one model at a time, so a single process leaves most cores
+idle on a big corpus. :py:func:`render_sharded` splits the STL files into
+shards and keeps ``processes`` blender processes running one of the scripts
+(image_match_generator.py or generate_images_for_humans.py) on a shard each.
+Every shard gets its own report CSV, merged into
+image_match_generator_report.csv at the end.
+
+A model that makes the script fail is skipped by the script itself. If blender
+dies altogether, the model it was rendering is marked as failed and the rest of
+its shard is put back in the queue. From the command line::
+
+    python render_driver.py -d ~/stl_set_a/ -o test_output/ --processes 8 -- --resolution 200
+"""
+__author__ = 'ryan'
+
+from report import PROGRESS_PREFIX, REPORT_FILENAME
+from stl_reader import find_stl_files
+from multiprocessing import cpu_count
+from os.path import abspath, dirname, exists, expanduser, join
+from os import environ, listdir, makedirs
+from shutil import rmtree
+from math import ceil
+
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+import threading
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+
+def render_sharded(stl_directory_name, output_directory, script='image_match_generator.py', processes=None,
+                   shard_size=None, script_args=(), blender='blender', script_directory=None, progress=None):
+    """
+    Render every STL file in a directory with several blender processes
+
+    :param stl_directory_name: directory containing STL files
+    :param output_directory: where the images and the merged report go
+    :param script: blender script to run, with --file-list and --report options
+    :param processes: number of blender processes (default: one per core)
+    :param shard_size: STL files per blender process (default: about four shards per process)
+    :param script_args: more command line arguments for the script, e.g. ['--no-rotations']
+    :param blender: the blender executable
+    :param script_directory: directory of the script (default: this one)
+    :param progress: function called with (done, total, STL file, error or None) as every model finishes
+    :return: dict with the list of STL files rendered and (STL file, error) pairs of those that failed
+    """
+    stl_files = sorted(find_stl_files(stl_directory_name))
+    processes = processes or cpu_count()
+    shard_size = shard_size or max(1, int(ceil(len(stl_files) / (4.0 * processes))))
+    script_directory = abspath(expanduser(script_directory or dirname(abspath(__file__))))
+    output_directory = abspath(expanduser(output_directory))
+    if not exists(output_directory):
+        makedirs(output_directory)
+
+    shards = Queue()
+    for start in range(0, len(stl_files), shard_size):
+        shards.put(stl_files[start:start + shard_size])
+    state = {'rendered': [], 'failed': [], 'shards': 0}
+    lock = threading.Lock()
+
+    def finished(stl_name, error):
+        with lock:
+            if error is None:
+                state['rendered'].append(stl_name)
+            else:
+                state['failed'].append((stl_name, error))
+            done = len(state['rendered']) + len(state['failed'])
+        if progress:
+            progress(done, len(stl_files), stl_name, error)
+
+    def next_shard_directory():
+        with lock:
+            state['shards'] += 1
+            return join(work_directory, str(state['shards']))
+
+    def worker():
+        while True:
+            shard = shards.get()
+            if shard is None:
+                break
+            try:
+                rest = _render_shard(shard, next_shard_directory(), output_directory, script, script_args,
+                                     blender, script_directory, finished)
+                if rest:
+                    shards.put(rest)
+            except Exception as e:
+                # the worker has to live on to take the shards other workers put back
+                with lock:
+                    done = set(state['rendered']) | set(stl_name for stl_name, _ in state['failed'])
+                for stl_name in shard:
+                    if stl_name not in done:
+                        finished(stl_name, repr(e))
+            finally:
+                shards.task_done()
+
+    work_directory = tempfile.mkdtemp()
+    try:
+        threads = [threading.Thread(target=worker) for _ in range(min(processes, max(shards.qsize(), 1)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        shards.join()
+        for _ in threads:
+            shards.put(None)
+        for thread in threads:
+            thread.join()
+
+        # merge the shard reports, in the order the shards were started
+        with open(join(output_directory, REPORT_FILENAME), 'w') as report_file:
+            for shard in sorted(listdir(work_directory), key=int):
+                report_path = join(work_directory, shard, REPORT_FILENAME)
+                if exists(report_path):
+                    with open(report_path) as shard_report:
+                        report_file.write(shard_report.read())
+    finally:
+        rmtree(work_directory)
+
+    return {'rendered': state['rendered'], 'failed': state['failed']}
+
+
+def _render_shard(shard, shard_directory, output_directory, script, script_args, blender, script_directory,
+                  finished):
+    # run blender on a shard; returns the STL files it never got to if it died
+    makedirs(shard_directory)
+    file_list = join(shard_directory, 'stl_files.txt')
+    with open(file_list, 'w') as f:
+        f.writelines(stl_name + '\n' for stl_name in shard)
+
+    args = [blender, '-b', '-P', join(script_directory, script), '--',
+            '-d', dirname(shard[0]),
+            '-o', output_directory,
+            '--file-list', file_list,
+            '--report', join(shard_directory, REPORT_FILENAME)] + list(script_args)
+    pending = list(shard)
+    try:
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, cwd=script_directory, universal_newlines=True)
+    except OSError as e:
+        for stl_name in pending:
+            finished(stl_name, repr(e))
+        return []
+
+    try:
+        # skip whatever blender prints about its own progress
+        for line in iter(process.stdout.readline, ''):
+            if line.startswith(PROGRESS_PREFIX):
+                message = json.loads(line[len(PROGRESS_PREFIX):])
+                if message['stl_filename'] in pending:
+                    pending.remove(message['stl_filename'])
+                finished(message['stl_filename'], message['error'])
+    except Exception:
+        process.kill()
+        process.wait()
+        raise
+    returncode = process.wait()
+
+    if not pending:
+        return []
+    # blender died on the first model it didn't finish; the others may be fine
+    finished(pending[0], 'blender exited with code {}'.format(returncode))
+    return pending[1:]
+
+
+def print_progress(done, total, stl_name, error):
+    sys.stderr.write('[{}/{}] {}{}\n'.format(done, total, stl_name, ' FAILED: ' + error if error else ''))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render a directory of STL files with several blender processes',
+                                     epilog='arguments after -- are passed on to the blender script')
+    parser.add_argument('-d', '--target-directory', required=True, help='directory containing STL files')
+    parser.add_argument('-o', '--output-directory', required=True, help='directory where to put images')
+    parser.add_argument('--processes', type=int, help='number of blender processes (default: one per core)')
+    parser.add_argument('--shard-size', type=int, help='STL files per blender process')
+    parser.add_argument('--for-humans', dest='script', action='store_const', const='generate_images_for_humans.py',
+                        default='image_match_generator.py', help='render with generate_images_for_humans.py')
+    parser.add_argument('--blender', default=environ.get('BLENDER', 'blender'), help='the blender executable')
+
+    argv = sys.argv[1:]
+    script_args = argv[argv.index('--') + 1:] if '--' in argv else []
+    args = parser.parse_args(argv[:argv.index('--')] if '--' in argv else argv)
+
+    result = render_sharded(args.target_directory, args.output_directory, script=args.script,
+                            processes=args.processes, shard_size=args.shard_size, script_args=script_args,
+                            blender=args.blender, progress=print_progress)
+    sys.stderr.write('{} rendered, {} failed\n'.format(len(result['rendered']), len(result['failed'])))
+    sys.exit(1 if result['failed'] else 0)
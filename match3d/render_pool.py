@@ -0,0 +1,227 @@
+"""Pool of long-lived blender processes for rendering
+
+Spawning blender costs a few seconds before the first pixel is rendered. A
+:py:class:`RenderPool` keeps a number of blender processes running
+render_worker.py and feeds them jobs over a pipe, so that cost is paid once per
+worker instead of once per add or search.
+"""
+__author__ = 'ryan'
+
+import json
+import subprocess
+import threading
+from itertools import count
+from os.path import abspath, dirname, expanduser, join
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+RESULT_PREFIX = 'MATCH3D-RESULT '
+WORKER_SCRIPT = 'render_worker.py'
+
+
+class RenderError(Exception):
+    pass
+
+
+class RenderJob(object):
+    """A render request waiting in (or taken from) the pool's queue"""
+    def __init__(self, job_id, options):
+        self.id = job_id
+        self.options = options
+        self.error = None
+        # (STL file, error) pairs of the models the worker couldn't render
+        self.failed = []
+        self._done = threading.Event()
+
+    def finish(self, error=None, failed=None):
+        self.error = error
+        self.failed = [tuple(failure) for failure in failed or []]
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Block until the job has been rendered
+
+        :param timeout: seconds to wait, or None to wait forever
+        :return: True if the job finished in time
+        """
+        return self._done.wait(timeout)
+
+
+class RenderPool(object):
+    def __init__(self, workers=2, max_jobs_per_worker=100, max_queued_jobs=0,
+                 job_timeout=600, blender='blender', script_directory=None):
+        """
+        Start a pool of blender render workers
+
+        :param workers: number of blender processes to keep running
+        :param max_jobs_per_worker: restart a blender process after this many jobs, to bound its memory (None to never recycle)
+        :param max_queued_jobs: maximum number of jobs waiting for a worker. submit blocks when full (0 for unbounded)
+        :param job_timeout: seconds before a job is considered hung and its worker is killed (None for no limit)
+        :param blender: name or path of the blender executable
+        :param script_directory: directory containing render_worker.py (defaults to this package)
+        """
+        self.workers = workers
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.job_timeout = job_timeout
+        self.blender = blender
+        self.script_directory = script_directory or dirname(abspath(__file__))
+
+        self.jobs = Queue(max_queued_jobs)
+        self._ids = count()
+        self._closed = False
+        self._threads = []
+        for _ in range(workers):
+            t = threading.Thread(target=self._worker_loop)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, stl_directory_name, output_directory, **options):
+        """
+        Queue a directory of STL files for rendering
+
+        :param stl_directory_name: directory containing STL files
+        :param output_directory: where the images and report are written
+        :param options: image_match_generator options (resolution, all_rotations, front_and_back, octahedral)
+        :return: a :py:class:`RenderJob`
+        """
+        if self._closed:
+            raise RenderError('render pool is closed')
+        options = dict(options)
+        options['target-directory'] = abspath(expanduser(stl_directory_name))
+        options['output-directory'] = abspath(expanduser(output_directory))
+        job = RenderJob(next(self._ids), options)
+        self.jobs.put(job)
+        return job
+
+    def render(self, stl_directory_name, output_directory, **options):
+        """
+        Render a directory of STL files and wait for the result
+
+        Takes the same arguments as :py:meth:`submit`. Raises :py:class:`RenderError` if blender fails.
+
+        :return: list of (STL file, error) pairs of the models that failed, and are missing from the report
+        """
+        job = self.submit(stl_directory_name, output_directory, **options)
+        job.wait()
+        if job.error:
+            raise RenderError(job.error)
+        return job.failed
+
+    def close(self):
+        """Stop accepting jobs, let queued jobs finish and shut the workers down"""
+        self._closed = True
+        for _ in self._threads:
+            self.jobs.put(None)
+        for t in self._threads:
+            t.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _spawn(self):
+        process = subprocess.Popen([self.blender, '-b', '-P', join(self.script_directory, WORKER_SCRIPT)],
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   cwd=self.script_directory,
+                                   universal_newlines=True)
+        # wait for the scene to load, so start-up isn't billed to the first job
+        try:
+            if self._read_reply(process) is None:
+                raise RenderError('blender render worker failed to start')
+        except Exception:
+            self._kill(process)
+            raise
+        return process
+
+    @staticmethod
+    def _read_reply(process):
+        # skip whatever blender prints about its own progress
+        for line in iter(process.stdout.readline, ''):
+            if line.startswith(RESULT_PREFIX):
+                return json.loads(line[len(RESULT_PREFIX):])
+        return None
+
+    @staticmethod
+    def _stop(process):
+        if process.poll() is None:
+            try:
+                process.stdin.close()
+                process.wait()
+            except (IOError, OSError):
+                process.kill()
+
+    @staticmethod
+    def _kill(process):
+        try:
+            process.kill()
+            process.wait()
+        except (IOError, OSError):
+            pass
+
+    def _run_job(self, process, job):
+        # a hung render is killed, which closes stdout and ends _read_reply
+        watchdog = None
+        if self.job_timeout:
+            watchdog = threading.Timer(self.job_timeout, process.kill)
+            watchdog.start()
+        try:
+            message = dict(job.options, id=job.id)
+            process.stdin.write(json.dumps(message) + '\n')
+            process.stdin.flush()
+            reply = self._read_reply(process)
+        except (IOError, OSError) as e:
+            reply = {'ok': False, 'error': repr(e), 'died': True}
+        finally:
+            if watchdog:
+                watchdog.cancel()
+
+        if reply is None:
+            reply = {'ok': False, 'error': 'blender render worker exited', 'died': True}
+        return reply
+
+    def _worker_loop(self):
+        process = None
+        jobs_done = 0
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+
+            try:
+                if process is None:
+                    process = self._spawn()
+                    jobs_done = 0
+                reply = self._run_job(process, job)
+                jobs_done += 1
+            except Exception as e:
+                # a bad reply or a broken worker mustn't leave the caller waiting; start a fresh process
+                if process is not None:
+                    self._kill(process)
+                    process = None
+                job.finish(error=str(e) if isinstance(e, (RenderError, OSError)) else repr(e))
+                continue
+            job.finish(error=None if reply['ok'] else reply.get('error'), failed=reply.get('failures'))
+
+            # recycle dead or worn-out workers
+            try:
+                if process is not None and (reply.get('died') or process.poll() is not None or
+                                            (self.max_jobs_per_worker and jobs_done >= self.max_jobs_per_worker)):
+                    self._stop(process)
+                    process = None
+            except Exception:
+                self._kill(process)
+                process = None
+
+        if process is not None:
+            self._stop(process)
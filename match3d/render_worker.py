@@ -0,0 +1,42 @@
+"""Long-lived blender process that renders image_match_generator jobs
+
+Started by :py:class:`render_pool.RenderPool`. Each line on stdin is a JSON job
+holding the same options as the image_match_generator.py command line (plus an
+``id``). A reply line prefixed with RESULT_PREFIX is written to stdout when the
+job is done -- blender prints its own progress there too, so the prefix is how
+the pool tells the two apart.
+"""
+
+# put modules in path
+import sys
+sys.path.append('.')
+from image_match_generator import ImagesBuilder
+from render_pool import RESULT_PREFIX
+
+import json
+
+
+def reply(message):
+    sys.stdout.write(RESULT_PREFIX + json.dumps(message) + '\n')
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    builder = None
+    reply({'id': None, 'ok': True, 'ready': True})
+    for line in iter(sys.stdin.readline, ''):
+        if not line.strip():
+            continue
+        job = json.loads(line)
+        try:
+            # the scene is only set up once per process
+            if builder is None:
+                builder = ImagesBuilder(job)
+            else:
+                builder.configure(job)
+            failures = builder.run()
+        except Exception as e:
+            reply({'id': job.get('id'), 'ok': False, 'error': repr(e)})
+        else:
+            # models that failed are left out of the report
+            reply({'id': job.get('id'), 'ok': True, 'failures': failures})
@@ -0,0 +1,54 @@
+"""The report CSV that image_match_generator.py writes next to the images
+
+One row per image, mapping it to the STL file it was rendered from. Views
+that were skipped because they look just like another view of the same model
+get a row too, with no image_filename and the id of that other view in
+canonical_id. Renderers that time themselves fill in the seconds spent on
+each view, and on every row of a model the seconds spent loading and orienting
+it and its numbers of faces and vertices. No bpy imports in here, so the
+blender scripts and the Python side can share it.
+"""
+__author__ = 'ryan'
+
+import csv
+import json
+import sys
+
+REPORT_FILENAME = 'image_match_generator_report.csv'
+REPORT_FIELDS = ['id', 'image_filename', 'stl_filename', 'canonical_id', 'seconds', 'model_seconds', 'faces',
+                 'vertices']
+
+# stdout lines with this prefix tell render_driver.py how far a blender script got;
+# blender prints plenty of its own there
+PROGRESS_PREFIX = 'MATCH3D-PROGRESS '
+
+
+def report_writer(report_file):
+    return csv.DictWriter(report_file, fieldnames=REPORT_FIELDS)
+
+
+def read_report(path):
+    """
+    Read a report CSV
+
+    :param path: path of the report
+    :return: generator of dicts with the REPORT_FIELDS of every row (older reports lack the later fields)
+    """
+    with open(path) as report_file:
+        for row in csv.reader(report_file):
+            # the renderers don't write a header, but tolerate one
+            if not row or row[0] == REPORT_FIELDS[0]:
+                continue
+            yield dict(zip(REPORT_FIELDS, row))
+
+
+def report_progress(stl_name, error=None):
+    """Tell whoever started the blender script that an STL file is done, or failed"""
+    sys.stdout.write(PROGRESS_PREFIX + json.dumps({'stl_filename': stl_name, 'error': error}) + '\n')
+    sys.stdout.flush()
+
+
+def read_file_list(path):
+    """Read the STL paths of a --file-list file, one per line"""
+    with open(path) as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
@@ -0,0 +1,477 @@
+"""A local HTTP service for adding and searching designs
+
+Adds and searches are jobs in one bounded queue, run by a fixed number of
+worker threads sharing an APIOperations, so no more than that many renders
+(blender runs, with the blender backend) happen at once however many requests
+come in. When the queue is full, requests are refused with 429 and a
+Retry-After header instead of piling up. Searches for the same STL file (by
+SHA-1 of its contents) with the same options while one is queued or running
+wait for that job rather than starting their own.
+
+Endpoints, all answering JSON:
+
+* ``GET /designs`` lists the designs (``?counts=1``, ``?catalog=1`` as for list_designs)
+* ``POST /designs`` adds a design, ``{"stl_id": ..., "stl_url": ...}``, or many, ``{"items": [[stl_id, url], ...]}``,
+  or the STL file itself as the body, with ``?stl_id=``. Answers 202 with the job to poll
+* ``POST /search`` searches, ``{"stl_url": ..., "ranking": ...}`` or the STL file as the body. Answers with the
+  results, or 202 with the job if it takes longer than ``?wait=`` seconds
+* ``GET /jobs/<id>`` the state of a job, and its result once it is done
+* ``GET /health`` the queue: workers, queued and running jobs
+
+From the command line::
+
+    python server.py --port 8080 --index-name match3d --workers 2 --queue-size 16
+"""
+__author__ = 'ryan'
+
+from api_operations import APIOperations
+from caching import RenderCache, ResultCache, file_digest
+from download import DownloadError
+from elasticsearch.exceptions import TransportError
+from requests import RequestException
+from rasterizer import NumpyRenderer
+from collections import OrderedDict
+from functools import partial
+from os import environ, remove
+from uuid import uuid4
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import traceback
+
+import numpy as np
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from queue import Queue, Full
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from Queue import Queue, Full
+    from urlparse import urlparse, parse_qs
+
+SEARCH_OPTIONS = ('ranking', 'return_raw', 'render_backend', 'prefilter', 'shape_weight', 'progressive')
+
+
+class QueueFull(Exception):
+    pass
+
+
+class RequestError(Exception):
+    def __init__(self, message, status=400):
+        super(RequestError, self).__init__(message)
+        self.status = status
+
+
+class Job(object):
+    def __init__(self, kind, function, args=(), kwargs=None, key=None, cleanup=None):
+        """
+        A unit of work for the JobQueue
+
+        :param kind: 'add', 'add_many' or 'search'
+        :param function: called with args and kwargs by a worker
+        :param key: requests for the same key share this job while it is queued or running (optional)
+        :param cleanup: called once the job has finished, whether it failed or not (optional)
+        """
+        self.id = uuid4().hex
+        self.kind = kind
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.key = key
+        self.cleanup = cleanup
+        self.state = 'queued'
+        self.result = None
+        self.error = None
+        self.requests = 1
+        self.created = time.time()
+        self.started = self.finished = None
+        self._done = threading.Event()
+
+    def run(self):
+        self.state = 'running'
+        self.started = time.time()
+        try:
+            self.result = self.function(*self.args, **self.kwargs)
+            self.state = 'done'
+        except Exception as e:
+            self.error = '{}: {}'.format(type(e).__name__, e)
+            self.state = 'failed'
+        finally:
+            if self.cleanup:
+                self.cleanup()
+            self.finished = time.time()
+            self._done.set()
+
+    def wait(self, timeout=None):
+        """Wait for the job to finish, at most timeout seconds. True if it has"""
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def to_dict(self, result=True):
+        job = {'id': self.id, 'kind': self.kind, 'state': self.state, 'requests': self.requests,
+               'created': self.created, 'started': self.started, 'finished': self.finished}
+        if self.error:
+            job['error'] = self.error
+        if result and self.state == 'done':
+            job['result'] = self.result
+        return job
+
+
+class JobQueue(object):
+    def __init__(self, workers=2, max_queued=16, keep=1000, exclusive_adds=False):
+        """
+        A bounded queue of jobs run by a pool of worker threads
+
+        :param workers: jobs run at once
+        :param max_queued: jobs waiting for a worker before submit refuses more
+        :param keep: finished jobs remembered for get
+        :param exclusive_adds: run one add at a time, for indexes whose adds mustn't interleave
+            (local_index.LocalOperations). Searches still run alongside them and each other, which is
+            only safe because SignatureIndex and LocalOperations lock their own state
+        """
+        self.workers = workers
+        self.keep = keep
+        self._queue = Queue(max_queued)
+        self._jobs = OrderedDict()
+        self._pending = {}
+        self._running = 0
+        self._lock = threading.Lock()
+        self._add_lock = threading.Lock() if exclusive_adds else None
+        self._threads = [threading.Thread(target=self._work, name='match3d-worker-{}'.format(i))
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, job):
+        """
+        Queue a job, or return the queued or running job with the same key
+
+        :raises QueueFull: if max_queued jobs are waiting already
+        :return: the job that will answer the request
+        """
+        with self._lock:
+            current = self._pending.get(job.key) if job.key else None
+            if current is not None:
+                current.requests += 1
+                if job.cleanup:
+                    job.cleanup()
+                return current
+            try:
+                self._queue.put_nowait(job)
+            except Full:
+                if job.cleanup:
+                    job.cleanup()
+                raise QueueFull('{} jobs queued already'.format(self._queue.maxsize))
+            self._jobs[job.id] = job
+            if job.key:
+                self._pending[job.key] = job
+        return job
+
+    def get(self, job_id):
+        """The job with this id, or None"""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            return {'workers': self.workers,
+                    'running': self._running,
+                    'queued': self._queue.qsize(),
+                    'max_queued': self._queue.maxsize,
+                    'jobs': len(self._jobs)}
+
+    def close(self):
+        """Let the queued jobs finish and stop the workers"""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            with self._lock:
+                self._running += 1
+            try:
+                if self._add_lock is not None and job.kind != 'search':
+                    with self._add_lock:
+                        job.run()
+                else:
+                    job.run()
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    if job.key and self._pending.get(job.key) is job:
+                        del self._pending[job.key]
+                    self._forget()
+
+    def _forget(self):
+        # drop the oldest finished jobs beyond keep
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self.keep)]:
+            del self._jobs[job_id]
+
+
+class Service(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, operations, jobs, search_timeout=60, allow_files=False, retry_after=5):
+        """
+        The HTTP server
+
+        :param address: (host, port) to listen on
+        :param operations: APIOperations shared by the workers
+        :param jobs: the JobQueue adds and searches run in
+        :param search_timeout: default seconds a search request waits for its result before answering 202
+        :param allow_files: accept stl_file paths on the server's file system, not just urls and uploads
+        :param retry_after: seconds suggested to clients refused with 429
+        """
+        HTTPServer.__init__(self, address, Handler)
+        self.operations = operations
+        self.jobs = jobs
+        self.search_timeout = search_timeout
+        self.allow_files = allow_files
+        self.retry_after = retry_after
+
+
+def _json_default(obj):
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError('{!r} is not JSON serializable'.format(obj))
+
+
+def _flag(value):
+    return value.lower() in ('1', 'true', 'yes')
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self._dispatch({'/designs': self.list_designs, '/health': self.health}, prefixes={'/jobs/': self.job})
+
+    def do_POST(self):
+        self._dispatch({'/designs': self.add, '/search': self.search})
+
+    def _dispatch(self, routes, prefixes=None):
+        url = urlparse(self.path)
+        self.query = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+        route = url.path.rstrip('/') or '/'
+        try:
+            if route in routes:
+                return routes[route]()
+            for prefix, function in (prefixes or {}).items():
+                if route.startswith(prefix):
+                    return function(route[len(prefix):])
+            raise RequestError('no such endpoint: {}'.format(route), status=404)
+        except QueueFull as e:
+            self._send(429, {'error': str(e)}, headers={'Retry-After': str(self.server.retry_after)})
+        except RequestError as e:
+            self._send(e.status, {'error': str(e)})
+        except (ValueError, DownloadError) as e:
+            self._send(400, {'error': str(e)})
+        except TransportError as e:
+            self._send(502, {'error': 'elasticsearch: {}'.format(e)})
+        except Exception as e:
+            traceback.print_exc()
+            self._send(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+
+    def _send(self, status, body, headers=None):
+        data = json.dumps(body, default=_json_default).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_job(self, job):
+        self._send(202, {'job': job.to_dict(result=False)}, headers={'Location': '/jobs/' + job.id})
+
+    def _read_body(self):
+        # a JSON request, or an STL file uploaded as the body: (json or None, temporary STL path or None, SHA-1)
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}, None, None
+        content_type = (self.headers.get('Content-Type') or '').split(';')[0].strip()
+        if content_type == 'application/json':
+            try:
+                return json.loads(self.rfile.read(length).decode('utf-8')), None, None
+            except ValueError:
+                raise RequestError('the request body is not valid JSON')
+
+        max_bytes = self.server.operations.downloader.max_bytes
+        if max_bytes and length > max_bytes:
+            raise RequestError('{} bytes is more than the {} allowed'.format(length, max_bytes), status=413)
+        handle, path = tempfile.mkstemp(suffix='.stl')
+        digest = hashlib.sha1()
+        with os.fdopen(handle, 'wb') as f:
+            while length > 0:
+                chunk = self.rfile.read(min(length, 2 ** 16))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+                length -= len(chunk)
+        return None, path, digest.hexdigest()
+
+    def _source(self, body):
+        # (stl_url, stl_file) of a JSON request
+        stl_url, stl_file = body.get('stl_url'), body.get('stl_file')
+        if stl_file and not self.server.allow_files:
+            raise RequestError('stl_file is not allowed, send the file or its stl_url')
+        if not (stl_url or stl_file):
+            raise RequestError('stl_url or stl_file is required')
+        return stl_url, stl_file
+
+    def list_designs(self):
+        designs = self.server.operations.list_designs(counts=_flag(self.query.get('counts', '')),
+                                                      catalog=_flag(self.query.get('catalog', '')))
+        self._send(200, {'designs': designs})
+
+    def health(self):
+        self._send(200, self.server.jobs.stats())
+
+    def job(self, job_id):
+        job = self.server.jobs.get(job_id)
+        if job is None:
+            raise RequestError('no such job: {}'.format(job_id), status=404)
+        self._send(200, {'job': job.to_dict()})
+
+    def add(self):
+        ops = self.server.operations
+        body, path, _ = self._read_body()
+        if path:
+            stl_id = self.query.get('stl_id')
+            if not stl_id:
+                remove(path)
+                raise RequestError('stl_id is required')
+            job = Job('add', ops.add, (stl_id,), {'stl_file': path}, cleanup=partial(remove, path))
+        elif 'items' in body:
+            items = [(item[0], item[1]) for item in body['items']]
+            if not self.server.allow_files and any(not source.startswith(('http://', 'https://'))
+                                                   for _, source in items):
+                raise RequestError('items must be urls')
+            job = Job('add_many', ops.add_many, (items,))
+        else:
+            if not body.get('stl_id'):
+                raise RequestError('stl_id is required')
+            stl_url, stl_file = self._source(body)
+            job = Job('add', ops.add, (body['stl_id'],), {'stl_url': stl_url, 'stl_file': stl_file})
+        self._send_job(self.server.jobs.submit(job))
+
+    def search(self):
+        body, path, digest = self._read_body()
+        if body is None:
+            options = dict((name, self.query[name]) for name in SEARCH_OPTIONS if name in self.query)
+        else:
+            options = dict((name, body[name]) for name in SEARCH_OPTIONS if name in body)
+            stl_url, stl_file = self._source(body)
+            if stl_url:
+                # fetched here so concurrent searches for the same file, from any url, share a job
+                path = tempfile.mkstemp(suffix='.stl')[-1]
+                try:
+                    digest, _ = self.server.operations.downloader.fetch(stl_url, path)
+                except RequestException as e:
+                    raise RequestError('could not download {}: {}'.format(stl_url, e), status=502)
+                finally:
+                    if digest is None:
+                        remove(path)
+            else:
+                try:
+                    digest = file_digest(stl_file)
+                except (IOError, OSError) as e:
+                    raise RequestError('could not read {}: {}'.format(stl_file, e))
+        for name, convert in (('return_raw', _flag), ('prefilter', int), ('shape_weight', float),
+                              ('progressive', _flag)):
+            if isinstance(options.get(name), str):
+                options[name] = convert(options[name])
+
+        key = (digest,) + tuple(options.get(name) for name in SEARCH_OPTIONS)
+        if path:
+            job = Job('search', self._search, (path, options), key=key, cleanup=partial(remove, path))
+        else:
+            job = Job('search', self._search, (stl_file, options), key=key)
+        job = self.server.jobs.submit(job)
+
+        wait = float(self.query.get('wait', self.server.search_timeout))
+        if not job.wait(wait):
+            return self._send_job(job)
+        if job.error:
+            return self._send(500, {'job': job.to_dict()})
+        self._send(200, dict(job.result, job=job.id))
+
+    def _search(self, stl_file, options):
+        result = self.server.operations.search(stl_file=stl_file, **options)
+        if options.get('return_raw'):
+            return {'results': result}
+        # results keyed by the (temporary) file name don't mean anything to the client
+        response = {'results': result[stl_file]}
+        if 'tier' in result:
+            response['tier'] = result['tier']
+        return response
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Add and search designs over HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--index-name', default='match3d')
+    parser.add_argument('--es-hosts', default=environ.get('ES_HOSTS', 'localhost'))
+    parser.add_argument('--local-index', help='directory of a local_index.LocalOperations index instead')
+    parser.add_argument('--cutoff', type=float, default=0.5)
+    parser.add_argument('--render-backend', default='blender', choices=['blender', 'numpy'])
+    parser.add_argument('--resolution', type=int, help='resolution of the numpy backend')
+    parser.add_argument('--render-cache', help='directory of a render cache')
+    parser.add_argument('--result-cache', help='directory of a result cache')
+    parser.add_argument('--processes', type=int, help='signature pool size (default: one per core)')
+    parser.add_argument('--blender-processes', type=int, default=1, help='blender processes per add_many shard')
+    parser.add_argument('--workers', type=int, default=2, help='adds and searches run at once')
+    parser.add_argument('--queue-size', type=int, default=16, help='jobs waiting for a worker before 429')
+    parser.add_argument('--search-timeout', type=float, default=60,
+                        help='seconds a search waits for its result before answering with the job')
+    parser.add_argument('--allow-files', action='store_true', help='accept paths on this machine as stl_file')
+    args = parser.parse_args(argv)
+
+    options = {'cutoff': args.cutoff, 'render_backend': args.render_backend, 'processes': args.processes,
+               'blender_processes': args.blender_processes}
+    if args.render_cache:
+        options['render_cache'] = RenderCache(args.render_cache)
+    if args.result_cache:
+        options['result_cache'] = ResultCache(directory=args.result_cache)
+    if args.local_index:
+        from local_index import LocalOperations
+        operations = LocalOperations(args.local_index, **options)
+    else:
+        operations = APIOperations(es_nodes=args.es_hosts.split(','), index_name=args.index_name, **options)
+    if args.resolution:
+        operations.render_backends['numpy'] = NumpyRenderer(resolution=args.resolution)
+
+    jobs = JobQueue(workers=args.workers, max_queued=args.queue_size, exclusive_adds=bool(args.local_index))
+    service = Service((args.host, args.port), operations, jobs, search_timeout=args.search_timeout,
+                      allow_files=args.allow_files)
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.server_close()
+        jobs.close()
+        operations.close()
+
+
+if __name__ == '__main__':
+    main()
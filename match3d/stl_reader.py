@@ -0,0 +1,261 @@
+"""Read STL files with numpy, without blender
+
+Binary STL files are memory-mapped: the triangles are a view on the file, so
+even multi-GB models are only paged in as they are used. ASCII STL files are
+tokenized line by line in chunks (:py:func:`iter_ascii_triangles`), again on
+every pass over the mesh, so they needn't fit in memory either unless
+:py:attr:`STLMesh.triangles` is asked for.
+
+Nothing in here imports bpy, so it can be used from the blender scripts as
+well as from the Python side.
+"""
+__author__ = 'ryan'
+
+from os import walk
+from os.path import abspath, getsize, join
+
+import numpy as np
+
+BINARY_HEADER_SIZE = 80
+BINARY_FACE = np.dtype([('normal', '<f4', (3,)),
+                        ('vertices', '<f4', (3, 3)),
+                        ('attribute', '<u2')])
+# bytes read to decide whether a file that starts with 'solid' really is ASCII
+ASCII_PROBE_SIZE = 1024
+ASCII_TEXT_BYTES = bytes(bytearray(range(32, 127)) + bytearray(b'\t\n\r\f\v'))
+
+
+class STLMesh(object):
+    def __init__(self, triangles, normals=None, name=''):
+        """
+        A triangle soup read from an STL file
+
+        :param triangles: array of shape (n, 3, 3): n faces of 3 vertices. May be a view on a memory-mapped file
+        :param normals: array of shape (n, 3) of face normals as stored in the file (optional)
+        :param name: the solid name (ASCII) or header (binary)
+        """
+        self.triangles = triangles
+        self.normals = normals
+        self.name = name
+
+    def __len__(self):
+        return len(self.triangles)
+
+    @property
+    def vertices(self):
+        """Every face's vertices, shape (3n, 3). Copies the triangles into memory"""
+        return np.asarray(self.triangles, dtype=np.float64).reshape(-1, 3)
+
+    @property
+    def faces(self):
+        """Vertex indices of every face into :py:attr:`vertices`, shape (n, 3)"""
+        return np.arange(3 * len(self)).reshape(-1, 3)
+
+    def indexed(self):
+        """
+        Merge duplicate vertices
+
+        :return: (vertices, faces) -- unique vertices of shape (m, 3) and faces of shape (n, 3) indexing them
+        """
+        vertices, inverse = np.unique(np.asarray(self.triangles).reshape(-1, 3), axis=0, return_inverse=True)
+        return vertices.astype(np.float64), inverse.reshape(-1, 3)
+
+    def iter_chunks(self, chunk_size=1000000):
+        """Yield the triangles as float64 arrays of at most chunk_size faces, so big files needn't fit in memory"""
+        for start in range(0, len(self), chunk_size):
+            yield np.asarray(self.triangles[start:start + chunk_size], dtype=np.float64)
+
+    def areas_and_centroids(self, chunk_size=1000000):
+        """
+        Face areas and centroids
+
+        :return: (areas, centroids) of shapes (n,) and (n, 3)
+        """
+        areas = np.empty(len(self))
+        centroids = np.empty((len(self), 3))
+        for i, chunk in enumerate(self.iter_chunks(chunk_size)):
+            s = slice(i * chunk_size, i * chunk_size + len(chunk))
+            areas[s] = 0.5 * np.linalg.norm(np.cross(chunk[:, 1] - chunk[:, 0], chunk[:, 2] - chunk[:, 0]), axis=1)
+            centroids[s] = chunk.mean(axis=1)
+        return areas, centroids
+
+    def validate(self, chunk_size=1000000):
+        """
+        Count problems that make a model unusable for rendering
+
+        :return: dict with the number of faces, faces with non-finite coordinates and faces with zero area
+        """
+        non_finite = degenerate = 0
+        for chunk in self.iter_chunks(chunk_size):
+            finite = np.isfinite(chunk).all(axis=(1, 2))
+            non_finite += int((~finite).sum())
+            chunk = chunk[finite]
+            cross = np.cross(chunk[:, 1] - chunk[:, 0], chunk[:, 2] - chunk[:, 0])
+            degenerate += int((~cross.any(axis=1)).sum())
+        return {'faces': len(self), 'non_finite_faces': non_finite, 'degenerate_faces': degenerate}
+
+
+class ASCIISTLMesh(STLMesh):
+    def __init__(self, path, name='', chunk_size=100000):
+        """
+        An ASCII STL file, streamed from disk rather than held in memory
+
+        :py:meth:`iter_chunks`, and everything built on it, tokenizes the file again on every pass.
+        :py:attr:`triangles` reads the whole file into memory, for callers that need random access.
+
+        :param path: path to the STL file
+        :param name: the solid name
+        :param chunk_size: number of faces tokenized at a time
+        """
+        self.path = path
+        self.normals = None
+        self.name = name
+        self.chunk_size = chunk_size
+        self._triangles = None
+        self._faces = None
+
+    def __len__(self):
+        if self._faces is None:
+            for _ in self.iter_chunks():
+                pass
+        return self._faces
+
+    @property
+    def triangles(self):
+        """Every face, shape (n, 3, 3), read into memory on first use"""
+        if self._triangles is None:
+            chunks = [chunk.astype(np.float32) for chunk in iter_ascii_triangles(self.path, self.chunk_size)]
+            self._triangles = np.concatenate(chunks) if chunks else np.zeros((0, 3, 3), dtype=np.float32)
+            self._faces = len(self._triangles)
+        return self._triangles
+
+    def iter_chunks(self, chunk_size=None):
+        if self._triangles is not None:
+            for chunk in super(ASCIISTLMesh, self).iter_chunks(chunk_size or self.chunk_size):
+                yield chunk
+            return
+        faces = 0
+        for chunk in iter_ascii_triangles(self.path, chunk_size or self.chunk_size):
+            faces += len(chunk)
+            yield chunk
+        self._faces = faces
+
+
+def find_stl_files(directory):
+    """Yield the absolute path of every STL file below a directory, skipping hidden files"""
+    for root, _, filenames in walk(directory):
+        for filename in filenames:
+            if not filename.startswith('.') and filename.rpartition('.')[-1] == 'stl':
+                yield abspath(join(root, filename))
+
+
+def is_binary_stl(path):
+    """
+    Tell binary from ASCII STL
+
+    The size of a binary file is fixed by its face count, but many exporters append a few bytes,
+    so a bigger file may be binary too. Testing for a leading 'solid' isn't enough either, because
+    plenty of binary exporters write 'solid' into the header: a file that is big enough is only
+    taken for ASCII if it starts like one, with 'solid' followed by printable text and a facet.
+    """
+    size = getsize(path)
+    if size < BINARY_HEADER_SIZE + 4:
+        return False
+    with open(path, 'rb') as f:
+        start = f.read(ASCII_PROBE_SIZE)
+    n_faces = np.frombuffer(start[BINARY_HEADER_SIZE:BINARY_HEADER_SIZE + 4], dtype='<u4')[0]
+    expected = BINARY_HEADER_SIZE + 4 + int(n_faces) * BINARY_FACE.itemsize
+    if size == expected:
+        return True
+    return size > expected and not _looks_ascii(start)
+
+
+def _looks_ascii(start):
+    # the first bytes of an ASCII STL file: 'solid', then only text, reaching a facet or the end of the solid
+    if start[:5].lower() != b'solid':
+        return False
+    if start.translate(None, ASCII_TEXT_BYTES):
+        return False
+    return b'facet' in start or b'endsolid' in start
+
+
+def read_binary_stl(path, mmap=True):
+    """
+    Read a binary STL file
+
+    :param path: path to the STL file
+    :param mmap: memory-map the file (zero-copy) rather than reading it into memory
+    :return: a :py:class:`STLMesh`
+    """
+    with open(path, 'rb') as f:
+        header = f.read(BINARY_HEADER_SIZE)
+        n_faces = int(np.frombuffer(f.read(4), dtype='<u4')[0])
+        if getsize(path) < BINARY_HEADER_SIZE + 4 + n_faces * BINARY_FACE.itemsize:
+            raise ValueError('truncated binary STL file: {}'.format(path))
+        if n_faces == 0:
+            records = np.zeros(0, dtype=BINARY_FACE)
+        elif mmap:
+            records = np.memmap(path, dtype=BINARY_FACE, mode='r',
+                                offset=BINARY_HEADER_SIZE + 4, shape=(n_faces,))
+        else:
+            records = np.fromfile(f, dtype=BINARY_FACE, count=n_faces)
+
+    name = header.split(b'\0')[0].decode('ascii', 'replace').strip()
+    return STLMesh(records['vertices'], normals=records['normal'], name=name)
+
+
+def iter_ascii_triangles(path, chunk_size=100000):
+    """
+    Stream the triangles of an ASCII STL file
+
+    :param path: path to the STL file
+    :param chunk_size: number of faces per yielded array
+    :return: generator of float64 arrays of shape (k, 3, 3)
+    """
+    coordinates = []
+    with open(path, 'rb') as f:
+        for line_number, line in enumerate(f, 1):
+            tokens = line.split()
+            if not tokens or tokens[0] != b'vertex':
+                continue
+            if len(tokens) != 4:
+                raise ValueError('malformed vertex on line {} of {}'.format(line_number, path))
+            coordinates.extend(tokens[1:])
+            if len(coordinates) == 9 * chunk_size:
+                yield np.array(coordinates, dtype=np.float64).reshape(-1, 3, 3)
+                coordinates = []
+
+    if len(coordinates) % 9:
+        raise ValueError('ASCII STL file ends in the middle of a face: {}'.format(path))
+    if coordinates:
+        yield np.array(coordinates, dtype=np.float64).reshape(-1, 3, 3)
+
+
+def read_ascii_stl(path, chunk_size=100000):
+    """
+    Read an ASCII STL file
+
+    :param path: path to the STL file
+    :param chunk_size: number of faces tokenized at a time
+    :return: a :py:class:`ASCIISTLMesh`, which streams the file rather than reading it into memory
+    """
+    with open(path, 'rb') as f:
+        first_line = f.readline().split()
+    name = b' '.join(first_line[1:]).decode('ascii', 'replace')
+    return ASCIISTLMesh(path, name=name, chunk_size=chunk_size)
+
+
+def load_stl(path, mmap=True):
+    """
+    Read a binary or ASCII STL file
+
+    :param path: path to the STL file
+    :param mmap: memory-map binary files rather than reading them into memory
+    :return: a :py:class:`STLMesh`
+    """
+    if is_binary_stl(path):
+        return read_binary_stl(path, mmap=mmap)
+    with open(path, 'rb') as f:
+        if f.read(5).lower() != b'solid':
+            raise ValueError('not an STL file: {}'.format(path))
+    return read_ascii_stl(path)
@@ -1,59 +1,381 @@
 __author__ = 'ryan'
 
+import heapq
 import tempfile
 import elasticsearch
+import numpy as np
+from caching import file_digest
+from stl_reader import load_stl, find_stl_files
+from rasterizer import NumpyRenderer
+from render_driver import render_sharded
+from render_pool import RenderError
+from report import REPORT_FILENAME, read_report
+from timing import Timings
+from views import RENDER_DEFAULTS
 from image_match.elasticsearch_driver import SignatureES
+from image_match.signature_database_base import make_record, normalized_distance
+from multiprocessing import Pool
 from os import spawnvp, P_WAIT, listdir, rmdir, remove, walk
-from os.path import expanduser, abspath, join, splitext, dirname, basename
+from operator import itemgetter
+from os.path import expanduser, abspath, join, splitext, dirname, basename, exists, getsize
+
+
+def _make_record(args):
+    # module level, so multiprocessing can pickle it
+    path, gis, k, N = args
+    return make_record(path, gis, k, N)
 
 
 class ThreeDSearch(object):
-    def __init__(self, es_nodes=['localhost'], index_name='match3d', cutoff=0.5):
-        self.es = elasticsearch.Elasticsearch(es_nodes)
-        self.ses = SignatureES(self.es, index=index_name)
+    def __init__(self, es_nodes=['localhost'], index_name='match3d', cutoff=0.5, render_pool=None,
+                 render_backend='blender', batch_search=False, processes=None, render_cache=None,
+                 signature_database=None, blender_processes=1, timing_hook=None):
+        if signature_database is None:
+            self.es = elasticsearch.Elasticsearch(es_nodes)
+            self.ses = SignatureES(self.es, index=index_name)
+        else:
+            # any other image_match signature database, e.g. local_index.SignatureIndex
+            self.es = None
+            self.ses = signature_database
         self.ses.distance_cutoff = cutoff
 
+        # compute all signatures in a process pool and query them with one _msearch
+        self.batch_search = batch_search
+        # size of the signature process pool (None for one per core, 1 to stay in this process)
+        self.processes = processes
+        self._signature_pool = None
+
+        # optional render_pool.RenderPool. Without one, blender is spawned for every render
+        self.render_pool = render_pool
+        # without a pool, directories of several STL files are split between this many blender processes
+        self.blender_processes = blender_processes
+
+        # 'blender', a name from render_backends, or an object with a render method like NumpyRenderer's
+        self.render_backend = render_backend
+        self.render_backends = {'numpy': NumpyRenderer()}
+
+        # optional caching.RenderCache, so a model already rendered with the same options isn't rendered again
+        self.render_cache = render_cache
+
+        # called with (stage, seconds, counts and sizes) as every stage of an add or search finishes, see timing.py
+        self.timing_hook = timing_hook
+
+    def generate_images(self, stl_directory_name, blender_args=None, output_directory=None,
+                        rotations=False, front_and_back=False, reflections=False, render_backend=None,
+                        stl_digest=None, timings=None, resolution=None):
+        """
+        Render the views of every STL file in a directory
+
+        :param stl_directory_name: directory containing STL files
+        :param blender_args: full blender command line to run instead (optional)
+        :param output_directory: where to write the images. A temporary directory is made if not given
+        :param rotations: render the 90 degree rotations too
+        :param front_and_back: render the back views too
+        :param reflections: render mirrored views too
+        :param render_backend: override the instance's render_backend for this call
+        :param stl_digest: caching.file_digest of the STL file, if already known (saves hashing it again)
+        :param timings: timing.Timings to record the render stage in (optional)
+        :param resolution: width and height of the views, instead of the renderer's default (optional)
+        :return: the output directory
+        """
+        if not output_directory:
+            output_directory = tempfile.mkdtemp()
+
+        backend = render_backend or self.render_backend
+        backend_name = backend if isinstance(backend, str) else type(backend).__name__
+        timings = timings or Timings(self.timing_hook)
+        with timings.stage('render', backend=backend_name) as info:
+            if resolution:
+                info['resolution'] = resolution
+            cache_key = None
+            stl_files = list(find_stl_files(stl_directory_name)) if self.render_cache and not blender_args else []
+            if len(stl_files) == 1:
+                cache_key = self.render_cache.key(stl_digest or file_digest(stl_files[0]),
+                                                  backend=backend_name,
+                                                  rotations=rotations,
+                                                  front_and_back=front_and_back,
+                                                  reflections=reflections,
+                                                  **self._render_settings(backend, resolution))
+                if self.render_cache.restore(cache_key, stl_files[0], output_directory):
+                    info.update(self._render_stats(output_directory), cached=True)
+                    return output_directory
+
+            failed = self._render(stl_directory_name, output_directory, blender_args=blender_args,
+                                  rotations=rotations, front_and_back=front_and_back, reflections=reflections,
+                                  render_backend=backend, resolution=resolution)
+            if failed:
+                info['failed'] = len(failed)
+            if cache_key:
+                self.render_cache.store(cache_key, output_directory)
+            info.update(self._render_stats(output_directory))
+        return output_directory
+
+    def _render_settings(self, render_backend, resolution=None):
+        # everything besides the view flags that changes the rendered images, for the render cache key
+        backend = self.render_backends.get(render_backend, render_backend)
+        if backend == 'blender':
+            return dict(RENDER_DEFAULTS, resolution=resolution or RENDER_DEFAULTS['resolution'])
+        if hasattr(backend, 'settings'):
+            return backend.settings(resolution)
+        # a backend that doesn't say what else it depends on
+        return {'resolution': resolution}
+
     @staticmethod
-    def generate_images(stl_directory_name, blender_args=None):
-        output_directory = tempfile.mkdtemp()
+    def _render_stats(output_directory):
+        # what the report says about the render: views and their bytes, and the renderer's own timings
+        stats = {'views': 0, 'bytes': 0}
+        report_path = join(output_directory, REPORT_FILENAME)
+        if not exists(report_path):
+            return stats
+        models = {}
+        render_seconds = 0.0
+        for row in read_report(report_path):
+            if row.get('image_filename') and exists(row['image_filename']):
+                stats['views'] += 1
+                stats['bytes'] += getsize(row['image_filename'])
+            if row.get('seconds'):
+                render_seconds += float(row['seconds'])
+            if row.get('faces'):
+                models[row['stl_filename']] = row
+        if render_seconds:
+            stats['render_seconds'] = render_seconds
+        if models:
+            stats.update({'models': len(models),
+                          'model_seconds': sum(float(row['model_seconds'] or 0) for row in models.values()),
+                          'faces': sum(int(row['faces']) for row in models.values())})
+            if all(row.get('vertices') for row in models.values()):
+                stats['vertices'] = sum(int(row['vertices']) for row in models.values())
+        return stats
+
+    def _render(self, stl_directory_name, output_directory, blender_args=None, rotations=False,
+                front_and_back=False, reflections=False, render_backend=None, resolution=None):
+        # only backends that take a resolution are given one
+        options = {'resolution': resolution} if resolution else {}
+        backend = self.render_backends.get(render_backend, render_backend)
+        if backend != 'blender' and not blender_args:
+            backend.render(stl_directory_name, output_directory,
+                           rotations=rotations,
+                           front_and_back=front_and_back,
+                           reflections=reflections,
+                           **options)
+            return
+
+        if self.render_pool and not blender_args:
+            failed = self.render_pool.render(stl_directory_name, output_directory,
+                                             all_rotations=rotations,
+                                             front_and_back=front_and_back,
+                                             reflections=reflections,
+                                             **options)
+            if failed and len(failed) >= len(list(find_stl_files(stl_directory_name))):
+                raise self._render_error(failed)
+            return failed
 
         if not blender_args:
-            blender_args = ['blender',
-                    '-b', '-P', 'image_match_generator.py', '--',
-                    '-d', abspath(expanduser(stl_directory_name)),
-                    '-o', output_directory,
-                    '--no-rotations',
-                    '--only-front-view']
+            if self.blender_processes > 1:
+                result = render_sharded(stl_directory_name, output_directory, processes=self.blender_processes,
+                                        script_args=self._view_options(rotations, front_and_back, reflections,
+                                                                       resolution))
+                if result['failed'] and not result['rendered']:
+                    raise self._render_error(result['failed'])
+                # the models that did render are still worth having; callers spot the others in the report
+                return result['failed']
+            blender_args = self._blender_command(stl_directory_name, output_directory, rotations=rotations,
+                                                 front_and_back=front_and_back, reflections=reflections,
+                                                 resolution=resolution)
 
         spawnvp(P_WAIT, 'blender', blender_args)
-        return output_directory
 
-    def search_images(self, _images_directory):
+    @staticmethod
+    def _render_error(failed):
+        # every model failed: nothing to carry on with. The (STL file, error) pairs go along as error.failed
+        error = RenderError('; '.join('{}: {}'.format(stl_name, error) for stl_name, error in failed))
+        error.failed = failed
+        return error
+
+    @staticmethod
+    def _view_options(rotations=False, front_and_back=False, reflections=False, resolution=None):
+        # image_match_generator.py's command line options for the views
+        options = ['--resolution', str(resolution)] if resolution else []
+        if not rotations:
+            options.append('--no-rotations')
+        if not front_and_back:
+            options.append('--only-front-view')
+        if not reflections:
+            options.append('--no-reflections')
+        return options
+
+    def _blender_command(self, stl_directory_name, output_directory, rotations=False, front_and_back=False,
+                         reflections=False, resolution=None):
+        return ['blender',
+                '-b', '-P', 'image_match_generator.py', '--',
+                '-d', abspath(expanduser(stl_directory_name)),
+                '-o', output_directory] + self._view_options(rotations, front_and_back, reflections, resolution)
+
+    @staticmethod
+    def check_stl(stl_file):
+        """
+        Read an STL file without blender, and refuse it if nothing in it can be rendered
+
+        :param stl_file: path to an STL file
+        :return: the :py:class:`stl_reader.STLMesh`
+        """
+        mesh = load_stl(stl_file)
+        report = mesh.validate()
+        if report['faces'] == report['non_finite_faces'] + report['degenerate_faces']:
+            raise ValueError('no renderable faces in STL file: {}'.format(stl_file))
+        return mesh
+
+    def search_images(self, _images_directory, batch=None, search_filter=None, timings=None):
+        """
+        Search the index with every image in a directory
+
+        :param _images_directory: directory of rendered views
+        :param batch: compute the signatures in parallel and send one _msearch (defaults to batch_search)
+        :param search_filter: elasticsearch query the hits must also match (optional, implies batch)
+        :param timings: timing.Timings to record the signature and query stages in (optional). Without
+            batch, image_match computes each signature and queries it in one go: a single search_image stage
+        :return: a list of hits for each image
+        """
         img_paths = [join(_images_directory, x) for x in listdir(_images_directory) if splitext(x)[-1] == '.png']
+        if batch is None:
+            batch = self.batch_search
+        timings = timings or Timings(self.timing_hook)
+        if batch or search_filter:
+            with timings.stage('signatures', views=len(img_paths)):
+                records = self.make_records(img_paths)
+            with timings.stage('query', views=len(records)) as info:
+                res = self.search_records(records, search_filter=search_filter)
+                info['hits'] = sum(len(hits) for hits in res)
+            return res
+
         res = []
-        for img_path in img_paths:
-            res.append(self.ses.search_image(img_path))
+        with timings.stage('search_image', views=len(img_paths)) as info:
+            for img_path in img_paths:
+                res.append(self.ses.search_image(img_path))
+            info['hits'] = sum(len(hits) for hits in res)
         return res
 
+    def iter_records(self, img_paths):
+        """
+        Compute image_match records (signature and words) for images, in the signature process pool
+
+        :param img_paths: paths of images
+        :return: generator of records, in the order of img_paths
+        """
+        if self.render_cache and self.render_cache.signatures:
+            return self._iter_cached_records(img_paths)
+        return self._compute_records(img_paths)
+
+    def _compute_records(self, img_paths):
+        args = [(img_path, self.ses.gis, self.ses.k, self.ses.N) for img_path in img_paths]
+        if self.processes == 1 or len(args) < 2:
+            return (_make_record(a) for a in args)
+        if self._signature_pool is None:
+            self._signature_pool = Pool(self.processes)
+        return self._signature_pool.imap(_make_record, args)
+
+    def _iter_cached_records(self, img_paths):
+        # records of images seen before come from the render cache, keyed by the image contents
+        digests = [file_digest(img_path) for img_path in img_paths]
+        cached = [self.render_cache.get_record(digest, img_path) for digest, img_path in zip(digests, img_paths)]
+        computed = self._compute_records([img_path for img_path, rec in zip(img_paths, cached) if rec is None])
+        for digest, rec in zip(digests, cached):
+            if rec is None:
+                rec = next(computed)
+                self.render_cache.put_record(digest, rec)
+            yield rec
+
+    def make_records(self, img_paths):
+        return list(self.iter_records(img_paths))
+
+    def search_records(self, records, doc_type='image', search_filter=None):
+        """
+        Search the index for many image_match records in a single _msearch request
+
+        :param records: records from make_records
+        :param search_filter: elasticsearch query the hits must also match (optional)
+        :return: a list of hits for each record, like search_images
+        """
+        if self.es is None:
+            return self.ses.search_records(records)
+        body, signatures = self._msearch_body(records, doc_type, search_filter)
+        if not body:
+            return []
+
+        responses = self.es.msearch(body=body)['responses']
+        return self._format_responses(responses, signatures)
+
+    def _msearch_body(self, records, doc_type='image', search_filter=None):
+        # the _msearch request body of search_records, and the signatures of the records
+        body = []
+        signatures = []
+        for rec in records:
+            words = dict((key, value) for key, value in rec.items() if key.startswith('simple_word_'))
+            signatures.append(rec['signature'])
+            query = {'bool': {'should': [{'term': {word: words[word]}} for word in words]}}
+            if search_filter:
+                query['bool'].update({'filter': search_filter, 'minimum_should_match': 1})
+            body.append({'index': self.ses.index, 'type': doc_type})
+            body.append({'query': query,
+                         '_source': {'exclude': ['simple_word_*']},
+                         'size': getattr(self.ses, 'size', 100)})
+        return body, signatures
+
+    def _format_responses(self, responses, signatures):
+        return [self._format_hits(response['hits']['hits'], signature)
+                for response, signature in zip(responses, signatures)]
+
+    def _format_hits(self, hits, signature):
+        # the same result format and cutoff as image_match's SignatureES
+        if not hits:
+            return []
+        dists = normalized_distance(np.array([hit['_source']['signature'] for hit in hits]), np.array(signature))
+        res = []
+        for hit, dist in zip(hits, dists):
+            if dist < self.ses.distance_cutoff:
+                res.append({'id': hit['_id'],
+                            'score': hit['_score'],
+                            'metadata': hit['_source'].get('metadata'),
+                            'path': hit['_source'].get('url', hit['_source'].get('path')),
+                            'dist': dist})
+        return sorted(res, key=itemgetter('dist'))
+
+    def close(self):
+        """Shut down the signature process pool"""
+        if self._signature_pool is not None:
+            self._signature_pool.terminate()
+            self._signature_pool = None
+
     @staticmethod
-    def composite_score(results):
+    def _design_key(hit):
+        # the directory of the image, named after the design by run_all's layout
+        return basename(dirname(hit['path']))
+
+    @classmethod
+    def composite_score(cls, results, key=None):
+        design_key = key or cls._design_key
         uniques = {}
         for i, result in enumerate(results):
             for hit in result:
-                k = basename(dirname(hit['path']))
-                if uniques.has_key(k):
+                k = design_key(hit)
+                if k is None:
+                    continue
+                if k in uniques:
                     uniques[k].append(hit['dist'])
                 else:
                     uniques[k] = [hit['dist']]
+        # views missing a hit count as the worst distance. Views of symmetric models that duplicate another
+        # aren't rendered, so scale by the views actually searched, not the three a search renders at most
+        n_views = len(results)
         for key in uniques:
-            uniques[key] += (3 - len(uniques[key])) * [1.]
-            uniques[key] = sum(uniques[key])/3.0
+            uniques[key] += (n_views - len(uniques[key])) * [1.]
+            uniques[key] = sum(uniques[key]) / float(n_views)
 
         return uniques
 
     @classmethod
-    def tournament_score(self, results, max_matches=5):
-        composite_score = self.composite_score(results)
+    def tournament_score(self, results, max_matches=5, key=None):
+        composite_score = self.composite_score(results, key=key)
         k = composite_score.keys()
         v = composite_score.values()
         winners = sorted(zip(k, v), key=lambda x: x[1])[:max_matches]
@@ -62,19 +384,17 @@ class ThreeDSearch(object):
             ranked_winners.update({winner[0]: i})
         return ranked_winners
 
-    @staticmethod
-    def best_single_image(results, n_per_view=5):
+    @classmethod
+    def best_single_image(cls, results, n_per_view=5, key=None):
+        key = key or cls._design_key
         scores = {}
         for result in results:
-            for i in range(n_per_view):
-                if result:
-                    best = min(result, key=lambda x: x['dist'])
-                    k = basename(dirname(best['path']))
-                    if k not in scores:
-                        scores[k] = best['dist']
-                    elif best['dist'] < scores[k]:
-                        scores[k] = best['dist']
-                    result.remove(best)
+            for hit in heapq.nsmallest(n_per_view, result, key=itemgetter('dist')):
+                k = key(hit)
+                if k is None:
+                    continue
+                if k not in scores or hit['dist'] < scores[k]:
+                    scores[k] = hit['dist']
         return scores
 
     @staticmethod
@@ -87,9 +407,9 @@ class ThreeDSearch(object):
                         and abspath(join(t[0], filename)) != ignore_path:
                     yield abspath(join(t[0], filename))
 
-    def run(self, stl_directory_name, return_raw=False, ranking='dist'):
+    def run(self, stl_directory_name, return_raw=False, ranking='dist', render_backend=None):
         key = basename(dirname(stl_directory_name))
-        images_path = self.generate_images(dirname(stl_directory_name))
+        images_path = self.generate_images(dirname(stl_directory_name), render_backend=render_backend)
         res = self.search_images(images_path)
         for file_path in listdir(images_path):
             remove(join(images_path, file_path))
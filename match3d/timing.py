@@ -0,0 +1,66 @@
+"""Time the stages of adding and searching designs
+
+An add or a search goes through several stages (download, loading the STL,
+rendering, computing signatures, querying...), each with its own costs. A
+:py:class:`Timings` records how long every stage took, along with counts and
+sizes (views, hits, faces, bytes), and passes each one on to a hook as soon as
+it finishes::
+
+    def log_stage(stage, seconds, info):
+        print('{:<12} {:8.3f}s {}'.format(stage, seconds, info))
+
+    api = APIOperations(index_name='3d_test', timing_hook=log_stage)
+    api.search(stl_file='porsche.stl', timings=True)['timings']
+"""
+__author__ = 'ryan'
+
+from contextlib import contextmanager
+
+import time
+
+
+class Timings(object):
+    def __init__(self, hook=None):
+        """
+        Durations, counts and sizes of the stages of an add or a search
+
+        :param hook: function called with (stage name, seconds, dict of counts and sizes) as every stage finishes
+        """
+        self.hook = hook
+        self.stages = []
+        self._started = time.time()
+
+    @contextmanager
+    def stage(self, name, **info):
+        """
+        Time the block as a stage. Counts known only at the end can be added to the dict it yields::
+
+            with timings.stage('query', views=len(records)) as info:
+                hits = search(records)
+                info['hits'] = len(hits)
+        """
+        started = time.time()
+        try:
+            yield info
+        finally:
+            self.record(name, time.time() - started, **info)
+
+    def record(self, name, seconds, **info):
+        """Add a stage timed some other way"""
+        self.stages.append((name, seconds, info))
+        if self.hook:
+            self.hook(name, seconds, info)
+
+    def summary(self):
+        """
+        The timing breakdown, ready to be serialized
+
+        :return: dict with the total seconds since the Timings was made and the list of stages, each a
+            dict with stage, seconds and its counts and sizes
+        """
+        stages = []
+        for name, seconds, info in self.stages:
+            stage = dict(info)
+            stage.update({'stage': name, 'seconds': seconds})
+            stages.append(stage)
+        return {'total': time.time() - self._started, 'stages': stages}
@@ -0,0 +1,129 @@
+"""Conventions for the views image_match_generator renders
+
+Shared by the blender renderer and the numpy rasterizer so both produce the same
+views under the same names. No bpy imports in here.
+
+Each model is scaled to fit a sphere of radius 3 around its center of mass and
+turned so that one of its principal axes lies along x. The orthographic camera
+and the lamp sit on the x axis, looking at the origin: at +x for the front view
+and -x for the back view. The camera's TRACK_TO constraint keeps world z up on
+the screen, so y runs left to right in the front view and right to left in the
+back view.
+"""
+__author__ = 'ryan'
+
+import numpy as np
+
+# width of the orthographic camera's view, as in blender's default scene
+ORTHO_SCALE = 7.314286
+
+# radius the model is scaled to
+MODEL_RADIUS = 3.0
+
+# what image_match_generator.py renders unless told otherwise. Part of the render cache key of
+# blender renders (see three_d_match.py), so changing a default doesn't serve views made under the old one
+RENDER_DEFAULTS = {'resolution': 1024, 'image_transforms': True, 'dedupe': True}
+
+
+def view_filename(stl_hash, eig_vec_num, rotation, side, reflected):
+    return '{}.{}.{}.{}.{}.png'.format(stl_hash, eig_vec_num, rotation, side, int(reflected))
+
+
+def transform_view(pixels, rotation, reflected, side):
+    """
+    Turn a rendered view into the view of the rotated and/or reflected object
+
+    Turning the object about the viewing axis only turns the image, and mirroring it
+    (z -> -z) only flips the image upside down, as z is up on the screen.
+
+    :param pixels: image array (rows top to bottom) of the unrotated, unreflected object
+    :param rotation: number of quarter turns of the object about the viewing axis
+    :param reflected: whether the object is mirrored after rotating
+    :param side: 'front' or 'back'. Seen from the back, the object turns the other way
+    """
+    k = rotation if side == 'front' else -rotation
+    pixels = np.rot90(pixels, k)
+    if reflected:
+        pixels = np.flipud(pixels)
+    return pixels
+
+
+def degenerate_eigenvalues(evals, tolerance=0.05):
+    """
+    Whether two principal moments are (nearly) equal
+
+    The principal axes in their plane are then arbitrary, and bodies of revolution and the like look
+    the same along either of them.
+
+    :param evals: the principal moments of inertia
+    :param tolerance: relative to the largest moment
+    """
+    evals = np.sort(np.abs(np.real(evals)))
+    return bool((np.diff(evals) <= tolerance * evals[-1]).any())
+
+
+class ViewDeduplicator(object):
+    def __init__(self, evals=None, eigenvalue_tolerance=0.05, pixel_tolerance=0.01, thumbnail_size=16):
+        """
+        Spot views of a model that look the same as one seen before
+
+        Views are compared with the others of the same principal axis (rotational and mirror symmetry),
+        and with those of the other axes only if the principal moments are degenerate.
+
+        :param evals: the principal moments of inertia of the model (None to compare every view with every other)
+        :param eigenvalue_tolerance: see degenerate_eigenvalues
+        :param pixel_tolerance: largest mean absolute difference of two duplicates, in grey levels from 0 to 1
+        :param thumbnail_size: views are only compared in full if their thumbnails this size are close
+        """
+        self.cross_axis = evals is None or degenerate_eigenvalues(evals, eigenvalue_tolerance)
+        self.pixel_tolerance = pixel_tolerance
+        self.thumbnail_size = thumbnail_size
+        self._kept = []
+
+    def canonical(self, view_id, eig_vec_num, pixels):
+        """
+        The id of an earlier view that looks the same, or None (and the view is remembered)
+
+        :param view_id: id of the view, e.g. its filename
+        :param eig_vec_num: principal axis of the view
+        :param pixels: image array (rows top to bottom), uint8 or floats in [0, 1], grey or with colour channels
+        """
+        grey = np.asarray(pixels)
+        if grey.dtype == np.uint8:
+            grey = grey / 255.0
+        if grey.ndim == 3:
+            grey = grey[:, :, :3].mean(axis=2)
+        grey = np.round(255 * grey).astype(np.uint8)
+        thumbnail = self._thumbnail(grey)
+
+        for kept_id, kept_axis, kept_thumbnail, kept_grey in self._kept:
+            if kept_axis != eig_vec_num and not self.cross_axis:
+                continue
+            if kept_grey.shape != grey.shape \
+                    or np.abs(kept_thumbnail - thumbnail).max() > 4 * self.pixel_tolerance:
+                continue
+            if np.abs(kept_grey.astype(np.int16) - grey).mean() / 255.0 <= self.pixel_tolerance:
+                return kept_id
+        self._kept.append((view_id, eig_vec_num, thumbnail, grey))
+        return None
+
+    def _thumbnail(self, grey):
+        # block means, on the largest part of the image that divides evenly
+        n = self.thumbnail_size
+        rows, columns = (grey.shape[0] // n) * n, (grey.shape[1] // n) * n
+        if not rows or not columns:
+            return grey / 255.0
+        return grey[:rows, :columns].reshape(n, rows // n, n, columns // n).mean(axis=(1, 3)) / 255.0
+
+
+def screen_coordinates(vertices, side):
+    """
+    Project vertices of an oriented model onto the camera's image plane
+
+    :param vertices: array of shape (..., 3)
+    :param side: 'front' or 'back'
+    :return: (right, up, depth) arrays in model units. Larger depth is closer to the camera
+    """
+    if side == 'front':
+        return vertices[..., 1], vertices[..., 2], vertices[..., 0]
+    return -vertices[..., 1], vertices[..., 2], -vertices[..., 0]
@@ -85,7 +85,11 @@ setup(
     ],
     install_requires=[
         'image_match',
+        # the client image_match is written for
+        'elasticsearch>=2.3,<2.4',
         'requests',
+        # the numpy render backend writes its views with it
+        'Pillow',
     ],
     tests_require=tests_require,
     extras_require={
@@ -0,0 +1,5 @@
+import sys
+from os.path import abspath, dirname, join
+
+# the modules of match3d import each other by name, as the blender scripts and the service run them
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'match3d'))
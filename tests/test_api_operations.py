@@ -0,0 +1,28 @@
+import pytest
+
+pytest.importorskip('image_match')
+pytest.importorskip('elasticsearch')
+
+from local_index import LocalOperations
+
+
+@pytest.fixture
+def operations(tmpdir):
+    return LocalOperations(str(tmpdir), cutoff=0.5)
+
+
+def test_decisive(operations):
+    # well within the cutoff: decisive_fraction * cutoff is 0.25
+    assert operations._decisive({'a': 0.2, 'b': 0.21})
+    # well ahead of the next best (min_separation is 0.1), or of the cutoff when there is no next best
+    assert operations._decisive({'a': 0.3, 'b': 0.45})
+    assert operations._decisive({'a': 0.3})
+    # close calls go on to the next tier
+    assert not operations._decisive({'a': 0.3, 'b': 0.32})
+    assert not operations._decisive({'a': 0.45})
+
+
+def test_no_match_is_decisive(operations):
+    assert operations._decisive({})
+    operations.escalate_no_match = True
+    assert not operations._decisive({})
@@ -0,0 +1,111 @@
+import threading
+
+import pytest
+
+from caching import LRUCache, RenderCache, ResultCache
+from rasterizer import NumpyRenderer
+from views import RENDER_DEFAULTS
+
+
+def test_render_cache_key():
+    options = {'backend': 'numpy', 'rotations': True, 'front_and_back': False, 'reflections': False,
+               'resolution': 512, 'supersample': 1, 'dedupe': True}
+    key = RenderCache.key('digest', **options)
+    assert RenderCache.key('digest', **dict(options)) == key
+    assert RenderCache.key('other digest', **options) != key
+    for name, value in options.items():
+        changed = dict(options)
+        changed[name] = 'something else'
+        assert RenderCache.key('digest', **changed) != key, name
+
+
+def test_numpy_renderer_settings():
+    assert NumpyRenderer(resolution=256).settings() == {'resolution': 256, 'supersample': 1, 'dedupe': True}
+    assert NumpyRenderer(resolution=256).settings(128)['resolution'] == 128
+    assert NumpyRenderer().settings() != NumpyRenderer(supersample=2).settings()
+    assert NumpyRenderer().settings() != NumpyRenderer(dedupe=False).settings()
+
+
+def test_render_settings(tmpdir):
+    pytest.importorskip('image_match')
+    pytest.importorskip('elasticsearch')
+    from local_index import LocalOperations
+
+    operations = LocalOperations(str(tmpdir))
+    # every image_match_generator.py setting besides the view flags, at the resolution rendered
+    assert operations._render_settings('blender') == RENDER_DEFAULTS
+    assert operations._render_settings('blender', 256) == dict(RENDER_DEFAULTS, resolution=256)
+    assert operations._render_settings('numpy') == operations.render_backends['numpy'].settings()
+    assert operations._render_settings(NumpyRenderer(supersample=2)) != operations._render_settings('numpy')
+
+
+def test_result_cache_generations(tmpdir):
+    for directory in (None, str(tmpdir)):
+        cache = ResultCache(directory=directory)
+        generation = cache.generation('index')
+        key = ResultCache.key('digest', ranking='single')
+        cache.put(key, 'index', generation, {'a': 0.1})
+        assert cache.get(key, 'index', generation) == {'a': 0.1}
+        # a copy, so callers can't change what's cached
+        cache.get(key, 'index', generation)['a'] = 1
+        assert cache.get(key, 'index', generation) == {'a': 0.1}
+
+        new_generation = cache.invalidate('index')
+        assert new_generation != generation
+        assert cache.generation('index') == new_generation
+        assert cache.get(key, 'index', new_generation) is None
+
+
+def test_result_cache_shared_directory(tmpdir):
+    first, second = ResultCache(directory=str(tmpdir)), ResultCache(directory=str(tmpdir))
+    generation = first.generation('index')
+    assert second.generation('index') == generation
+    first.put('key', 'index', generation, [1, 2])
+    assert second.get('key', 'index', generation) == [1, 2]
+    # a search started before another process wrote to the index isn't cached
+    second.invalidate('index')
+    first.put('stale', 'index', generation, [3])
+    assert ResultCache(directory=str(tmpdir)).get('stale', 'index', generation) is None
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    cache['a'] = 1
+    cache['b'] = 2
+    # reading a marks it as recently used, so b is forgotten first
+    assert cache['a'] == 1
+    cache['c'] = 3
+    assert 'b' not in cache
+    assert cache.get('b') is None
+    assert (cache['a'], cache['c']) == (1, 3)
+    assert cache.pop('a') == 1
+    del cache['c']
+    assert len(cache) == 0
+
+
+def test_caches_shared_between_threads(tmpdir):
+    lru = LRUCache(maxsize=50)
+    results = ResultCache(maxsize=50, directory=str(tmpdir))
+    errors = []
+
+    def work(thread):
+        try:
+            for i in range(200):
+                lru[(thread, i)] = i
+                lru.get((thread, i - 1))
+                lru.pop((thread, i - 2), None)
+                generation = results.generation('index')
+                results.put(str(i), 'index', generation, i)
+                results.get(str(i), 'index', generation)
+                if i % 50 == 0:
+                    results.invalidate('index')
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(thread,)) for thread in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert len(lru) <= 50
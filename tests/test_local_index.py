@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('image_match')
+pytest.importorskip('elasticsearch')
+
+from local_index import SignatureIndex, _top
+
+N = 4
+
+
+def record(words, signature, stl_id=None):
+    rec = {'signature': list(signature), 'path': 'view.png', 'metadata': {'stl_id': stl_id} if stl_id else None}
+    for i, word in enumerate(words):
+        rec['simple_word_{}'.format(i)] = word
+    return rec
+
+
+def make_index(directory=None, size=100, max_segments=10):
+    return SignatureIndex(directory, size=size, max_segments=max_segments, N=N, distance_cutoff=1.0)
+
+
+def ids(hits):
+    return [hit['id'] for hit in hits]
+
+
+def test_search_by_distance():
+    index = make_index()
+    index.insert_records([record([1, 2, 3, 4], [1, 1, 1, 1]),
+                          record([1, 2, 3, 5], [1, 1, 1, 0]),
+                          record([6, 7, 8, 9], [1, 1, 1, 1])], ids=['same', 'close', 'unrelated'])
+    hits = index.search_single_record(record([1, 2, 3, 4], [1, 1, 1, 1]))
+    # rows sharing no word are not candidates
+    assert ids(hits) == ['same', 'close']
+    assert hits[0]['dist'] == 0
+    assert hits[0]['score'] == 4 and hits[1]['score'] == 3
+
+
+def test_distance_cutoff():
+    index = make_index()
+    index.distance_cutoff = 0.1
+    index.insert_records([record([1, 2, 3, 4], [1, 1, 1, 1]), record([1, 2, 3, 5], [-1, -1, -1, 1])],
+                         ids=['same', 'far'])
+    assert ids(index.search_single_record(record([1, 2, 3, 4], [1, 1, 1, 1]))) == ['same']
+
+
+def test_replace_and_delete():
+    index = make_index()
+    index.insert_records([record([1, 2, 3, 4], [1, 1, 1, 1])], ids=['a'])
+    index.flush()
+    index.insert_records([record([5, 6, 7, 8], [1, 1, 1, 1])], ids=['a'])
+    assert index.search_single_record(record([1, 2, 3, 4], [1, 1, 1, 1])) == []
+    assert len(index) == 1
+    assert ids(index.search_single_record(record([5, 6, 7, 8], [1, 1, 1, 1]))) == ['a']
+
+    index.delete(['a'])
+    assert len(index) == 0
+    assert index.search_single_record(record([5, 6, 7, 8], [1, 1, 1, 1])) == []
+
+
+def test_stl_ids_filter():
+    index = make_index()
+    index.insert_records([record([1, 2, 3, 4], [1, 1, 1, 1], stl_id='x'),
+                          record([1, 2, 3, 4], [1, 1, 1, 1], stl_id='y'),
+                          record([1, 2, 3, 4], [1, 1, 1, 1])], ids=['x1', 'y1', 'none'])
+    query = record([1, 2, 3, 4], [1, 1, 1, 1])
+    assert sorted(ids(index.search_records([query])[0])) == ['none', 'x1', 'y1']
+    assert ids(index.search_records([query], stl_ids=['y'])[0]) == ['y1']
+    assert index.search_records([query], stl_ids=[])[0] == []
+
+
+def test_size_keeps_the_best_candidates():
+    # candidates are picked by shared words before distances are computed, ties going to the oldest rows
+    index = make_index(size=2)
+    index.insert_records([record([1, 0, 0, 0], [1, 1, 1, 1]),
+                          record([1, 2, 0, 0], [1, 1, 1, 1])], ids=['one word', 'two words'])
+    index.flush()
+    index.insert_records([record([1, 2, 3, 0], [-1, -1, 1, 1]),
+                          record([1, 2, 0, 9], [1, 1, 1, 1])], ids=['three words', 'two words, later'])
+    hits = index.search_single_record(record([1, 2, 3, 4], [1, 1, 1, 1]))
+    assert sorted(ids(hits)) == ['three words', 'two words']
+
+
+def test_persistence_and_optimize(tmpdir):
+    directory = str(tmpdir.join('index'))
+    index = make_index(directory, max_segments=2)
+    for i in range(4):
+        index.insert_records([record([i, 10 + i, 20 + i, 30 + i], [1, 1, 1, 1])], ids=[str(i)])
+        index.flush()
+    # the segments were merged along the way
+    assert len(index.segments) <= 2
+    index.delete(['0'])
+
+    reopened = make_index(directory)
+    assert len(reopened) == 3
+    assert reopened.search_single_record(record([0, 10, 20, 30], [1, 1, 1, 1])) == []
+    reopened.optimize()
+    assert len(reopened.segments) == 1
+    assert ids(make_index(directory).search_single_record(record([3, 13, 23, 33], [1, 1, 1, 1]))) == ['3']
+
+
+def test_top():
+    rows = np.arange(6)
+    counts = np.array([1, 3, 2, 3, 2, 1])
+    top_rows, top_counts = _top(rows, counts, 3)
+    assert list(top_rows) == [1, 2, 3]
+    assert list(top_counts) == [3, 2, 3]
+    top_rows, _ = _top(rows, counts, 10)
+    assert list(top_rows) == list(rows)
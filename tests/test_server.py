@@ -0,0 +1,120 @@
+import json
+import threading
+
+import pytest
+
+pytest.importorskip('image_match')
+pytest.importorskip('elasticsearch')
+pytest.importorskip('requests')
+
+from server import Job, JobQueue, QueueFull, Service
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import Request, urlopen, HTTPError
+
+
+class Blocker(object):
+    # a job function that runs until released
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, *args, **kwargs):
+        self.started.set()
+        self.release.wait(10)
+        return {'args': list(args)}
+
+
+@pytest.fixture
+def blocker():
+    blocker = Blocker()
+    yield blocker
+    blocker.release.set()
+
+
+def test_same_key_shares_a_job(blocker):
+    jobs = JobQueue(workers=1, max_queued=4)
+    cleaned = []
+    first = jobs.submit(Job('search', blocker, ('a',), key='digest'))
+    second = jobs.submit(Job('search', blocker, ('b',), key='digest', cleanup=lambda: cleaned.append('b')))
+    assert second is first
+    assert first.requests == 2
+    # the duplicate's temporary file is removed at once
+    assert cleaned == ['b']
+    assert jobs.submit(Job('search', blocker, ('c',), key='other digest')) is not first
+
+    blocker.release.set()
+    assert first.wait(10)
+    assert first.state == 'done' and first.result == {'args': ['a']}
+    # a finished job isn't shared any more
+    assert jobs.submit(Job('search', blocker, ('d',), key='digest')) is not first
+    jobs.close()
+
+
+def test_queue_full(blocker):
+    jobs = JobQueue(workers=1, max_queued=1)
+    running = jobs.submit(Job('add', blocker))
+    assert blocker.started.wait(10)
+    jobs.submit(Job('add', blocker))
+    cleaned = []
+    with pytest.raises(QueueFull):
+        jobs.submit(Job('add', blocker, cleanup=lambda: cleaned.append(True)))
+    assert cleaned == [True]
+    assert jobs.stats()['queued'] == 1
+
+    blocker.release.set()
+    assert running.wait(10)
+    jobs.close()
+
+
+def test_failed_job():
+    def fail():
+        raise ValueError('bad model')
+    jobs = JobQueue(workers=1)
+    job = jobs.submit(Job('add', fail))
+    assert job.wait(10)
+    assert job.state == 'failed' and job.error == 'ValueError: bad model'
+    assert jobs.get(job.id) is job
+    jobs.close()
+
+
+class Operations(object):
+    def __init__(self, add):
+        self.add = add
+
+
+def test_busy_service_answers_429(blocker):
+    jobs = JobQueue(workers=1, max_queued=1)
+    service = Service(('127.0.0.1', 0), Operations(blocker), jobs, retry_after=7)
+    thread = threading.Thread(target=service.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:{}/designs'.format(service.server_address[1])
+
+    def post(stl_id):
+        body = json.dumps({'stl_id': stl_id, 'stl_url': 'http://example.com/{}.stl'.format(stl_id)})
+        request = Request(url, body.encode('utf-8'), {'Content-Type': 'application/json'})
+        try:
+            response = urlopen(request, timeout=10)
+        except HTTPError as e:
+            response = e
+        return response.getcode(), response.info(), json.loads(response.read().decode('utf-8'))
+
+    try:
+        assert post('running')[0] == 202
+        assert blocker.started.wait(10)
+        status, headers, body = post('queued')
+        assert status == 202
+        assert headers['Location'] == '/jobs/' + body['job']['id']
+        status, headers, body = post('refused')
+        assert status == 429
+        assert headers['Retry-After'] == '7'
+        assert 'error' in body
+    finally:
+        blocker.release.set()
+        service.shutdown()
+        service.server_close()
+        jobs.close()
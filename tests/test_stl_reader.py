@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+from stl_reader import BINARY_FACE, ASCIISTLMesh, is_binary_stl, load_stl
+
+TETRAHEDRON = np.array([[[0, 0, 0], [1, 0, 0], [0, 1, 0]],
+                        [[0, 0, 0], [0, 0, 1], [1, 0, 0]],
+                        [[0, 0, 0], [0, 1, 0], [0, 0, 1]],
+                        [[1, 0, 0], [0, 0, 1], [0, 1, 0]]], dtype=np.float32)
+
+
+def write_binary(path, triangles, header=b'binary', trailing=b''):
+    records = np.zeros(len(triangles), dtype=BINARY_FACE)
+    records['vertices'] = triangles
+    with open(str(path), 'wb') as f:
+        f.write(header.ljust(80, b'\0'))
+        f.write(np.array([len(triangles)], dtype='<u4').tobytes())
+        f.write(records.tobytes())
+        f.write(trailing)
+    return str(path)
+
+
+def write_ascii(path, triangles, name='tetrahedron'):
+    lines = ['solid ' + name]
+    for triangle in triangles:
+        lines += ['  facet normal 0 0 0', '    outer loop']
+        lines += ['      vertex {} {} {}'.format(*vertex) for vertex in triangle]
+        lines += ['    endloop', '  endfacet']
+    lines.append('endsolid ' + name)
+    with open(str(path), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return str(path)
+
+
+def test_binary(tmpdir):
+    path = write_binary(tmpdir.join('a.stl'), TETRAHEDRON)
+    assert is_binary_stl(path)
+    mesh = load_stl(path)
+    assert len(mesh) == 4
+    assert mesh.name == 'binary'
+    np.testing.assert_array_equal(mesh.triangles, TETRAHEDRON)
+
+
+def test_binary_with_solid_header(tmpdir):
+    path = write_binary(tmpdir.join('a.stl'), TETRAHEDRON, header=b'solid exported by a CAD tool')
+    assert is_binary_stl(path)
+    np.testing.assert_array_equal(load_stl(path).triangles, TETRAHEDRON)
+
+
+@pytest.mark.parametrize('header', [b'binary', b'solid exported by a CAD tool'])
+def test_binary_with_trailing_bytes(tmpdir, header):
+    path = write_binary(tmpdir.join('a.stl'), TETRAHEDRON, header=header, trailing=b'\0' * 7)
+    assert is_binary_stl(path)
+    np.testing.assert_array_equal(load_stl(path).triangles, TETRAHEDRON)
+
+
+def test_ascii(tmpdir):
+    path = write_ascii(tmpdir.join('a.stl'), TETRAHEDRON)
+    assert not is_binary_stl(path)
+    mesh = load_stl(path)
+    assert isinstance(mesh, ASCIISTLMesh)
+    assert mesh.name == 'tetrahedron'
+    assert len(mesh) == 4
+    np.testing.assert_array_equal(mesh.triangles, TETRAHEDRON)
+
+
+def test_ascii_streams_in_chunks(tmpdir):
+    triangles = np.concatenate([TETRAHEDRON + i for i in range(5)])
+    mesh = ASCIISTLMesh(write_ascii(tmpdir.join('a.stl'), triangles), chunk_size=3)
+    chunks = list(mesh.iter_chunks())
+    assert [len(chunk) for chunk in chunks] == [3, 3, 3, 3, 3, 3, 2]
+    np.testing.assert_array_equal(np.concatenate(chunks), triangles)
+    # streaming doesn't keep the triangles
+    assert mesh._triangles is None
+    assert len(mesh) == 20
+
+
+def test_ascii_truncated_face(tmpdir):
+    path = write_ascii(tmpdir.join('a.stl'), TETRAHEDRON)
+    with open(path) as f:
+        lines = f.read().splitlines()
+    with open(path, 'w') as f:
+        # drop the last vertex
+        f.write('\n'.join(lines[:-5] + lines[-4:]) + '\n')
+    with pytest.raises(ValueError):
+        list(load_stl(path).iter_chunks())
+
+
+def test_not_an_stl(tmpdir):
+    path = tmpdir.join('a.stl')
+    path.write('hello')
+    with pytest.raises(ValueError):
+        load_stl(str(path))
+
+
+def test_truncated_binary(tmpdir):
+    path = write_binary(tmpdir.join('a.stl'), TETRAHEDRON)
+    with open(path, 'rb') as f:
+        contents = f.read()
+    with open(path, 'wb') as f:
+        f.write(contents[:-10])
+    with pytest.raises(ValueError):
+        load_stl(path)
@@ -0,0 +1,51 @@
+import numpy as np
+
+from views import ViewDeduplicator, degenerate_eigenvalues, transform_view
+
+
+def view(seed, size=32):
+    return np.random.RandomState(seed).randint(0, 256, (size, size)).astype(np.uint8)
+
+
+def test_degenerate_eigenvalues():
+    assert degenerate_eigenvalues([1.0, 1.0, 2.0])
+    assert degenerate_eigenvalues([1.0, 1.02, 2.0])
+    assert not degenerate_eigenvalues([1.0, 1.5, 2.0])
+
+
+def test_duplicates_of_the_same_axis():
+    dedupe = ViewDeduplicator(evals=[1.0, 1.5, 2.0])
+    assert dedupe.canonical('a', 0, view(0)) is None
+    assert dedupe.canonical('b', 0, view(0)) == 'a'
+    # within pixel_tolerance: a grey level off here and there, like antialiasing
+    nearly = view(0).astype(np.int16) + np.random.RandomState(2).randint(-2, 3, (32, 32))
+    assert dedupe.canonical('c', 0, np.clip(nearly, 0, 255).astype(np.uint8)) == 'a'
+    assert dedupe.canonical('d', 0, view(1)) is None
+
+
+def test_other_axes_only_when_degenerate():
+    assert ViewDeduplicator(evals=[1.0, 1.5, 2.0]).canonical('a', 0, view(0)) is None
+    distinct = ViewDeduplicator(evals=[1.0, 1.5, 2.0])
+    distinct.canonical('a', 0, view(0))
+    assert distinct.canonical('b', 1, view(0)) is None
+
+    symmetric = ViewDeduplicator(evals=[1.0, 1.0, 2.0])
+    symmetric.canonical('a', 0, view(0))
+    assert symmetric.canonical('b', 1, view(0)) == 'a'
+
+
+def test_pixel_formats():
+    dedupe = ViewDeduplicator()
+    grey = view(0)
+    assert dedupe.canonical('grey', 0, grey) is None
+    # floats in [0, 1], and colour channels (with alpha), are compared as grey levels
+    assert dedupe.canonical('floats', 0, grey / 255.0) == 'grey'
+    assert dedupe.canonical('rgba', 0, np.dstack([grey, grey, grey, np.zeros_like(grey)])) == 'grey'
+    # a different shape is never a duplicate
+    assert dedupe.canonical('small', 0, grey[:16, :16]) is None
+
+
+def test_rotated_views_are_distinct():
+    dedupe = ViewDeduplicator()
+    dedupe.canonical('a', 0, view(0))
+    assert dedupe.canonical('b', 0, transform_view(view(0), 1, False, 'front')) is None